@@ -2,4 +2,7 @@
 
 nohup celery -A fills.tasks worker -l INFO -c 2 &>/app/logs/celery-console.log &
 
+# 生成任务的进度推送
+nohup uvicorn fillexcel.asgi:application --host 0.0.0.0 --port 4300 &>/app/logs/asgi-console.log &
+
 uwsgi --ini /app/config/uwsgi.ini
\ No newline at end of file
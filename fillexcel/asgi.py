@@ -8,9 +8,25 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 """
 
 import os
+import re
 
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fillexcel.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Django 初始化后才能导入
+from fills.events import job_events  # noqa: E402
+
+# 生成任务的进度推送，其余请求交给 Django
+JOB_EVENTS_PATTERN = re.compile(r'^/fills/events/(?P<hash_id>[0-9A-Za-z-]+)$')
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http':
+        matched = JOB_EVENTS_PATTERN.match(scope['path'])
+        if matched:
+            await job_events(scope, receive, send, matched['hash_id'])
+            return
+    await django_application(scope, receive, send)
@@ -1,4 +1,5 @@
 import pathlib
+import tempfile
 from configparser import ConfigParser
 from configparser import ExtendedInterpolation
 
@@ -31,3 +32,39 @@ def read_celery_config():
                           interpolation=ExtendedInterpolation())
     config.read(CURRENT_DIR / 'configure.ini', encoding='utf8')
     return config['celery']
+
+
+def read_payload_config():
+    config = ConfigParser(allow_no_value=True,
+                          interpolation=ExtendedInterpolation())
+    config.read(CURRENT_DIR / 'configure.ini', encoding='utf8')
+    c = config['payload'] if config.has_section('payload') else {}
+    return {
+        'mode': c.get('mode', 'reference'),
+        'location': c.get('location', config['celery']['backend']),
+        'ttl': c.get('ttl', '3600')
+    }
+
+
+def read_template_cache_config():
+    config = ConfigParser(allow_no_value=True,
+                          interpolation=ExtendedInterpolation())
+    config.read(CURRENT_DIR / 'configure.ini', encoding='utf8')
+    c = config['template_cache'] if config.has_section('template_cache') else {}
+    return {
+        'enabled': c.get('enabled', 'true') == 'true',
+        'directory': c.get('directory', None) or str(pathlib.Path(tempfile.gettempdir()) / 'fillexcel-templates'),
+        'max_size': int(c.get('max_size', '512')),
+        'memory_entries': int(c.get('memory_entries', '16'))
+    }
+
+
+def read_job_config():
+    config = ConfigParser(allow_no_value=True,
+                          interpolation=ExtendedInterpolation())
+    config.read(CURRENT_DIR / 'configure.ini', encoding='utf8')
+    c = config['job'] if config.has_section('job') else {}
+    return {
+        'location': c.get('location', None) or config['celery']['backend'],
+        'ttl': int(c.get('ttl', '86400'))
+    }
@@ -213,6 +213,30 @@ REST_FRAMEWORK = {
     'DATETIME_FORMAT': '%Y-%m-%d %H:%M:%S',
     'PAGE_SIZE': 8
 }
+# 生成数据是否放在 Celery 进程中执行，False 时在请求中生成数据后再提交写入任务
+GENERATE_IN_WORKER = True
+# 支持的最大填充行数；在 Celery 进程中按块生成时内存占用与行数无关，适用于流式写入的 stream 和 xml 写入方式
+FILL_MAX_LINE_NUMBER = 100000
+# 按写入方式限制的最大填充行数，openpyxl 写入方式会将整个工作簿放在内存中
+FILL_MAX_LINE_NUMBER_BY_ENGINE = {'openpyxl': 10000}
+# GENERATE_IN_WORKER 为 False 时在请求中一次生成全部数据，行数上限保持原来的 200 行
+FILL_MAX_LINE_NUMBER_IN_REQUEST = 200
+# 同时生成同一层互不依赖的列的线程数，1 表示逐列生成；生成数据主要受 GIL 限制，只有生成器释放 GIL 时多线程才有收益
+FILL_COLUMN_WORKERS = 1
+# 批量生成时每批最多的文件数
+GENERATE_BATCH_MAX_ITEMS = 500
+# 单次生成的最大份数
+GENERATE_MAX_COPIES = 20
+# 进程内缓存生成规则等数据的最大数量、秒数，以及与其他进程比较版本号的间隔秒数
+LOCAL_CACHE_MAX_ENTRIES = 1024
+LOCAL_CACHE_TIMEOUT = 300
+LOCAL_CACHE_VERSION_CHECK_INTERVAL = 5
+# 按多个ID查询时每次最多的数量
+BULK_DETAIL_MAX_IDS = 100
+# 直接上传/下载对象存储文件的临时地址有效期（秒）
+PRESIGNED_URL_EXPIRES = 600
+# 直接上传的模板文件大小上限（字节）
+PRESIGNED_UPLOAD_MAX_SIZE = 20 * 1024 * 1024
 # Token 的有效期配置
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(hours=4),
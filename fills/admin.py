@@ -9,7 +9,7 @@ from .models import GenerateRule, GenerateRuleParameter
 # Register your models here.
 class FillingRequirementAdmin(admin.ModelAdmin):
     list_display = ('id', 'username', 'remark', 'file_id', 'original_filename', 'start_line', 'line_number',
-                    'created_at', 'updated_at')
+                    'write_engine', 'created_at', 'updated_at')
     list_per_page = 16
 
 
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class FillsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'fills'
+
+    def ready(self):
+        # 注册模型变化的信号处理
+        from . import signals  # noqa: F401
@@ -1,11 +1,185 @@
 import logging
+import math
+import random
+import time
+import typing
 from functools import wraps
 
-from django.core.cache import cache
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
 from rest_framework.response import Response
 
 log = logging.getLogger(__name__)
 
+# 过期后仍可返回旧数据的秒数，期间只有一个请求重新查询
+STALE_SECONDS = 300
+# 重新查询时持有锁的最长秒数
+LOCK_SECONDS = 10
+# 没有旧数据时等待其他请求查询完成的最长秒数，超过后自己查询
+LOCK_WAIT_SECONDS = 2
+# 提前刷新的倾向，越大越早刷新
+EARLY_REFRESH_BETA = 1.0
+
+# 锁的值与加锁时的令牌相同时才删除，查询超过 LOCK_SECONDS 后不会删除其他请求的锁
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_release_script = None
+
+
+class CacheEntry(typing.NamedTuple):
+    """缓存的数据和过期时间，数据为空或 0 时也能与未缓存区分"""
+    value: typing.Any
+    # 过期的时间戳
+    expires_at: float
+    # 查询耗时的秒数
+    delta: float
+
+
+def get_or_query(cache_key, query, timeout=None):
+    """读取缓存，没有或过期时查询数据库后放入缓存
+
+    同一个 key 同时只有一个请求查询数据库，其他请求返回过期前的数据或等待查询完成；
+    临近过期时按查询耗时随机提前刷新，避免大量请求在同一时刻过期
+
+    :param cache_key 缓存的 key
+    :param query 读取数据库的无参数函数
+    :param timeout 缓存的秒数，为空时使用默认的缓存时间
+    """
+    if timeout is None:
+        timeout = caches['default'].default_timeout
+    entry = _read_entry(cache_key)
+    now = time.time()
+    if entry is not None and not _should_refresh(entry, now):
+        return entry.value
+    lock_key = f'{cache_key}:lock'
+    # 整数不经过序列化，Redis 中保存的值就是令牌本身
+    token = random.getrandbits(62) + 1
+    if not cache.add(lock_key, token, LOCK_SECONDS):
+        if entry is not None:
+            # 其他请求正在刷新，先返回现有的数据
+            return entry.value
+        entry = _wait_entry(cache_key, lock_key)
+        if entry is not None:
+            return entry.value
+        # 等待超时，不持有锁直接查询，也不删除其他请求的锁
+        log.warning('<CacheManager> wait lock timeout: ' + cache_key)
+        return _query_and_store(cache_key, query, timeout)
+    try:
+        return _query_and_store(cache_key, query, timeout)
+    finally:
+        _release_lock(lock_key, token)
+
+
+def _query_and_store(cache_key, query, timeout):
+    t0 = time.perf_counter()
+    val = query()
+    delta = time.perf_counter() - t0
+    cache.set(cache_key, CacheEntry(val, time.time() + timeout, delta), timeout + STALE_SECONDS)
+    log.info('<CacheManager> store key: ' + cache_key)
+    return val
+
+
+def _release_lock(lock_key, token):
+    """锁仍属于当前请求时删除，Redis 中比较和删除在一个 Lua 脚本中完成"""
+    global _release_script
+    backend = caches['default']
+    if isinstance(backend, RedisCache):
+        key = backend.make_and_validate_key(lock_key)
+        client = backend._cache.get_client(key, write=True)
+        if _release_script is None:
+            _release_script = client.register_script(_RELEASE_LOCK_SCRIPT)
+        _release_script(keys=(key,), args=(token,), client=client)
+    elif cache.get(lock_key, None) == token:
+        cache.delete(lock_key)
+
+
+def _read_entry(cache_key) -> typing.Optional[CacheEntry]:
+    entry = cache.get(cache_key, None)
+    # 忽略旧格式的缓存
+    return entry if isinstance(entry, CacheEntry) else None
+
+
+def _should_refresh(entry: CacheEntry, now):
+    """已过期，或按查询耗时随机决定提前刷新"""
+    return now - entry.delta * EARLY_REFRESH_BETA * math.log(1 - random.random()) >= entry.expires_at
+
+
+def _wait_entry(cache_key, lock_key):
+    """等待其他请求查询完成，间隔逐渐增加，超时后返回 None
+
+    同步的 Web 进程在等待期间被占用，因此只在没有旧数据时等待，且最多等待 LOCK_WAIT_SECONDS
+    """
+    deadline = time.monotonic() + LOCK_WAIT_SECONDS
+    interval = 0.02
+    while time.monotonic() < deadline:
+        time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+        interval = min(interval * 2, 0.2)
+        entry = _read_entry(cache_key)
+        if entry is not None:
+            return entry
+        if not cache.get(lock_key, None):
+            return _read_entry(cache_key)
+    return None
+
+
+def cache_namespace(name, owner=None):
+    """列表和单个查询缓存的命名空间，按数据类型或所属对象区分
+
+    :param name 数据类型，一般是模型名
+    :param owner 所属对象，如用户名、填充要求ID
+    """
+    return name if owner is None else f'{name}@{owner}'
+
+
+def _version_key(namespace):
+    return f'CacheVersion:{namespace}'
+
+
+def get_versions(*namespaces):
+    """读取命名空间的版本号，拼接后放入缓存的 key，版本号变化后旧的 key 不再被读取
+
+    :param namespaces 命名空间
+    """
+    versions = get_version_map(namespaces)
+    return '.'.join(str(versions[namespace]) for namespace in namespaces)
+
+
+def get_version_map(namespaces):
+    """批量读取命名空间的版本号，一次访问缓存，只有丢失的版本号需要重新写入
+
+    :param namespaces 命名空间
+    :return 命名空间对应的版本号
+    """
+    keys = dict(((namespace, _version_key(namespace)) for namespace in namespaces))
+    versions = cache.get_many(keys.values())
+    missing = tuple(key for key in keys.values() if key not in versions)
+    if missing:
+        # 版本号丢失时以当前时间开始，不会与丢失前的版本号重复
+        for key in missing:
+            cache.add(key, time.time_ns() // 1000000, None)
+        versions.update(cache.get_many(missing))
+    return dict(((namespace, versions.get(key, 0)) for namespace, key in keys.items()))
+
+
+def bump_versions(*namespaces):
+    """增加命名空间的版本号，命名空间中所有的列表和单个查询缓存同时失效
+
+    :param namespaces 命名空间
+    """
+    for namespace in namespaces:
+        key = _version_key(namespace)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # 还没有版本号时没有对应的缓存
+            cache.add(key, time.time_ns() // 1000000, None)
+        log.info('<CacheManager> bump version: ' + namespace)
+
 
 class CacheManager:
     # 缓存前缀
@@ -18,79 +192,151 @@ class CacheManager:
         """
         return getattr(self, 'cache_prefix')
 
-    def get_cache(self, pk: int | str, query):
+    def get_cache(self, pk: int | str, query, namespaces: tuple = ()):
         """
-        :param pk 数据库对象主键
+        :param pk 数据库对象主键或查询条件
         :param query 读取数据库的无参数函数
+        :param namespaces 数据所属的命名空间，版本号作为 key 的一部分
         """
-        cache_key = f'{self.prefix}:{pk}'
-        val = cache.get(cache_key, None)
-        if val:
-            return val
-        else:
-            val = query()
-            cache.set(cache_key, val)
-            log.info('<CacheManager> store key: ' + cache_key)
-            return val
+        if namespaces:
+            return get_or_query(f'{self.prefix}:v{get_versions(*namespaces)}:{pk}', query)
+        return get_or_query(f'{self.prefix}:{pk}', query)
+
+    @staticmethod
+    def params_key(query_params, names: tuple[str, ...]):
+        """由查询参数组成缓存 key，只包含影响查询结果的参数
+
+        :param query_params 查询参数
+        :param names 参数名
+        """
+        return '&'.join(f'{name}={query_params.get(name)}' for name in names if query_params.get(name, None))
 
     def invalid_cache(self, pk: int | str):
         """
         :param pk 数据库对象主键
         """
         cache_key = f'{self.prefix}:{pk}'
-        val = cache.get(cache_key, None)
-        if val:
-            log.info('<CacheManager> delete key: ' + cache_key)
-            cache.delete(cache_key)
+        log.info('<CacheManager> delete key: ' + cache_key)
+        cache.delete(cache_key)
+
+
+class _UncachedResponse(Exception):
+    """响应不是成功状态，不放入缓存"""
+
+
+def response_key(view_name, pk, namespace=None):
+    """单个查询响应的缓存 key
 
+    :param view_name 视图类名
+    :param pk 路径参数
+    :param namespace 数据所属的命名空间
+    """
+    if namespace:
+        return f'{view_name}:v{get_versions(namespace)}:{pk}'
+    return f'{view_name}:{pk}'
+
+
+def _response_key(view, kwargs, cache_key, namespace):
+    return response_key(view.__class__.__name__, kwargs.get(str(cache_key), 'none'), namespace)
+
+
+def get_many_or_query(view_name, pks, query, namespace=None):
+    """批量读取单个查询的缓存，与 cacheable 使用相同的 key，未缓存的数据一次查询后一起放入缓存
+
+    数据的 key 包含命名空间的版本号，需要先读取版本号再一次读取所有数据，与数量无关固定两次访问缓存。
+    过期的数据与 get_or_query 相同：获得锁的请求重新查询，其他请求返回旧数据
+
+    :param view_name 单个查询的视图类名
+    :param pks 主键
+    :param query 按未缓存的主键查询的函数，返回主键对应的数据
+    :param namespace 数据所属的命名空间
+    :return 主键对应的数据，不存在的主键不包含在内
+    """
+    prefix = response_key(view_name, '', namespace)
+    keys = dict(((pk, f'{prefix}{pk}') for pk in pks))
+    entries = cache.get_many(keys.values())
+    now = time.time()
+    found, missing, tokens = {}, [], {}
+    for pk, key in keys.items():
+        entry = entries.get(key, None)
+        if not isinstance(entry, CacheEntry):
+            missing.append(pk)
+            continue
+        if _should_refresh(entry, now):
+            # 只有过期的数据需要加锁，一般数量很少
+            token = random.getrandbits(62) + 1
+            if cache.add(f'{key}:lock', token, LOCK_SECONDS):
+                tokens[pk] = token
+                missing.append(pk)
+                continue
+        found[pk] = entry.value
+    if not missing:
+        return found
+    try:
+        timeout = caches['default'].default_timeout
+        t0 = time.perf_counter()
+        queried = query(missing)
+        delta = time.perf_counter() - t0
+        cache.set_many(dict(((keys[pk], CacheEntry(val, now + timeout, delta)) for pk, val in queried.items())),
+                       timeout + STALE_SECONDS)
+        log.info(f'<CacheManager> store {len(queried)} keys: {prefix}*')
+        found.update(queried)
+    finally:
+        for pk, token in tokens.items():
+            _release_lock(f'{keys[pk]}:lock', token)
+    return found
 
-def cacheable(cache_key: str | int = None):
+
+def cacheable(cache_key: str | int = None, namespace: str = None):
     """
     装饰器，用于缓存响应。
+
+    :param cache_key 作为缓存 key 的路径参数
+    :param namespace 数据所属的命名空间，版本号变化后缓存失效
     """
 
     def decorator(method):
         @wraps(method)
         def wrapper(self, *args, **kwargs):
             # 生成缓存键
-            key = "{}:{}".format(self.__class__.__name__, kwargs.get(str(cache_key), 'none'))
-
-            cached_response = cache.get(key)
-
-            if cached_response:
-                return Response(cached_response, status=200)
+            key = _response_key(self, kwargs, cache_key, namespace)
+            response: typing.Optional[Response] = None
 
-            # 调用实际的视图方法
-            response: Response = method(self, *args, **kwargs)
-
-            if response.status_code <= 299 and response.data:
-                log.info('<cache_response> store key: ' + key)
-                # 将响应内容存入缓存
-                cache.set(key, response.data)
+            def query():
+                nonlocal response
+                # 调用实际的视图方法
+                response = method(self, *args, **kwargs)
+                if response.status_code > 299:
+                    raise _UncachedResponse()
+                return response.data
 
-            return response
+            try:
+                data = get_or_query(key, query)
+            except _UncachedResponse:
+                return response
+            return response if response is not None else Response(data, status=200)
 
         return wrapper
 
     return decorator
 
 
-def cache_evict(cache_key: str | int = None):
+def cache_evict(cache_key: str | int = None, namespace: str = None):
     """
     装饰器，用于清理缓存的响应。
+
+    :param cache_key 作为缓存 key 的路径参数
+    :param namespace 与 cacheable 相同的命名空间
     """
 
     def decorator(method):
         @wraps(method)
         def wrapper(self, *args, **kwargs):
             # 生成缓存键
-            key = "{}:{}".format(self.__class__.__name__, kwargs.get(str(cache_key), 'none'))
-
-            cached_response = cache.get(key)
+            key = _response_key(self, kwargs, cache_key, namespace)
 
-            if cached_response:
-                log.info('<cache_response> delete key: ' + key)
-                cache.delete(key)
+            log.info('<cache_response> delete key: ' + key)
+            cache.delete(key)
 
             # 调用实际的视图方法
             return method(self, *args, **kwargs)
@@ -0,0 +1,57 @@
+"""按列存储的生成数据
+
+列名对应的位置在生成前确定，每列的数据存放在固定位置的数组中。
+计算列只按位置读取引用的列，不再为每一行复制所有列的值
+"""
+import collections.abc
+import typing
+
+
+class ColumnStore(collections.abc.MutableMapping):
+    """一块生成数据，可以像列名对应数据的字典一样读写"""
+    __slots__ = ('names', 'index', 'columns', 'length')
+
+    def __init__(self, names: typing.Sequence[str], length: int):
+        """
+        :param names 按填入顺序排列的列名
+        :param length 行数
+        """
+        self.names = tuple(names)
+        self.index = dict(((name, i) for i, name in enumerate(self.names)))
+        # 未生成的列为 None
+        self.columns: list = [None] * len(self.names)
+        self.length = length
+
+    def __getitem__(self, name):
+        values = self.columns[self.index[name]]
+        if values is None:
+            raise KeyError(name)
+        return values
+
+    def __setitem__(self, name, values):
+        i = self.index.get(name, None)
+        if i is None:
+            # 不在计划中的列追加到最后
+            i = len(self.names)
+            self.names += (name,)
+            self.index[name] = i
+            self.columns.append(None)
+        self.columns[i] = values
+
+    def __delitem__(self, name):
+        if self[name] is not None:
+            self.columns[self.index[name]] = None
+
+    def __iter__(self):
+        return (name for name, values in zip(self.names, self.columns) if values is not None)
+
+    def __len__(self):
+        return sum(1 for values in self.columns if values is not None)
+
+    def iter_rows(self, names: typing.Sequence[str]):
+        """只读取指定的列，逐行返回这些列的值组成的元组
+
+        :param names 读取的列名
+        :raise KeyError 列没有数据
+        """
+        return zip(*(self[name] for name in names))
@@ -0,0 +1,132 @@
+"""通过 Server-Sent Events 推送生成任务的进度
+
+Django 4.1 的 StreamingHttpResponse 不支持异步迭代，这里是直接挂在 ASGI 入口上的应用。
+订阅 Celery 进程更新状态时发布的消息，每次收到消息读取一次状态推送给浏览器，
+完成或失败后结束；浏览器的 EventSource 不能设置请求头，Token 通过 ?token= 传递
+"""
+import asyncio
+import json
+import logging
+import urllib.parse
+
+import redis.asyncio as aioredis
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from fillexcel.configurator import read_job_config
+from .jobs import DONE, FAILED, job_channel, job_key, parse_job
+
+log = logging.getLogger(__name__)
+
+# 没有消息时发送注释保持连接的间隔（秒）
+HEARTBEAT_INTERVAL = 15
+# 单个连接的最长时间（秒），超过后断开，EventSource 会自动重连
+MAX_DURATION = 600
+# EventSource 断开后重连的间隔（毫秒）
+RETRY_INTERVAL = 3000
+
+_client = None
+
+
+def _get_client() -> aioredis.Redis:
+    global _client
+    if _client is None:
+        _client = aioredis.Redis.from_url(read_job_config()['location'], decode_responses=True)
+    return _client
+
+
+def format_event(event, data):
+    """按 SSE 格式编码一条消息
+
+    :param event 事件名
+    :param data 事件数据，编码为 JSON
+    """
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'.encode('utf-8')
+
+
+def authenticate(query_string: bytes):
+    """校验查询参数中的 Token
+
+    :param query_string ASGI scope 中的查询字符串
+    :return 用户ID，Token 无效时返回 None
+    """
+    token = urllib.parse.parse_qs(query_string.decode('latin-1')).get('token', (None,))[0]
+    if not token:
+        return None
+    try:
+        return AccessToken(token).get('user_id', None)
+    except TokenError:
+        return None
+
+
+async def job_events(scope, receive, send, hash_id):
+    """推送单个生成任务的进度，事件为 queued、running、done 或 failed
+
+    :param scope ASGI scope
+    :param receive ASGI receive
+    :param send ASGI send
+    :param hash_id 生成的文件ID
+    """
+    if authenticate(scope.get('query_string', b'')) is None:
+        await _send_error(scope, send, 401, '身份认证信息未提供或已过期')
+        return
+    client = _get_client()
+    pubsub = client.pubsub()
+    # 先订阅再读取状态，不会错过两者之间的变化
+    await pubsub.subscribe(job_channel(hash_id))
+    try:
+        job = parse_job(hash_id, await client.hgetall(job_key(hash_id)))
+        if job is None:
+            await _send_error(scope, send, 404, '生成任务不存在或已过期')
+            return
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                                (b'cache-control', b'no-cache'),
+                                # 关闭 nginx 的缓冲，消息立即发送给浏览器
+                                (b'x-accel-buffering', b'no')]})
+        await send({'type': 'http.response.body', 'body': f'retry: {RETRY_INTERVAL}\n\n'.encode('utf-8'),
+                    'more_body': True})
+        streaming = asyncio.ensure_future(_stream(client, pubsub, send, hash_id, job))
+        disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+        try:
+            await asyncio.wait((streaming, disconnected), timeout=MAX_DURATION,
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (streaming, disconnected):
+                task.cancel()
+        if streaming.done() and not streaming.cancelled() and streaming.exception():
+            log.error(f'push job {hash_id} events failed: {streaming.exception()}')
+        if not disconnected.done():
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
+
+
+async def _stream(client: aioredis.Redis, pubsub, send, hash_id, job: dict):
+    """发送当前状态，之后每次状态变化时发送，完成或失败后结束"""
+    while True:
+        await send({'type': 'http.response.body', 'body': format_event(job['status'], job), 'more_body': True})
+        if job['status'] in (DONE, FAILED):
+            return
+        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=HEARTBEAT_INTERVAL)
+        while message is None:
+            await send({'type': 'http.response.body', 'body': b': keep-alive\n\n', 'more_body': True})
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=HEARTBEAT_INTERVAL)
+        job = parse_job(hash_id, await client.hgetall(job_key(hash_id)))
+        if job is None:
+            return
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _send_error(scope, send, status, message):
+    """与 ErrorHandlerMiddleware 相同结构的错误信息"""
+    body = json.dumps(dict(data=(), path=scope['path'], message=message), ensure_ascii=False).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode('latin-1'))]})
+    await send({'type': 'http.response.body', 'body': body})
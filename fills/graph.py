@@ -0,0 +1,80 @@
+"""列之间的依赖关系
+
+表达式计算引用的列、列值拼接的列都需要先生成；没有依赖关系的列分在同一层，可以同时生成
+"""
+import typing
+
+from .tools import expression_variables
+
+
+def parse_dependencies(function_name, params: dict):
+    """按生成函数和参数得到依赖的列
+
+    :param function_name 生成函数名
+    :param params 参数名对应的参数值
+    """
+    if function_name == 'calculate_expressions':
+        return expression_variables(params.get('expressions', None) or '')
+    if function_name == 'join_string':
+        return tuple(dict.fromkeys(c for c in (params.get('columns', None) or '').split(',') if c))
+    return ()
+
+
+def find_cycle(edges: typing.Mapping[str, typing.Iterable[str]]):
+    """查找依赖关系中的环
+
+    :param edges 列名对应依赖的列名
+    :return 组成环的列名，没有环时返回 None
+    """
+    visiting, visited = [], set()
+
+    def visit(name):
+        if name in visiting:
+            return visiting[visiting.index(name):] + [name]
+        if name in visited or name not in edges:
+            return None
+        visiting.append(name)
+        for dependency in edges[name]:
+            cycle = visit(dependency)
+            if cycle:
+                return cycle
+        visiting.pop()
+        visited.add(name)
+        return None
+
+    for key in edges:
+        found = visit(key)
+        if found:
+            return found
+    return None
+
+
+def sort_levels(nodes: typing.Sequence, outputs: typing.Callable, dependencies: typing.Callable):
+    """按依赖关系分层，每层只依赖之前的层
+
+    :param nodes 已按填入顺序排列的节点
+    :param outputs 节点写入的列名
+    :param dependencies 节点依赖的列名
+    :return 分层后的节点
+    :raise ValueError 依赖关系中有环
+    """
+    producers = {}
+    for node in nodes:
+        for name in outputs(node):
+            producers.setdefault(name, []).append(node)
+    # 节点依赖写入对应列的其它节点，未定义的列忽略
+    depends = dict(((id(node), set(id(producer) for name in dependencies(node)
+                                   for producer in producers.get(name, ()) if producer is not node))
+                    for node in nodes))
+    levels, done = [], set()
+    remaining = list(nodes)
+    while remaining:
+        level = [node for node in remaining if depends[id(node)] <= done]
+        if not level:
+            names = dict(((id(node), outputs(node)[0]) for node in nodes))
+            cycle = find_cycle(dict(((names[key], [names[v] for v in value]) for key, value in depends.items())))
+            raise ValueError(f'列之间的依赖关系有环: {" -> ".join(cycle or ())}')
+        levels.append(tuple(level))
+        done.update(id(node) for node in level)
+        remaining = [node for node in remaining if id(node) not in done]
+    return tuple(levels)
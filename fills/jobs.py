@@ -0,0 +1,174 @@
+"""生成任务的状态和进度
+
+每个生成任务在 Redis 中保存一个 hash（fills:job:{hashId}），提交时写入排队状态，
+Celery 进程开始生成、每写入一块数据和结束时更新，查询时只读取这一个 key
+"""
+import functools
+import logging
+import os
+import time
+
+import redis
+
+from fillexcel.configurator import read_job_config
+
+# Web 进程和 Celery 进程都会使用，日志的输出由各自的配置决定
+log = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# 按进程创建的客户端，fork 后的子进程重新创建
+_client = None
+_client_pid = None
+
+
+@functools.lru_cache(maxsize=None)
+def _get_config():
+    return read_job_config()
+
+
+def _get_client() -> redis.Redis:
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = redis.Redis.from_url(_get_config()['location'], decode_responses=True)
+        _client_pid = os.getpid()
+    return _client
+
+
+def job_key(hash_id):
+    return f'fills:job:{hash_id}'
+
+
+def job_channel(hash_id):
+    """状态变化时发布消息的频道，消息内容为当前状态"""
+    return f'fills:job:{hash_id}:events'
+
+
+def _update(hash_id, mapping: dict, increments: dict = None):
+    """在一次往返中更新状态、延长有效期并通知订阅者，状态只用于展示，更新失败不影响生成
+
+    :param hash_id 生成的文件ID
+    :param mapping 写入的字段
+    :param increments 累加的字段
+    """
+    key = job_key(hash_id)
+    try:
+        pipeline = _get_client().pipeline(transaction=False)
+        pipeline.hset(key, mapping=mapping)
+        for field, amount in (increments or {}).items():
+            pipeline.hincrby(key, field, amount)
+        pipeline.expire(key, _get_config()['ttl'])
+        # 只通知变化，订阅者重新读取状态
+        pipeline.publish(job_channel(hash_id), mapping.get('status', RUNNING))
+        pipeline.execute()
+    except redis.RedisError as e:
+        log.warning(f'update job {hash_id} failed: {e}')
+
+
+def create_jobs(jobs):
+    """提交任务时写入排队状态
+
+    :param jobs 生成的文件ID、填充要求ID和总行数
+    """
+    try:
+        pipeline = _get_client().pipeline(transaction=False)
+        now = time.time()
+        for hash_id, requirement_id, total in jobs:
+            key = job_key(hash_id)
+            pipeline.delete(key)
+            pipeline.hset(key, mapping=dict(status=QUEUED, requirementId=requirement_id, rows=0, total=total,
+                                            createdAt=now))
+            pipeline.expire(key, _get_config()['ttl'])
+        pipeline.execute()
+    except redis.RedisError as e:
+        log.warning(f'create jobs failed: {e}')
+
+
+def start_job(hash_id, total):
+    """开始生成
+
+    :param hash_id 生成的文件ID
+    :param total 需要写入的总行数
+    """
+    _update(hash_id, dict(status=RUNNING, rows=0, total=total, startedAt=time.time()))
+
+
+def add_rows(hash_id, rows):
+    """写入一块数据后累加已写入的行数
+
+    :param hash_id 生成的文件ID
+    :param rows 本块的行数
+    """
+    _update(hash_id, dict(updatedAt=time.time()), dict(rows=rows))
+
+
+def finish_job(hash_id, filenames):
+    """生成完成
+
+    :param hash_id 生成的文件ID
+    :param filenames 生成的文件名
+    """
+    _update(hash_id, dict(status=DONE, filenames=','.join(filenames), finishedAt=time.time()))
+
+
+def fail_job(hash_id, error):
+    """生成失败
+
+    :param hash_id 生成的文件ID
+    :param error 失败原因
+    """
+    _update(hash_id, dict(status=FAILED, error=str(error)[:500], finishedAt=time.time()))
+
+
+def read_job(hash_id):
+    """读取任务的状态和进度，不存在时返回 None
+
+    :param hash_id 生成的文件ID
+    """
+    try:
+        values = _get_client().hgetall(job_key(hash_id))
+    except redis.RedisError as e:
+        log.warning(f'read job {hash_id} failed: {e}')
+        return None
+    return parse_job(hash_id, values)
+
+
+def read_jobs(hash_ids):
+    """在一次往返中读取多个任务的状态和进度
+
+    :param hash_ids 生成的文件ID
+    :return 文件ID对应的状态，不存在的任务为 None；Redis 不可用时返回 None
+    """
+    try:
+        pipeline = _get_client().pipeline(transaction=False)
+        for hash_id in hash_ids:
+            pipeline.hgetall(job_key(hash_id))
+        values = pipeline.execute()
+    except redis.RedisError as e:
+        log.warning(f'read jobs failed: {e}')
+        return None
+    return dict(((hash_id, parse_job(hash_id, job)) for hash_id, job in zip(hash_ids, values)))
+
+
+def parse_job(hash_id, values: dict):
+    """转换 Redis 中保存的状态，不存在时返回 None
+
+    :param hash_id 生成的文件ID
+    :param values hash 中的字段
+    """
+    if not values:
+        return None
+    started_at = float(values['startedAt']) if 'startedAt' in values else None
+    finished_at = float(values['finishedAt']) if 'finishedAt' in values else None
+    if started_at is None:
+        elapsed = None
+    else:
+        elapsed = round((finished_at or time.time()) - started_at, 3)
+    return dict(fileId=hash_id, requirementId=int(values['requirementId']) if 'requirementId' in values else None,
+                status=values.get('status', QUEUED), rows=int(values.get('rows', 0)),
+                total=int(values.get('total', 0)), elapsed=elapsed,
+                filenames=values['filenames'].split(',') if values.get('filenames', None) else [],
+                error=values.get('error', None))
@@ -0,0 +1,144 @@
+"""进程内缓存，放在 Django 缓存之前
+
+生成规则这类几乎不变的数据在进程内保留一段时间，读取时不需要访问 Redis 和反序列化。
+每个命名空间在 Django 缓存中有一个版本号，数据变化时增加版本号；各进程每隔几秒比较一次版本号，
+版本号变化时清空本进程中该命名空间的数据，因此其他进程最多读到 LOCAL_CACHE_VERSION_CHECK_INTERVAL 秒的旧数据，
+用户经常修改的数据不应放入
+"""
+import collections
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .cache import bump_versions, get_or_query, get_versions
+
+log = logging.getLogger(__name__)
+
+# 缓存的数据可能为 None，用于区分未缓存
+_MISSING = object()
+
+
+class LocalCache:
+    __slots__ = ('namespace', 'max_entries', 'ttl', 'check_interval', 'hits', 'misses',
+                 '_entries', '_lock', '_version', '_checked_at', '_generation')
+
+    def __init__(self, namespace, max_entries, ttl, check_interval):
+        """数量和时间受限的进程内缓存，超出数量时淘汰最久未使用的数据
+
+        :param namespace 命名空间，对应一个版本号
+        :param max_entries 缓存的最大数量
+        :param ttl 缓存的秒数
+        :param check_interval 比较版本号的间隔秒数
+        """
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+        # 每次清空时递增，读取期间被清空时不放入读取到的旧数据
+        self._generation = 0
+
+    @property
+    def version_namespace(self):
+        return f'LocalCache:{self.namespace}'
+
+    def get(self, key, loader):
+        """读取进程内的数据，没有或过期时通过 loader 读取后放入
+
+        :param key 缓存的键
+        :param loader 读取数据的无参数函数
+        """
+        now = time.monotonic()
+        self._sync_version(now)
+        with self._lock:
+            val, expires_at = self._entries.get(key, (_MISSING, 0))
+            if val is not _MISSING and expires_at > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return val
+            self.misses += 1
+            generation = self._generation
+        val = loader()
+        with self._lock:
+            if generation != self._generation:
+                return val
+            self._entries[key] = (val, now + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return val
+
+    def _sync_version(self, now):
+        """每隔一段时间比较一次版本号，其他进程修改过数据时清空"""
+        if now - self._checked_at < self.check_interval:
+            return
+        version = get_versions(self.version_namespace)
+        with self._lock:
+            if version != self._version:
+                if self._version is not None:
+                    log.info(f'<LocalCache> {self.namespace} changed to version {version}')
+                self._entries.clear()
+                self._generation += 1
+                self._version = version
+            self._checked_at = now
+
+    def invalidate(self):
+        """增加版本号，所有进程中该命名空间的数据失效"""
+        bump_versions(self.version_namespace)
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            # 下次读取时重新比较版本号
+            self._checked_at = 0.0
+
+    def stats(self):
+        """命中和未命中的次数"""
+        return dict(hits=self.hits, misses=self.misses, size=len(self._entries))
+
+
+_caches: dict[str, LocalCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_local_cache(namespace) -> LocalCache:
+    """获得当前进程中命名空间对应的缓存
+
+    :param namespace 命名空间
+    """
+    local_cache = _caches.get(namespace, None)
+    if local_cache is None:
+        with _caches_lock:
+            local_cache = _caches.setdefault(namespace, LocalCache(
+                namespace, settings.LOCAL_CACHE_MAX_ENTRIES, settings.LOCAL_CACHE_TIMEOUT,
+                settings.LOCAL_CACHE_VERSION_CHECK_INTERVAL))
+    return local_cache
+
+
+def get_model_with_cache(model, pk, timeout):
+    """依次读取进程内缓存、Django 缓存和数据库
+
+    :param model 模型类
+    :param pk 主键
+    :param timeout Django 缓存的秒数
+    """
+    cache_key = f'{model.__name__}:{pk}'
+    return get_local_cache(model.__name__).get(
+        cache_key, lambda: get_or_query(cache_key, lambda: model.objects.get(pk=pk), timeout))
+
+
+def remove_model_cache(model, pk):
+    """数据变化时删除 Django 缓存，并使所有进程的进程内缓存失效
+
+    :param model 模型类
+    :param pk 主键
+    """
+    cache.delete(f'{model.__name__}:{pk}')
+    get_local_cache(model.__name__).invalidate()
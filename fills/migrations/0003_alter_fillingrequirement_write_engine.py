@@ -0,0 +1,18 @@
+# Generated by Django 4.1 on 2026-10-19 00:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fills', '0002_fillingrequirement_write_engine'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='fillingrequirement',
+            name='write_engine',
+            field=models.CharField(choices=[('openpyxl', '读取整个模板写入'), ('stream', '只写模式流式写入'), ('xml', '直接修改工作表XML')], default='openpyxl', max_length=64, verbose_name='写入方式'),
+        ),
+    ]
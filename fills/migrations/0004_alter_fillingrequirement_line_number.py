@@ -0,0 +1,19 @@
+# Generated by Django 4.1 on 2026-10-19 00:41
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fills', '0003_alter_fillingrequirement_write_engine'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='fillingrequirement',
+            name='line_number',
+            field=models.PositiveIntegerField(validators=[django.core.validators.MinValueValidator(1, message='填充行数至少为1')], verbose_name='结束行'),
+        ),
+    ]
@@ -1,10 +1,13 @@
 import reprlib
 
+from django.conf import settings
 from django.core.cache import cache
 from django.core.validators import MinValueValidator, MaxValueValidator, RegexValidator
 from django.db import models
 from django.db.models import UniqueConstraint
 
+from .cache import get_or_query
+from .localcache import get_model_with_cache, remove_model_cache
 from .timeunit import dc
 from .utils import SnowFlake
 
@@ -19,6 +22,22 @@ DEFINE_DATA_TYPE = (
     ('dict', '字典')
 )
 
+WRITE_ENGINE = (
+    ('openpyxl', '读取整个模板写入'),
+    ('stream', '只写模式流式写入'),
+    ('xml', '直接修改工作表XML')
+)
+
+
+def max_line_number(write_engine):
+    """写入方式支持的最大填充行数，在请求中生成数据时上限更小
+
+    :param write_engine 写入方式
+    """
+    if not settings.GENERATE_IN_WORKER:
+        return settings.FILL_MAX_LINE_NUMBER_IN_REQUEST
+    return settings.FILL_MAX_LINE_NUMBER_BY_ENGINE.get(write_engine, settings.FILL_MAX_LINE_NUMBER)
+
 
 def gen_id():
     return SnowFlake(0, 0).next_id()
@@ -47,9 +66,10 @@ class FillingRequirement(IdDateTimeBase):
     start_line = models.PositiveIntegerField('起始行', validators=(
         MinValueValidator(1, message='起始行在1到42之间'),
         MaxValueValidator(42, message='起始行在1到42之间')))
+    # 行数上限按写入方式由 max_line_number 得到，在序列化时校验
     line_number = models.PositiveIntegerField('结束行', validators=(
-        MinValueValidator(1, message='支持填充行数在1到200之间'),
-        MaxValueValidator(200, message='支持填充行数在1到200之间')))
+        MinValueValidator(1, message='填充行数至少为1'),))
+    write_engine = models.CharField('写入方式', choices=WRITE_ENGINE, default='openpyxl', max_length=64)
 
     class Meta:
         db_table = 'filling_requirement'
@@ -68,13 +88,12 @@ class GenerateRule(IdDateTimeBase):
 
     @classmethod
     def get_with_cache(cls, pk):
-        cache_key = f'GenerateRule:{pk}'
-        obj = cache.get(cache_key)
-        if not obj:
-            obj = cls.objects.get(pk=pk)
-            # 4 小时缓存数
-            cache.set(cache_key, obj, dc.hours.to_seconds(4))
-        return obj
+        # 进程内缓存之后是 4 小时的 Django 缓存
+        return get_model_with_cache(cls, pk, dc.hours.to_seconds(4))
+
+    @classmethod
+    def remove_cache(cls, pk):
+        remove_model_cache(cls, pk)
 
     class Meta:
         db_table = 'generate_rule'
@@ -98,13 +117,12 @@ class GenerateRuleParameter(IdDateTimeBase):
 
     @classmethod
     def get_with_cache(cls, pk):
-        cache_key = f'GenerateRuleParameter:{pk}'
-        obj = cache.get(cache_key)
-        if not obj:
-            obj = cls.objects.get(pk=pk)
-            # 4 小时缓存数
-            cache.set(cache_key, obj, dc.hours.to_seconds(4))
-        return obj
+        # 进程内缓存之后是 4 小时的 Django 缓存
+        return get_model_with_cache(cls, pk, dc.hours.to_seconds(4))
+
+    @classmethod
+    def remove_cache(cls, pk):
+        remove_model_cache(cls, pk)
 
     class Meta:
         db_table = 'generate_rule_parameter'
@@ -173,20 +191,12 @@ class ColumnRule(IdDateTimeBase):
 
     @classmethod
     def get_with_cache(cls, pk):
-        cache_key = f'ColumnRule:{pk}'
-        obj = cache.get(cache_key)
-        if not obj:
-            obj = cls.objects.get(pk=pk)
-            # 4 小时缓存数
-            cache.set(cache_key, obj, dc.hours.to_seconds(4))
-        return obj
+        # 用户经常修改，不放入进程内缓存，只使用 4 小时的 Django 缓存
+        return get_or_query(f'ColumnRule:{pk}', lambda: cls.objects.get(pk=pk), dc.hours.to_seconds(4))
 
     @classmethod
     def remove_cache(cls, pk):
-        cache_key = f'ColumnRule:{pk}'
-        val = cache.get(cache_key, None)
-        if val:
-            cache.delete(cache_key)
+        cache.delete(f'ColumnRule:{pk}')
 
     class Meta:
         db_table = 'column_rule'
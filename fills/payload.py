@@ -0,0 +1,66 @@
+import functools
+import os
+import uuid
+import zlib
+
+import msgpack
+import redis
+
+from fillexcel.configurator import read_payload_config
+from .logger import init_logger
+
+log = init_logger(__name__, 'payload.log')
+
+# 按进程创建的客户端，fork 后的子进程重新创建
+_client = None
+_client_pid = None
+
+
+@functools.lru_cache(maxsize=None)
+def _get_config():
+    return read_payload_config()
+
+
+def _get_client() -> redis.Redis:
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = redis.Redis.from_url(_get_config()['location'])
+        _client_pid = os.getpid()
+    return _client
+
+
+def is_by_reference():
+    """生成的数据是否以引用的方式传给任务"""
+    return _get_config()['mode'] == 'reference'
+
+
+def store_payload(excel_data: dict):
+    """压缩后存储生成的数据
+
+    :param excel_data 列名对应的数据
+    :return 存储的 key
+    """
+    key = f'fills:payload:{uuid.uuid1().hex}'
+    blob = zlib.compress(msgpack.packb(excel_data), 1)
+    _get_client().set(key, blob, ex=int(_get_config()['ttl']))
+    log.info(f'store payload {key}, {len(blob)} bytes')
+    return key
+
+
+def load_payload(key) -> dict:
+    """读取生成的数据
+
+    :param key 存储的 key
+    """
+    blob = _get_client().get(key)
+    if blob is None:
+        raise ValueError(f'生成的数据不存在或已过期: {key}')
+    return msgpack.unpackb(zlib.decompress(blob))
+
+
+def remove_payload(key):
+    """删除生成的数据
+
+    :param key 存储的 key
+    """
+    _get_client().delete(key)
@@ -0,0 +1,118 @@
+import logging
+import typing
+
+from django.core.cache import cache
+
+from .cache import bump_versions, cache_namespace, get_version_map, get_versions
+from .timeunit import dc
+
+log = logging.getLogger(__name__)
+
+# 计划结构变化时递增，避免读到旧结构的缓存
+PLAN_FORMAT = 4
+
+
+class ColumnPlan(typing.NamedTuple):
+    """单元格列的生成计划"""
+    column_name: str
+    function_name: str
+    associated_of: bool
+    fill_order: int
+    # 生成函数，未匹配到时为 None
+    function: typing.Optional[typing.Callable]
+    # 冻结的参数名和参数值
+    params: dict
+    # 预先读取的数据集数据
+    values: tuple = ()
+    # 数据集绑定的列名和属性名
+    binds: tuple = ()
+    # 依赖的列名
+    dependencies: tuple = ()
+
+    @property
+    def outputs(self):
+        """写入的列名，关联填入时包括绑定的列"""
+        return (self.column_name,) + tuple(col for col, _ in self.binds if col != self.column_name)
+
+
+class GenerationPlan(typing.NamedTuple):
+    """填充要求的生成计划，可被序列化后缓存"""
+    requirement_id: int
+    file_id: str
+    username: str
+    filename: str
+    start_line: int
+    line_number: int
+    # 写入 Excel 的方式
+    write_engine: str
+    # 已按填入顺序排好的列
+    columns: tuple[ColumnPlan, ...]
+    # 按依赖关系分层的列，同一层的列互不依赖
+    levels: tuple[tuple[ColumnPlan, ...], ...] = ()
+
+
+def _plan_namespace(requirement_id):
+    return cache_namespace('GenerationPlan', requirement_id)
+
+
+def _plan_key(requirement_id, version):
+    return f'GenerationPlan:{requirement_id}:{PLAN_FORMAT}:{version}'
+
+
+def get_cached_plan(requirement_id):
+    """读取缓存的生成计划
+
+    :param requirement_id 填充要求ID
+    :return 当前的版本号和缓存的生成计划，未缓存时生成计划为 None
+    """
+    version = get_versions(_plan_namespace(requirement_id))
+    return version, cache.get(_plan_key(requirement_id, version), None)
+
+
+def store_plan(plan: GenerationPlan, version):
+    """缓存生成计划
+
+    版本号在编译前读取，编译期间数据发生变化时计划缓存在旧版本下，不会被读取到
+
+    :param plan 生成计划
+    :param version 编译前读取的版本号
+    """
+    # 4 小时缓存数
+    cache.set(_plan_key(plan.requirement_id, version), plan, dc.hours.to_seconds(4))
+    log.info(f'<GenerationPlan> store plan: {plan.requirement_id} of version {version}')
+
+
+def get_cached_plans(requirement_ids):
+    """批量读取缓存的生成计划
+
+    :param requirement_ids 填充要求ID
+    :return 填充要求ID对应的版本号，以及只包含已缓存的生成计划
+    """
+    namespaces = dict(((requirement_id, _plan_namespace(requirement_id)) for requirement_id in requirement_ids))
+    values = get_version_map(namespaces.values())
+    versions = dict(((requirement_id, values[namespace]) for requirement_id, namespace in namespaces.items()))
+    plan_keys = dict(((_plan_key(requirement_id, version), requirement_id)
+                      for requirement_id, version in versions.items()))
+    return versions, dict(((plan_keys[key], plan) for key, plan in cache.get_many(list(plan_keys)).items()))
+
+
+def store_plans(plans, versions: dict):
+    """批量缓存生成计划
+
+    :param plans 生成计划
+    :param versions 编译前读取的填充要求ID对应的版本号
+    """
+    if not plans:
+        return
+    # 4 小时缓存数
+    cache.set_many(dict(((_plan_key(plan.requirement_id, versions[plan.requirement_id]), plan) for plan in plans)),
+                   dc.hours.to_seconds(4))
+    log.info(f'<GenerationPlan> store plans: {[plan.requirement_id for plan in plans]}')
+
+
+def invalidate_plan(*requirement_ids):
+    """增加版本号使旧的生成计划失效
+
+    :param requirement_ids 填充要求ID
+    """
+    bump_versions(*(_plan_namespace(requirement_id) for requirement_id in requirement_ids))
@@ -0,0 +1,141 @@
+"""按用户和接口限制操作频率
+
+使用滑动窗口计数：Redis 中每个用户每个接口一个有序集合，成员为每次操作的时间，
+检查、淘汰过期记录和写入在一个 Lua 脚本中完成，只需要一次往返且并发时计数准确。
+缓存不是 Redis 时（如测试环境）退化为按前后两个固定窗口加权估算的计数
+"""
+import logging
+import time
+import uuid
+from functools import wraps
+
+import redis
+from django.core.cache import cache, caches
+from django.core.cache.backends.redis import RedisCache
+from redis.commands.core import Script
+
+log = logging.getLogger(__name__)
+
+# 返回 {是否允许, 需要等待的毫秒数}，时间使用 Redis 服务器的时间，不受各进程时钟影响
+_SLIDING_WINDOW_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local window = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+if redis.call('ZCARD', KEYS[1]) >= limit then
+    local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    return {0, tonumber(oldest[2]) + window - now}
+end
+redis.call('ZADD', KEYS[1], now, ARGV[3])
+redis.call('PEXPIRE', KEYS[1], window)
+return {1, 0}
+"""
+
+_script = None
+
+
+def _get_script(client) -> Script:
+    global _script
+    if _script is None:
+        _script = client.register_script(_SLIDING_WINDOW_SCRIPT)
+    return _script
+
+
+class RateLimit:
+    __slots__ = ('name', 'limit', 'period')
+
+    def __init__(self, name, limit, period):
+        """时间窗口内允许的操作次数
+
+        :param name 接口名称，作为缓存 key 的一部分
+        :param limit 时间窗口内最多的操作次数
+        :param period 时间窗口（秒）
+        """
+        self.name = name
+        self.limit = limit
+        self.period = period
+
+    def key(self, identity):
+        return f'RateLimit:{self.name}:{identity}'
+
+    def hit(self, identity):
+        """记录一次操作
+
+        :param identity 用户标识
+        :return 是否允许，不允许时还需要等待的秒数
+        """
+        key = self.key(identity)
+        backend = caches['default']
+        try:
+            if isinstance(backend, RedisCache):
+                return self._hit_redis(backend, key)
+            return self._hit_counter(key)
+        except redis.RedisError as e:
+            # 限流不可用时不影响正常操作
+            log.warning(f'<RateLimit> check {key} failed: {e}')
+            return True, 0
+
+    def _hit_redis(self, backend: RedisCache, key):
+        key = backend.make_and_validate_key(key)
+        client = backend._cache.get_client(key, write=True)
+        allowed, wait = _get_script(client)(keys=(key,), args=(int(self.period * 1000), self.limit, uuid.uuid4().hex),
+                                            client=client)
+        return bool(allowed), wait / 1000
+
+    def _hit_counter(self, key):
+        now = time.time()
+        window = int(now // self.period)
+        current_key, previous_key = f'{key}:{window}', f'{key}:{window - 1}'
+        counts = cache.get_many((current_key, previous_key))
+        # 上一个窗口中仍在滑动窗口内的部分按比例计入
+        weight = 1 - (now % self.period) / self.period
+        if counts.get(previous_key, 0) * weight + counts.get(current_key, 0) >= self.limit:
+            return False, self.period - now % self.period
+        cache.add(current_key, 0, self.period * 2)
+        try:
+            cache.incr(current_key)
+        except ValueError:
+            # 刚好过期
+            cache.set(current_key, 1, self.period * 2)
+        return True, 0
+
+    def check(self, request):
+        """记录当前用户的一次操作，超过限制时报错
+
+        :param request 当前请求
+        """
+        identity = request_identity(request)
+        allowed, wait = self.hit(identity)
+        if not allowed:
+            log.info(f'<RateLimit> reject {self.name} of {identity}, retry after {wait:.1f}s')
+            raise ValueError('您的操作频率太快，请稍后再试！')
+
+
+def request_identity(request):
+    """已登录时按用户区分，未登录时按客户端地址区分（nginx 通过 uwsgi_params 传入 REMOTE_ADDR）"""
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    return f'ip:{request.META.get("REMOTE_ADDR", "")}'
+
+
+def rate_limit(name, limit, period):
+    """
+    装饰器，限制视图方法每个用户在时间窗口内的操作次数
+
+    :param name 接口名称，同名的方法共用一个计数
+    :param limit 时间窗口内最多的操作次数
+    :param period 时间窗口（秒）
+    """
+    limiter = RateLimit(name, limit, period)
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            limiter.check(request)
+            return method(self, request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -3,7 +3,8 @@ from rest_framework import serializers
 
 from .models import DataSet, DataSetDefine, DataSetValue, DataSetBind
 from .models import FillingRequirement, ColumnRule, DataParameter, FileRecord
-from .models import GenerateRule, GenerateRuleParameter
+from .models import GenerateRule, GenerateRuleParameter, max_line_number
+from .upload import is_presigned_upload, is_upload_validated
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -16,7 +17,23 @@ class FillingRequirementSerializer(serializers.ModelSerializer):
     class Meta:
         model = FillingRequirement
         fields = ('id', 'username', 'remark', 'file_id', 'original_filename', 'start_line', 'line_number',
-                  'created_at', 'updated_at')
+                  'write_engine', 'created_at', 'updated_at')
+
+    def validate(self, attrs):
+        """填充行数不能超过写入方式支持的上限，只修改其中一项时与已保存的另一项一起校验"""
+        line_number = attrs.get('line_number', getattr(self.instance, 'line_number', None))
+        write_engine = attrs.get('write_engine', getattr(self.instance, 'write_engine', None)) \
+            or FillingRequirement._meta.get_field('write_engine').default
+        limit = max_line_number(write_engine)
+        if line_number is not None and line_number > limit:
+            raise serializers.ValidationError(dict(line_number=f'{write_engine} 写入方式支持填充行数在1到{limit}之间'))
+        return attrs
+
+    def validate_file_id(self, value):
+        """直接上传的文件需要完成校验后才能使用"""
+        if is_presigned_upload(value) and not is_upload_validated(value):
+            raise serializers.ValidationError('文件尚未完成上传校验')
+        return value
 
 
 class FillingRequirementRelatedField(serializers.RelatedField):
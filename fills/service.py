@@ -1,122 +1,119 @@
+import datetime
 import json
 import logging
 import operator
+import os
 import sys
 import time
+import typing
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-from .models import DataSetBind, DataSetValue
-from .models import FillingRequirement, ColumnRule, DataParameter
-from .models import GenerateRule
-from .tasks import write_to_excel
-from .tools import fixed_value_iter, random_number_iter, time_serial_iter
-from .tools import none_iter
-from .tools import value_list_iter, associated_fill, calculate_expressions, join_string
+from celery import group, states
+from celery.result import AsyncResult
+from django.conf import settings
+from django.core.cache import cache
 
+from .models import DataSetValue
+from .models import FillingRequirement, ColumnRule, max_line_number
+from .columnstore import ColumnStore
+from .graph import find_cycle, parse_dependencies, sort_levels
+from .jobs import create_jobs, read_job, read_jobs
+from .plan import ColumnPlan, GenerationPlan
+from .payload import is_by_reference, store_payload
+from .plan import get_cached_plan, get_cached_plans, store_plan, store_plans
+from .tasks import generate_excel, write_to_excel
+from .timeunit import dc
+from .tools import FixedValueGenerator, RandomNumberGenerator, TimeSerialGenerator, ValueListGenerator
+from .tools import associated_fill, compile_expressions
+
+# 批量生成器，通过 generate(n) 一次生成整列的数据
 __NORMAL_FUNCTIONS__ = {
-    'fixed_value_iter': fixed_value_iter,
-    'random_number_iter': random_number_iter,
-    'time_serial_iter': time_serial_iter
+    'fixed_value_iter': FixedValueGenerator,
+    'random_number_iter': RandomNumberGenerator,
+    'time_serial_iter': TimeSerialGenerator
 }
 
 log = logging.getLogger(__name__)
 
+# 在 Celery 进程中生成数据时每块的行数
+FILL_CHUNK_SIZE = 5000
+_fill_executor = None
+
+
+def get_fill_executor() -> typing.Optional[ThreadPoolExecutor]:
+    """获得当前进程生成列数据的线程池，首次使用时创建；未配置多个线程时返回 None"""
+    global _fill_executor
+    if _fill_executor is None and settings.FILL_COLUMN_WORKERS > 1:
+        _fill_executor = ThreadPoolExecutor(max_workers=settings.FILL_COLUMN_WORKERS, thread_name_prefix='fill-column')
+    return _fill_executor
+
+
+def _reset_fill_executor():
+    """fork 后的子进程不能使用父进程的线程"""
+    global _fill_executor
+    _fill_executor = None
+
+
+os.register_at_fork(after_in_child=_reset_fill_executor)
+
 
-def write_value_list(column_rule: ColumnRule, rule: GenerateRule,
-                     start_line: int, end_line: int, column_data: dict):
+def write_value_list(column: ColumnPlan, offset: int, length: int, column_data: ColumnStore):
     """写入字符串数组"""
-    param = DataParameter.objects.get(column_rule_id__exact=column_rule.id)
-    data_value_list = DataSetValue.objects.filter(data_set__exact=param.data_set_id)
-    if not len(data_value_list):
-        log.warning(f'{rule.function_name} -> {column_rule.column_name}: 关联填充数据为空')
+    if not len(column.values):
+        log.warning(f'{column.function_name} -> {column.column_name}: 关联填充数据为空')
         return
-    values = tuple(d.item for d in data_value_list)
-    log.info('column: ' + column_rule.column_name)
-    log.info('function: ' + rule.function_name)
-    log.info('values: ' + str(values))
-    column_range = range(start_line, end_line)
-    column_data[column_rule.column_name] = tuple(val for _, val in zip(column_range, value_list_iter(values)))
+    # 按行的位置接着上一块循环取值
+    column_data[column.column_name] = ValueListGenerator(column.values, offset).generate(length)
 
 
-def write_associated_list(column_rule: ColumnRule, rule: GenerateRule,
-                          start_line: int, end_line: int, column_data: dict):
+def write_associated_list(column: ColumnPlan, offset: int, length: int, column_data: ColumnStore):
     """写入关联填入的对象数组"""
-    t0 = time.perf_counter()
-    param = DataParameter.objects.get(column_rule_id__exact=column_rule.id)
-    data_bind = DataSetBind.objects.filter(data_set__exact=param.data_set_id, column_rule_id__exact=column_rule.id)
-    data_value = DataSetValue.objects.filter(data_set__exact=param.data_set_id)
-    if not len(data_bind) or not len(data_value):
-        log.warning(f'{rule.function_name} -> {column_rule.column_name}: 关联填充数据为空')
+    if not len(column.binds) or not len(column.values):
+        log.warning(f'{column.function_name} -> {column.column_name}: 关联填充数据为空')
         return
-    log.info('function: ' + rule.function_name)
     # 数据集
-    value_iter = value_list_iter((json.loads(v.item) for v in data_value))
+    values = ValueListGenerator(column.values, offset).generate(length)
     # 数据绑定
-    bind_list = tuple((v.column_name, v.data_name) for v in data_bind)
+    bind_list = column.binds
     # 初始化列的数组
     for col, _ in bind_list:
         column_data[col] = []
     # 逐行执行
-    for _ in range(start_line, end_line):
+    for value in values:
         # 每行的所有关联数据
-        for col, val in associated_fill(bind_list, next(value_iter)):
+        for col, val in associated_fill(bind_list, value):
             column_data[col].append(val)
-    log.info(f'associated fill {time.perf_counter() - t0}')
 
 
-def write_calculate_expressions(column_rule: ColumnRule, rule: GenerateRule,
-                                start_line: int, end_line: int, column_data: dict):
+def write_calculate_expressions(column: ColumnPlan, offset: int, length: int, column_data: ColumnStore):
     """计算给定的表达式"""
-    t0 = time.perf_counter()
-    param = DataParameter.objects.get(column_rule_id__exact=column_rule.id)
-    expressions = param.value
-    log.info('function: ' + rule.function_name)
-    log.info('expressions: ' + expressions)
-    count = 0
-    data_list = []
-    # 逐行执行
-    for _ in range(start_line, end_line):
-        try:
-            # 取出当前行的列值
-            value_dict = dict(((key, values[count]) for key, values in column_data.items()))
-            # 添加计算值到数据列表
-            data_list.append(calculate_expressions(expressions, value_dict))
-        except Exception as e:
-            log.error(e, exc_info=sys.exc_info())
-            return
-        count += 1
+    expressions = column.params['expressions']
+    try:
+        # 表达式只编译一次，按引用的列整列计算
+        data_list = compile_expressions(expressions).evaluate_columns(column_data, length)
+    except Exception as e:
+        log.error(e, exc_info=sys.exc_info())
+        return
     # 填入数据
-    column_data[column_rule.column_name] = data_list
-    log.info(f'calculate expressions {time.perf_counter() - t0}')
+    column_data[column.column_name] = data_list
 
 
-def write_join_string(column_rule: ColumnRule, rule: GenerateRule,
-                      start_line: int, end_line: int, column_data: dict):
+def write_join_string(column: ColumnPlan, offset: int, length: int, column_data: ColumnStore):
     """特定字符拼接其它单元格的值"""
-    t0 = time.perf_counter()
-    param_list = DataParameter.objects.filter(column_rule_id__exact=column_rule.id)
-    # 转换参数为字典
-    param_dict = dict(((p.name, p.value) for p in param_list))
-    delimiter = param_dict['delimiter']
-    columns = param_dict['columns'].split(',')
+    delimiter = column.params['delimiter'] or str()
+    columns = column.params['columns'].split(',')
     if not len(columns):
-        log.warning(f'{rule.function_name} -> {column_rule.column_name}: 关联填充数据为空')
+        log.warning(f'{column.function_name} -> {column.column_name}: 关联填充数据为空')
+        return
+    try:
+        # 只读取需要拼接的列，逐行拼接
+        data_list = [delimiter.join(values) for values in column_data.iter_rows(columns)]
+    except Exception as e:
+        log.error(e, exc_info=sys.exc_info())
         return
-    log.info('function: ' + rule.function_name)
-    log.info('delimiter: ' + delimiter)
-    log.info('columns: ' + str(columns))
-    count = 0
-    data_list = []
-    # 逐行执行
-    for _ in range(start_line, end_line):
-        # 取出当前行的所需列值
-        value_dict = dict(((key, values[count]) for key, values in column_data.items()))
-        # 添加连接值到数据列表
-        s = join_string(columns, value_dict, delimiter)
-        data_list.append(s)
-        count += 1
     # 填入数据
-    column_data[column_rule.column_name] = data_list
-    log.info(f'joining string {time.perf_counter() - t0}')
+    column_data[column.column_name] = data_list
 
 
 __ASSOCIATED_FUNCTION__ = {
@@ -127,66 +124,424 @@ __ASSOCIATED_FUNCTION__ = {
 }
 
 
-def exec_associated_of_iter(column_rule: ColumnRule, rule: GenerateRule,
-                            start_line: int, end_line: int, column_data: dict):
+def exec_associated_of_iter(column: ColumnPlan, offset: int, length: int, column_data: ColumnStore):
     """执行关联数据的填入
 
-    :param column_rule 列规则
-    :param rule 生成规则
-    :param start_line 起始行
-    :param end_line 填入行数
-    :param column_data 写入 Excel 的数据
-    """
-    # 传入的参数和值
-    args = dict(**locals())
-    a_f = __ASSOCIATED_FUNCTION__.get(rule.function_name, None)
-    if a_f:
-        return a_f(**args)
+    :param column 列的生成计划
+    :param offset 当前块第一行相对于起始行的位置
+    :param length 当前块的行数
+    :param column_data 当前块写入 Excel 的数据
+    """
+    if column.function:
+        column.function(column, offset, length, column_data)
+
+
+def match_normal_generator(column: ColumnPlan):
+    """指定一般数据的批量生成器"""
+    log.info('column: ' + column.column_name)
+    log.info('function: ' + column.function_name)
+    log.info('value: ' + str(column.params))
+    if column.function:
+        # 将参数传给生成器的命名关键字参数
+        return column.function(**column.params)
+    return None
+
+
+def load_requirement_graph(fr: FillingRequirement):
+    """一次性读取填充要求关联的所有生成数据
+
+    查询次数固定，与列的数量无关
+
+    :param fr 填充规则
+    :return 列规则列表（已附带生成规则、参数和数据集绑定）和数据集ID对应的数据
+    """
+    column_rules, data_set_values = load_requirement_graphs((fr.id,))
+    return column_rules[fr.id], data_set_values
+
+
+def load_requirement_graphs(requirement_ids):
+    """一次性读取多个填充要求关联的所有生成数据
+
+    查询次数固定，与填充要求和列的数量无关
+
+    :param requirement_ids 填充要求ID
+    :return 填充要求ID对应的列规则列表和数据集ID对应的数据
+    """
+    column_rules = dict(((requirement_id, []) for requirement_id in requirement_ids))
+    for c in (ColumnRule.objects.filter(requirement_id__in=column_rules)
+              .select_related('rule')
+              .prefetch_related('dataparameter_set', 'datasetbind_set')):
+        column_rules[c.requirement_id].append(c)
+    data_set_ids = set(p.data_set_id for rules in column_rules.values() for c in rules
+                       for p in c.dataparameter_set.all() if p.data_set_id)
+    data_set_values = dict(((data_set_id, []) for data_set_id in data_set_ids))
+    if data_set_ids:
+        for v in DataSetValue.objects.filter(data_set_id__in=data_set_ids).order_by('id'):
+            data_set_values[v.data_set_id].append(v.item)
+    return column_rules, data_set_values
+
+
+def compile_column_plan(column_rule: ColumnRule, data_set_values: dict) -> ColumnPlan:
+    """编译单个列的生成计划
+
+    :param column_rule 列规则，需预先读取关联的参数和数据集绑定
+    :param data_set_values 数据集ID对应的数据
+    """
+    rule = column_rule.rule
+    param_list = column_rule.dataparameter_set.all()
+    # 将参数转为字典
+    params = dict(((p.name, p.value) for p in param_list))
+    values, binds = (), ()
+    if column_rule.associated_of:
+        function = __ASSOCIATED_FUNCTION__.get(rule.function_name, None)
+        data_set_id = next((p.data_set_id for p in param_list if p.data_set_id), None)
+        items = data_set_values.get(data_set_id, ())
+        if rule.function_name == 'value_list_iter':
+            values = tuple(items)
+        elif rule.function_name == 'associated_fill':
+            values = tuple(json.loads(item) for item in items)
+            binds = tuple((b.column_name, b.data_name) for b in column_rule.datasetbind_set.all()
+                          if b.data_set_id == data_set_id)
     else:
-        return none_iter()
+        function = __NORMAL_FUNCTIONS__.get(rule.function_name, None)
+    return ColumnPlan(column_rule.column_name, rule.function_name, column_rule.associated_of, rule.fill_order,
+                      function, params, values, binds, parse_dependencies(rule.function_name, params))
+
 
+def compile_plan(fr: FillingRequirement) -> GenerationPlan:
+    """编译填充要求的生成计划
 
-def match_normal_iter(column_rule: ColumnRule, rule: GenerateRule):
-    """指定一般数据的填入"""
-    param_list = DataParameter.objects.filter(column_rule_id__exact=column_rule.id)
-    # 将参数转为字典，传给调用方法的命名关键字参数
-    param_dict = dict(((p.name, p.value) for p in param_list))
-    log.info('column: ' + column_rule.column_name)
-    log.info('function: ' + rule.function_name)
-    log.info('value: ' + str(param_dict))
-    n_f = __NORMAL_FUNCTIONS__.get(rule.function_name, None)
-    if n_f:
-        return n_f(**param_dict)
-    return none_iter()
+    :param fr 填充规则
+    """
+    column_rule_list, data_set_values = load_requirement_graph(fr)
+    return build_plan(fr, column_rule_list, data_set_values)
 
 
-def fill_excel(fr: FillingRequirement, hash_id):
-    """填入数据到 Excel
+def build_plan(fr: FillingRequirement, column_rule_list, data_set_values: dict) -> GenerationPlan:
+    """由已读取的列规则和数据集数据生成计划
 
     :param fr 填充规则
-    :param hash_id 生成的文件ID
+    :param column_rule_list 列规则列表，需预先读取关联的参数和数据集绑定
+    :param data_set_values 数据集ID对应的数据
     """
-    column_rule_list = ColumnRule.objects.filter(requirement_id__exact=fr.id)
     if not len(column_rule_list):
         raise ValueError('没有定义列填充规则，请先定义规则')
     # 按定义的顺序填充, 需要关联其它数据的放在后面处理, 先处理固定值的
-    column_rule_list: list[ColumnRule] = sorted(column_rule_list, key=operator.attrgetter('rule.fill_order'))
-    fill_data = {'requirementId': fr.id, 'fileId': fr.file_id, 'username': fr.username, 'hashId': hash_id,
-                 'filename': fr.original_filename, 'startLine': fr.start_line, 'data': {}}
-    column_data = fill_data['data']
-    # 生成数据
-    start_line, end_line = fr.start_line, fr.start_line + fr.line_number
-    for column_rule in column_rule_list:
-        # 有数据关联
-        if column_rule.associated_of:
-            exec_associated_of_iter(column_rule, column_rule.rule, start_line, end_line, column_data)
-        # 非关联
-        else:
-            it = match_normal_iter(column_rule, column_rule.rule)
-            column_range = range(start_line, end_line)
-            column_data[column_rule.column_name] = tuple(val for _, val in zip(column_range, it))
-    # 异步处理写入数据
-    write_to_excel.apply_async(args=(fill_data,))
+    columns = sorted((compile_column_plan(c, data_set_values) for c in column_rule_list),
+                     key=operator.attrgetter('fill_order'))
+    # 按列的依赖关系分层，同一层内保持填入顺序
+    levels = sort_levels(columns, operator.attrgetter('outputs'), operator.attrgetter('dependencies'))
+    return GenerationPlan(fr.id, fr.file_id, fr.username, fr.original_filename, fr.start_line, fr.line_number,
+                          fr.write_engine, tuple(columns), levels)
+
+
+def validate_column_dependencies(column_rule: ColumnRule, params: dict):
+    """校验列使用新的参数后，列之间的依赖关系没有环
+
+    :param column_rule 列规则
+    :param params 新的参数名对应的参数值
+    """
+    edges = {}
+    for c in (ColumnRule.objects.filter(requirement_id__exact=column_rule.requirement_id)
+              .select_related('rule').prefetch_related('dataparameter_set')):
+        if c.id != column_rule.id:
+            edges[c.column_name] = parse_dependencies(c.rule.function_name,
+                                                      dict(((p.name, p.value) for p in c.dataparameter_set.all())))
+    edges[column_rule.column_name] = parse_dependencies(column_rule.rule.function_name, params)
+    cycle = find_cycle(edges)
+    if cycle:
+        raise ValueError(f'关联的列之间不能循环引用: {" -> ".join(cycle)}')
+
+
+def load_plan(requirement_id) -> GenerationPlan:
+    """读取生成计划，优先从缓存中读取
+
+    :param requirement_id 填充要求ID
+    """
+    version, plan = get_cached_plan(requirement_id)
+    if plan is None:
+        plan = compile_plan(FillingRequirement.objects.get(pk=requirement_id))
+        store_plan(plan, version)
+    return plan
+
+
+def load_plans(requirement_ids) -> dict:
+    """批量读取生成计划，未缓存的一起编译后放入缓存
+
+    :param requirement_ids 填充要求ID
+    :return 填充要求ID对应的生成计划
+    :raise ValueError 填充要求不存在或没有定义列填充规则
+    """
+    versions, plans = get_cached_plans(requirement_ids)
+    missing = [requirement_id for requirement_id in requirement_ids if requirement_id not in plans]
+    if missing:
+        requirements = FillingRequirement.objects.in_bulk(missing)
+        not_found = [requirement_id for requirement_id in missing if requirement_id not in requirements]
+        if not_found:
+            raise ValueError(f'未查询到对应的填充要求: {not_found}')
+        column_rules, data_set_values = load_requirement_graphs(list(requirements))
+        compiled = []
+        for requirement_id, fr in requirements.items():
+            try:
+                compiled.append(build_plan(fr, column_rules[requirement_id], data_set_values))
+            except ValueError as e:
+                raise ValueError(f'填充要求 {requirement_id}: {e}')
+        store_plans(compiled, versions)
+        plans.update(((plan.requirement_id, plan) for plan in compiled))
+    return plans
+
+
+def build_fill_meta(plan: GenerationPlan, hash_id):
+    """写入 Excel 需要的填充要求信息
+
+    :param plan 生成计划
+    :param hash_id 生成的文件ID
+    """
+    return {'requirementId': plan.requirement_id, 'fileId': plan.file_id, 'username': plan.username,
+            'hashId': hash_id, 'filename': plan.filename, 'startLine': plan.start_line,
+            'writeEngine': plan.write_engine, 'lineNumber': plan.line_number}
+
+
+def iter_fill_chunks(plan: GenerationPlan, chunk_size=FILL_CHUNK_SIZE):
+    """按块生成写入 Excel 的数据
+
+    生成器在所有块之间共享，随机数、时间序列等保持连续；关联的列只读取当前块的数据。
+    每块按依赖关系逐层生成，配置了多个线程时同一层的列在线程池中同时生成
+
+    :param plan 生成计划
+    :param chunk_size 每块的行数
+    :return 每块列名对应的数据
+    """
+    t0 = time.perf_counter()
+    # 一般数据的生成器只创建一次
+    generators = dict(((column.column_name, match_normal_generator(column))
+                       for column in plan.columns if not column.associated_of))
+    # 列的位置按填入顺序固定，所有块相同
+    names = tuple(dict.fromkeys(name for column in plan.columns for name in column.outputs))
+    for offset in range(0, plan.line_number, chunk_size):
+        length = min(chunk_size, plan.line_number - offset)
+        column_data = ColumnStore(names, length)
+        for level in plan.levels:
+            executor = get_fill_executor() if len(level) > 1 else None
+            if executor:
+                # 同一层的列写入不同的键，互不影响
+                for future in [executor.submit(fill_column, column, generators, offset, length, column_data)
+                               for column in level]:
+                    future.result()
+            else:
+                for column in level:
+                    fill_column(column, generators, offset, length, column_data)
+        yield column_data
+    log.info(f'generated {plan.requirement_id} of {plan.line_number} lines in {time.perf_counter() - t0}')
+
+
+def fill_column(column: ColumnPlan, generators: dict, offset: int, length: int, column_data: ColumnStore):
+    """生成单个列在当前块的数据
+
+    :param column 列的生成计划
+    :param generators 列名对应的一般数据生成器
+    :param offset 当前块第一行相对于起始行的位置
+    :param length 当前块的行数
+    :param column_data 当前块写入 Excel 的数据
+    """
+    # 有数据关联
+    if column.associated_of:
+        exec_associated_of_iter(column, offset, length, column_data)
+    # 非关联
+    else:
+        generator = generators[column.column_name]
+        column_data[column.column_name] = generator.generate(length) if generator else [None] * length
+
+
+def copy_file_ids(hash_id, copies=1):
+    """多份生成时每份的文件ID，第一份使用生成的文件ID
+
+    :param hash_id 生成的文件ID
+    :param copies 生成的份数
+    """
+    return [hash_id] + [f'{hash_id}-{n}' for n in range(2, copies + 1)]
+
+
+def build_fill_stream(requirement_id, hash_id, line_number=None, copies=1):
+    """读取生成计划，返回填充要求信息和每份按块生成的数据
+
+    每份使用独立的生成器，随机数据互不相同
+
+    :param requirement_id 填充要求ID
+    :param hash_id 生成的文件ID
+    :param line_number 本次生成的行数，为空时使用填充要求的行数
+    :param copies 生成的份数
+    :return 填充要求信息、每份的文件ID和数据块的迭代器、总行数
+    """
+    plan = load_plan(requirement_id)
+    if line_number:
+        plan = plan._replace(line_number=line_number)
+    check_line_number(plan)
+    streams = [(copy_id, iter_fill_chunks(plan)) for copy_id in copy_file_ids(hash_id, copies)]
+    return build_fill_meta(plan, hash_id), streams, plan.line_number
+
+
+def check_line_number(plan: GenerationPlan):
+    """填充行数不能超过写入方式支持的上限，上限变化前保存的填充要求在生成时拒绝
+
+    :param plan 生成计划，行数为本次生成的行数
+    """
+    limit = max_line_number(plan.write_engine)
+    if plan.line_number > limit:
+        raise ValueError(f'填充要求 {plan.requirement_id}: {plan.write_engine} 写入方式支持填充行数在1到{limit}之间')
+
+
+def build_fill_data(requirement_id, hash_id, copies=1):
+    """按生成计划一次生成写入 Excel 的全部数据
+
+    :param requirement_id 填充要求ID
+    :param hash_id 生成的文件ID
+    :param copies 生成的份数，多份时每份的数据放在 copies 中
+    """
+    plan = load_plan(requirement_id)
+    # 在请求中一次生成全部数据，切换生成方式前保存的大行数填充要求需要拒绝
+    if plan.line_number > settings.FILL_MAX_LINE_NUMBER_IN_REQUEST:
+        raise ValueError(f'在请求中生成时支持填充行数在1到{settings.FILL_MAX_LINE_NUMBER_IN_REQUEST}之间')
+    fill_data = build_fill_meta(plan, hash_id)
+    # 整体作为一块生成，转为字典以便序列化
+    if copies == 1:
+        fill_data['data'] = dict(next(iter_fill_chunks(plan, plan.line_number), {}))
+    else:
+        fill_data['copies'] = [{'hashId': copy_id, 'data': dict(next(iter_fill_chunks(plan, plan.line_number), {}))}
+                               for copy_id in copy_file_ids(hash_id, copies)]
+    return fill_data
+
+
+def fill_excel(requirement_id, hash_id, copies=1, archive=False):
+    """填入数据到 Excel
+
+    :param requirement_id 填充要求ID
+    :param hash_id 生成的文件ID
+    :param copies 生成的份数，所有份数共用一次下载和解析的模板
+    :param archive 是否把所有文件打包为一个 zip 文件，文件ID为生成的文件ID
+    """
+    fill_data = build_fill_data(requirement_id, hash_id, copies)
+    fill_data['archive'] = archive
+    if is_by_reference():
+        # 数据存入 Redis，任务消息中只有 key
+        for item in fill_data.get('copies', (fill_data,)):
+            item['dataKey'] = store_payload(item.pop('data'))
+    create_jobs(((hash_id, requirement_id, fill_data['lineNumber'] * copies),))
+    # 异步处理写入数据，任务ID与生成的文件ID相同
+    write_to_excel.apply_async(args=(fill_data,), task_id=hash_id)
     del fill_data
     # result = write_to_excel.apply_async(args=(fill_data,))
     # log.info(result.get())
+
+
+def defer_fill_excel(requirement_id, hash_id, copies=1, archive=False):
+    """只提交任务，生成数据和写入 Excel 都在 Celery 进程中执行
+
+    :param requirement_id 填充要求ID
+    :param hash_id 生成的文件ID
+    :param copies 生成的份数
+    :param archive 是否把所有文件打包为一个 zip 文件
+    """
+    # 开始生成前不编译生成计划，只确认填充要求存在，已缓存计划时不需要查询；总行数由 Celery 进程写入
+    _, plan = get_cached_plan(requirement_id)
+    if plan is None and not FillingRequirement.objects.filter(pk=requirement_id).exists():
+        raise ValueError(f'未查询到对应的填充要求: {requirement_id}')
+    create_jobs(((hash_id, requirement_id, plan.line_number * copies if plan else 0),))
+    generate_excel.apply_async(args=(requirement_id, hash_id), kwargs=dict(copies=copies, archive=archive),
+                               task_id=hash_id)
+
+
+def defer_fill_excel_batch(items, batch_id=None):
+    """批量提交生成任务，所有任务作为一个组执行
+
+    生成计划在提交前一起读取并放入缓存，Celery 进程生成时直接读取缓存
+
+    :param items 填充要求ID和本次生成的行数（为空时使用填充要求的行数）
+    :param batch_id 批次ID
+    :return 批次ID和每个任务的信息
+    """
+    plans = load_plans(list(dict.fromkeys(requirement_id for requirement_id, _ in items)))
+    batch_id = batch_id or uuid.uuid1().hex
+    jobs = []
+    for requirement_id, line_number in items:
+        plan = plans[requirement_id]
+        if line_number:
+            check_line_number(plan._replace(line_number=line_number))
+        jobs.append(dict(requirementId=requirement_id, fileId=uuid.uuid1().hex,
+                         lineNumber=line_number or plan.line_number))
+    create_jobs((job['fileId'], job['requirementId'], job['lineNumber']) for job in jobs)
+    # 任务ID与生成的文件ID相同
+    # 批次状态由缓存的批次信息和每个任务的状态得到，不需要保存 GroupResult
+    group(generate_excel.signature((job['requirementId'], job['fileId'], job['lineNumber']),
+                                   task_id=job['fileId']) for job in jobs).apply_async(task_id=batch_id)
+    batch = dict(batchId=batch_id, createdAt=datetime.datetime.now(), items=jobs)
+    # 批次信息保留 1 天
+    cache.set(_batch_key(batch_id), batch, dc.days.to_seconds(1))
+    log.info(f'<GenerateBatch> enqueue batch {batch_id} of {len(jobs)} jobs')
+    return batch
+
+
+def get_batch_status(batch_id):
+    """读取批量任务的整体状态和每个任务的状态
+
+    :param batch_id 批次ID
+    """
+    batch = cache.get(_batch_key(batch_id), None)
+    if batch is None:
+        raise ValueError('批量任务不存在或已过期')
+    # 所有任务的进度一次读取，与任务数量无关
+    jobs = read_jobs([job['fileId'] for job in batch['items']]) or {}
+    counts = dict(((state, 0) for state in ('queued', 'running', 'done', 'failed')))
+    items = []
+    for job in batch['items']:
+        progress = jobs.get(job['fileId'], None)
+        if progress is None:
+            # 进度没有记录时才读取 Celery 任务的状态
+            state = _job_state(AsyncResult(job['fileId'], app=generate_excel.app))
+            items.append(dict(job, status=state))
+        else:
+            state = progress['status']
+            items.append(dict(job, status=state, rows=progress['rows'], total=progress['total'],
+                              error=progress['error']))
+        counts[state] += 1
+    if counts['queued'] == len(items):
+        status = 'queued'
+    elif counts['queued'] or counts['running']:
+        status = 'running'
+    else:
+        status = 'failed' if counts['failed'] else 'done'
+    return dict(batchId=batch_id, createdAt=batch['createdAt'], status=status, total=len(items),
+                **counts, items=items)
+
+
+def get_job_status(hash_id):
+    """读取单个生成任务的状态和进度
+
+    进度没有记录时（已过期或 Redis 不可用）只返回 Celery 任务的状态
+
+    :param hash_id 生成的文件ID
+    """
+    job = read_job(hash_id)
+    if job is not None:
+        return job
+    result = AsyncResult(hash_id, app=generate_excel.app)
+    # 不存在的任务也是 PENDING 状态
+    if result.state == states.PENDING:
+        raise ValueError('生成任务不存在或已过期')
+    return dict(fileId=hash_id, requirementId=None, status=_job_state(result), rows=None, total=None,
+                elapsed=None, filenames=[], error=None)
+
+
+def _batch_key(batch_id):
+    return f'GenerateBatch:{batch_id}'
+
+
+def _job_state(result: AsyncResult):
+    """Celery 任务状态转为生成状态，任务返回 False 表示生成失败"""
+    if result.state == states.SUCCESS:
+        return 'done' if result.result else 'failed'
+    if result.state in states.PROPAGATE_STATES:
+        return 'failed'
+    if result.state in (states.STARTED, states.RETRY):
+        return 'running'
+    return 'queued'
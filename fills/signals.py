@@ -0,0 +1,117 @@
+import collections
+import threading
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .cache import bump_versions, cache_namespace
+from .models import DataSet, DataSetBind, DataSetDefine, DataSetValue
+from .models import FillingRequirement, ColumnRule, DataParameter
+from .models import GenerateRule, GenerateRuleParameter
+from .plan import invalidate_plan
+
+# 列表和单个查询缓存的命名空间，值为列表按哪个字段查询，None 表示只按数据类型区分
+__CACHE_NAMESPACES__ = {
+    FillingRequirement: 'username',
+    ColumnRule: 'requirement_id',
+    DataParameter: 'column_rule_id',
+    DataSet: 'username',
+    DataSetDefine: 'data_set_id',
+    DataSetValue: 'data_set_id',
+    DataSetBind: 'column_rule_id',
+    GenerateRule: None,
+    GenerateRuleParameter: 'rule_id'
+}
+
+
+# 变化的数据先按类型记下，事务提交后一起处理：删除在事务中发送信号，提交前增加版本号时，
+# 其他请求仍能读到将被删除的数据并缓存到新版本下
+_pending = threading.local()
+
+
+def _defer_invalidate(kind, pk):
+    """记下变化的数据，事务提交后使相关的缓存和生成计划失效，不在事务中时立即执行
+
+    :param kind 数据的类型
+    :param pk 数据的ID，类型为 namespace 时是命名空间
+    """
+    pending = getattr(_pending, 'items', None)
+    if pending is None:
+        pending = _pending.items = collections.defaultdict(set)
+    pending[kind].add(pk)
+    # 回滚后不会执行，每次都注册，已经处理过时不会重复查询
+    transaction.on_commit(_invalidate_pending)
+
+
+def _invalidate_pending():
+    pending = getattr(_pending, 'items', None)
+    if not pending:
+        return
+    _pending.items = None
+    if pending['namespace']:
+        bump_versions(*sorted(pending['namespace']))
+    # 任何影响生成计划的数据变化都会使对应填充要求的计划失效，批量删除时查询次数与数量无关
+    requirement_ids = set(pending['requirement'])
+    if pending['rule']:
+        requirement_ids.update(ColumnRule.objects.filter(rule_id__in=pending['rule'])
+                               .values_list('requirement_id', flat=True))
+    if pending['column_rule']:
+        requirement_ids.update(ColumnRule.objects.filter(id__in=pending['column_rule'])
+                               .values_list('requirement_id', flat=True))
+    if pending['data_set']:
+        requirement_ids.update(DataParameter.objects.filter(data_set_id__in=pending['data_set'])
+                               .values_list('column_rule__requirement_id', flat=True))
+    invalidate_plan(*requirement_ids)
+
+
+def cached_model_changed(sender, instance, **kwargs):
+    """数据变化时增加数据类型和所属对象的版本号，相关的列表和单个查询缓存都失效"""
+    owner_field = __CACHE_NAMESPACES__[sender]
+    _defer_invalidate('namespace', cache_namespace(sender.__name__))
+    if owner_field:
+        _defer_invalidate('namespace', cache_namespace(sender.__name__, getattr(instance, owner_field)))
+
+
+# 只连接有缓存的模型，其他模型（如用户、会话）删除时仍可以不逐条发送信号
+for _model in __CACHE_NAMESPACES__:
+    post_save.connect(cached_model_changed, sender=_model)
+    post_delete.connect(cached_model_changed, sender=_model)
+
+
+# 规则数据变化时同时清理模型的缓存
+@receiver((post_save, post_delete), sender=FillingRequirement)
+def filling_requirement_changed(sender, instance: FillingRequirement, **kwargs):
+    _defer_invalidate('requirement', instance.id)
+
+
+@receiver((post_save, post_delete), sender=GenerateRule)
+def generate_rule_changed(sender, instance: GenerateRule, **kwargs):
+    GenerateRule.remove_cache(instance.id)
+    _defer_invalidate('rule', instance.id)
+
+
+@receiver((post_save, post_delete), sender=GenerateRuleParameter)
+def generate_rule_parameter_changed(sender, instance: GenerateRuleParameter, **kwargs):
+    GenerateRuleParameter.remove_cache(instance.id)
+
+
+@receiver((post_save, post_delete), sender=ColumnRule)
+def column_rule_changed(sender, instance: ColumnRule, **kwargs):
+    ColumnRule.remove_cache(instance.id)
+    _defer_invalidate('requirement', instance.requirement_id)
+
+
+@receiver((post_save, post_delete), sender=DataParameter)
+def data_parameter_changed(sender, instance: DataParameter, **kwargs):
+    _defer_invalidate('column_rule', instance.column_rule_id)
+
+
+@receiver((post_save, post_delete), sender=DataSetBind)
+def data_set_bind_changed(sender, instance: DataSetBind, **kwargs):
+    _defer_invalidate('column_rule', instance.column_rule_id)
+
+
+@receiver((post_save, post_delete), sender=DataSetValue)
+def data_set_value_changed(sender, instance: DataSetValue, **kwargs):
+    _defer_invalidate('data_set', instance.data_set_id)
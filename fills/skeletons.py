@@ -0,0 +1,84 @@
+"""Celery 进程中已解析模板的内存缓存
+
+按模板文件内容的摘要缓存解析后的结构，每次生成从缓存的结构复制出新的工作簿，
+同一个模板只在第一次生成时解析
+"""
+import collections
+import functools
+import hashlib
+import threading
+
+from fillexcel.configurator import read_template_cache_config
+from .logger import init_logger
+
+log = init_logger(__name__, 'celery-task.log')
+
+# 缓存的解析结果可能为 None，用于区分未缓存
+_MISSING = object()
+
+
+class SkeletonCache:
+    __slots__ = ('max_entries', 'hits', 'misses', '_entries', '_lock')
+
+    def __init__(self, max_entries=16):
+        """数量受限的模板结构缓存，超出时淘汰最久未使用的结构
+
+        :param max_entries 缓存的最大数量，0 表示不缓存
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader):
+        """读取缓存的模板结构，没有时解析后放入缓存
+
+        :param key 缓存的键，包含模板内容的摘要
+        :param loader 解析模板的无参数函数
+        """
+        with self._lock:
+            skeleton = self._entries.get(key, _MISSING)
+            if skeleton is not _MISSING:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return skeleton
+            self.misses += 1
+        skeleton = loader()
+        if self.max_entries <= 0:
+            return skeleton
+        with self._lock:
+            self._entries[key] = skeleton
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        log.info(f'<SkeletonCache> load {key}, hits {self.hits}, misses {self.misses}')
+        return skeleton
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """命中和未命中的次数"""
+        return dict(hits=self.hits, misses=self.misses, size=len(self._entries))
+
+
+def file_digest(path, chunk_size=64 * 1024):
+    """计算文件内容的摘要，作为模板结构缓存的键
+
+    :param path 文件路径
+    :param chunk_size 每次读取的字节数
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(str(path), 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def get_skeleton_cache():
+    """获得当前进程的模板结构缓存"""
+    config = read_template_cache_config()
+    return SkeletonCache(config['memory_entries'] if config['enabled'] else 0)
@@ -1,15 +1,21 @@
+import datetime
+import functools
 import os
+import threading
 import uuid
 
 import certifi
 import urllib3
 from minio import Minio
+from minio.commonconfig import Tags
 
 from fillexcel.configurator import read_minio_config
 from .logger import init_logger
 
 log = init_logger(__name__, 'storage.log')
 
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
 
 def convert_path(path):
     """Convert path-like object to string.
@@ -23,11 +29,39 @@ def convert_path(path):
         return path
 
 
+@functools.lru_cache(maxsize=None)
+def _read_config():
+    """配置文件只读取一次"""
+    return read_minio_config()
+
+
+class ObjectStream:
+    """对象存储的文件流，迭代结束或关闭时释放连接"""
+
+    def __init__(self, response, chunk_size):
+        self.response = response
+        self.chunk_size = chunk_size
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            yield from self.response.stream(self.chunk_size)
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.response.close()
+            self.response.release_conn()
+
+
 class Storage:
 
-    def __init__(self, retry=4):
+    def __init__(self, retry=4, check_bucket=True):
         """对象存储
         :param retry 重试次数
+        :param check_bucket 是否检查存储桶存在
         """
         timeout = 30  # 30 秒请求超时
         ca_certs = os.environ.get('SSL_CERT_FILE') or certifi.where()
@@ -42,15 +76,16 @@ class Storage:
                 status_forcelist=[500, 502, 503, 504]
             )
         )
-        config = read_minio_config()
+        config = dict(_read_config())
         # 没有则创建存储桶
         self.bucket = config['bucket']
         del config['bucket']
         self.client = Minio(http_client=http_client, **config)
-        found = self.client.bucket_exists(self.bucket)
-        if not found:
-            self.client.make_bucket(self.bucket)
-            print(f"Bucket '{self.bucket}' created")
+        if check_bucket:
+            found = self.client.bucket_exists(self.bucket)
+            if not found:
+                self.client.make_bucket(self.bucket)
+                print(f"Bucket '{self.bucket}' created")
 
     def store_object_for_path(self, hash_id, file_path, folder=None, content_type=None):
         """存储对应路径的文件
@@ -103,7 +138,80 @@ class Storage:
             obj = self.client.get_object(self.bucket, f'{folder}/{file_id}')
         else:
             obj = self.client.get_object(self.bucket, file_id)
-        return obj.data
+        try:
+            return obj.data
+        finally:
+            # 归还连接到连接池
+            obj.close()
+            obj.release_conn()
+
+    def stat_object(self, file_id, folder=None):
+        """获得文件的大小、ETag 等信息
+
+        :param file_id 文件ID（文件名）
+        :param folder 对象存储的文件夹
+        """
+        if folder:
+            return self.client.stat_object(self.bucket, f'{folder}/{file_id}')
+        return self.client.stat_object(self.bucket, file_id)
+
+    def open_object_stream(self, file_id, folder=None, offset=0, length=0, chunk_size=64 * 1024):
+        """分块读取文件，读取结束或被关闭时释放连接
+
+        请求在首次迭代前发出，对象不存在等异常在调用时即可捕获
+
+        :param file_id 文件ID（文件名）
+        :param folder 对象存储的文件夹
+        :param offset 起始的字节位置
+        :param length 读取的字节数，0 表示读取到结尾
+        :param chunk_size 每次读取的字节数
+        """
+        name = f'{folder}/{file_id}' if folder else file_id
+        obj = self.client.get_object(self.bucket, name, offset=offset, length=length)
+        return ObjectStream(obj, chunk_size)
+
+    def set_object_tags(self, file_id, tags: dict, folder=None):
+        """设置文件的标签，会替换已有的所有标签
+
+        :param file_id 文件ID（文件名）
+        :param tags 标签名和标签值
+        :param folder 对象存储的文件夹
+        """
+        name = f'{folder}/{file_id}' if folder else file_id
+        object_tags = Tags.new_object_tags()
+        object_tags.update(tags)
+        self.client.set_object_tags(self.bucket, name, object_tags)
+
+    def get_object_tags(self, file_id, folder=None) -> dict:
+        """获得文件的标签，没有标签时返回空字典
+
+        :param file_id 文件ID（文件名）
+        :param folder 对象存储的文件夹
+        """
+        name = f'{folder}/{file_id}' if folder else file_id
+        return dict(self.client.get_object_tags(self.bucket, name) or {})
+
+    def presigned_put_url(self, file_id, expires: datetime.timedelta, folder=None):
+        """获得直接上传文件的临时地址
+
+        :param file_id 文件ID（文件名）
+        :param expires 有效期
+        :param folder 对象存储的文件夹
+        """
+        name = f'{folder}/{file_id}' if folder else file_id
+        return self.client.presigned_put_object(self.bucket, name, expires=expires)
+
+    def presigned_get_url(self, file_id, expires: datetime.timedelta, folder=None, content_disposition=None):
+        """获得直接下载文件的临时地址
+
+        :param file_id 文件ID（文件名）
+        :param expires 有效期
+        :param folder 对象存储的文件夹
+        :param content_disposition 下载时响应的 Content-Disposition
+        """
+        name = f'{folder}/{file_id}' if folder else file_id
+        response_headers = {'response-content-disposition': content_disposition} if content_disposition else None
+        return self.client.presigned_get_object(self.bucket, name, expires=expires, response_headers=response_headers)
 
     def get_object_to_path(self, file_id, fspath, folder=None):
         """获得文件并保存到指定路径
@@ -125,6 +233,42 @@ class Storage:
             self.client.remove_object(self.bucket, file_id)
 
 
+# 当前进程共享的客户端，按重试次数区分
+_storages = {}
+_bucket_checked = False
+_storages_lock = threading.Lock()
+
+
+def get_storage(retry=4) -> Storage:
+    """获得当前进程共享的对象存储客户端
+
+    首次使用时创建，之后复用连接池；存储桶只在进程中检查一次
+
+    :param retry 重试次数
+    """
+    global _bucket_checked
+    storage = _storages.get(retry, None)
+    if storage is None:
+        with _storages_lock:
+            storage = _storages.get(retry, None)
+            if storage is None:
+                storage = Storage(retry=retry, check_bucket=not _bucket_checked)
+                _bucket_checked = True
+                _storages[retry] = storage
+    return storage
+
+
+def _reset_storages():
+    """fork 后的子进程不能复用父进程的连接"""
+    global _bucket_checked, _storages_lock
+    _storages.clear()
+    _bucket_checked = False
+    _storages_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_storages)
+
+
 def main():
     server_config = {
         "url": "http://localhost:9090/api/v1/service-account-credentials",
@@ -1,16 +1,25 @@
 import os
 import pathlib
+import sys
 import tempfile
 import time
+import typing
+import zipfile
 
+import django
 import psycopg2
-import openpyxl
 from celery import Celery
+from celery.signals import worker_init
+from django.db import close_old_connections
 
 from fillexcel.configurator import read_postgres_config, read_celery_config
+from .jobs import add_rows, fail_job, finish_job, start_job
 from .logger import init_logger
-from .storage import Storage
+from .payload import load_payload, remove_payload
+from .storage import XLSX_CONTENT_TYPE, get_storage
+from .templatecache import get_template_cache
 from .utils import SnowFlake
+from .writers import chunk_length, get_writer
 
 app = Celery('fills', **read_celery_config())
 
@@ -26,58 +35,162 @@ def excel_column_to_number(column):
     return result
 
 
-def foreach_rows(worksheet, start_line, excel_data: dict):
-    for column, data_list in excel_data.items():
-        for num, val in zip(range(start_line, start_line + len(data_list)), data_list):
-            worksheet[f'{column}{num}'] = str(val)
-            worksheet[f'{column}{num}'].number_format = '@'
+@worker_init.connect
+def setup_django(**kwargs):
+    """Celery 进程启动时初始化一次 Django，用于读取生成计划和模型数据
+
+    在创建进程池之前执行，prefork 的子进程和 eventlet 等协程池都不需要再次初始化
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'fillexcel.settings')
+    django.setup()
+
+
+@app.task
+def generate_excel(requirement_id, hash_id, line_number=None, copies=1, archive=False):
+    """[定时任务] 生成数据并写入 Excel
+
+    数据按块生成，每块写入后即可释放，内存占用与总行数无关
+
+    :param requirement_id 填充要求ID
+    :param hash_id 生成的文件ID
+    :param line_number 本次生成的行数，为空时使用填充要求的行数
+    :param copies 生成的份数，所有份数共用一次下载和解析的模板
+    :param archive 是否把所有文件打包为一个 zip 文件
+    """
+    from .service import build_fill_stream
+    close_old_connections()
+    try:
+        fill_meta, streams, line_number = build_fill_stream(requirement_id, hash_id, line_number, copies)
+    except Exception as e:
+        log.error(f'generate {requirement_id} failed: {e}')
+        fail_job(hash_id, e)
+        return False
+    finally:
+        close_old_connections()
+    start_job(hash_id, line_number * copies)
+    filenames = write_copies(fill_meta, [(copy_id, _track_rows(hash_id, chunks)) for copy_id, chunks in streams],
+                             line_number, archive)
+    _finish_job(hash_id, filenames)
+    return filenames[0] if filenames and (archive or copies == 1) else filenames
 
 
 @app.task
 def write_to_excel(data_for_fill: dict):
     """[定时任务] 写入数据到 Excel
 
-    :param data_for_fill 待写入的数据
+    :param data_for_fill 待写入的数据，多份时每份的数据在 copies 中
+    """
+    hash_id = data_for_fill['hashId']
+    items = data_for_fill.pop('copies', None)
+    multiple = items is not None
+    if not multiple:
+        items = [data_for_fill]
+    start_job(hash_id, data_for_fill.get('lineNumber', 0) * len(items))
+    # 逐份读取数据，同一时间只保留一份
+    streams = [(item['hashId'], _track_rows(hash_id, _load_copy_chunks(item))) for item in items]
+    archive = data_for_fill.get('archive', False)
+    filenames = write_copies(data_for_fill, streams, None, archive)
+    _finish_job(hash_id, filenames)
+    if filenames:
+        for item in items:
+            if item.get('dataKey', None):
+                remove_payload(item['dataKey'])
+    return filenames[0] if filenames and (archive or not multiple) else filenames
+
+
+def _track_rows(hash_id, chunks: typing.Iterable[dict]):
+    """逐块返回数据，每块写入后更新任务已写入的行数"""
+    for excel_data in chunks:
+        yield excel_data
+        add_rows(hash_id, chunk_length(excel_data))
+
+
+def _finish_job(hash_id, filenames):
+    if filenames:
+        finish_job(hash_id, filenames)
+    else:
+        fail_job(hash_id, '写入 Excel 失败')
+
+
+def _load_copy_chunks(item: dict):
+    """读取一份写入的数据，作为唯一的数据块"""
+    data_key = item.get('dataKey', None)
+    yield load_payload(data_key) if data_key else item.pop('data')
+
+
+def write_copies(data_for_fill: dict, streams: typing.Iterable[tuple], line_number, archive=False):
+    """下载一次模板，逐份写入数据块后上传并保存生成记录
+
+    :param data_for_fill 填充要求信息
+    :param streams 每份的文件ID和按块生成的列名对应的数据
+    :param line_number 总行数，为空时按数据块的行数计算
+    :param archive 是否把所有文件打包为一个 zip 文件，文件ID为 hashId
+    :return 生成的文件名，打包时只有 zip 文件名；失败时返回 False
     """
     t0 = time.perf_counter()
     # 创建操作系统支持的临时目录
     tempdir = tempfile.TemporaryDirectory()
     tmp_dir = pathlib.Path(tempdir.name)
-    filename = add_timestamp_for_filename(data_for_fill['filename'])
-    save_path = tmp_dir / filename
+    template_path = tmp_dir / f"template-{data_for_fill['fileId']}.xlsx"
     try:
-        storge = Storage()
-        # 下载文件到临时目录
-        storge.get_object_to_path(data_for_fill['fileId'], str(save_path), 'requirement')
+        storge = get_storage()
+        template_cache = get_template_cache()
+        if template_cache:
+            # 从本地缓存取出模板，模板有变化时才重新下载
+            template_cache.checkout(storge, data_for_fill['fileId'], template_path)
+        else:
+            # 下载文件到临时目录
+            storge.get_object_to_path(data_for_fill['fileId'], str(template_path), 'requirement')
     except Exception as e:
         # 清空缓存文件
         tempdir.cleanup()
         log.error(str(e))
         return False
-    # 填入数据
-    start_line = data_for_fill['startLine']
-    excel_data: dict = data_for_fill['data']
-    book = openpyxl.load_workbook(str(save_path))
-    sheet = book.active
-    foreach_rows(sheet, start_line, excel_data)
-    book.save(str(save_path))
-    book.close()
-    del data_for_fill['data']
+    writer = get_writer(data_for_fill.get('writeEngine', None))
+    stem, ext = os.path.splitext(data_for_fill['filename'])
+    filenames = []
+    bundle = None
     try:
-        # 上传写入后的文件
-        storge.store_object_for_path(data_for_fill['hashId'], save_path,
-                                     content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        if archive:
+            archive_name = add_timestamp_for_filename(f'{stem}.zip')
+            # xlsx 已经是压缩文件，打包时不再压缩
+            bundle = zipfile.ZipFile(tmp_dir / archive_name, 'w', zipfile.ZIP_STORED)
+        for n, (hash_id, chunks) in enumerate(streams, 1):
+            filename = add_timestamp_for_filename(data_for_fill['filename'])
+            save_path = tmp_dir / filename
+            if line_number:
+                writer(template_path, save_path, data_for_fill['startLine'], chunks, line_number)
+            else:
+                chunks = list(chunks)
+                writer(template_path, save_path, data_for_fill['startLine'], chunks,
+                       sum(chunk_length(excel_data) for excel_data in chunks))
+            if bundle:
+                bundle.write(save_path, arcname=f'{stem}-{n}{ext}')
+            else:
+                # 上传写入后的文件
+                storge.store_object_for_path(hash_id, save_path, content_type=XLSX_CONTENT_TYPE)
+                # 文件生成记录
+                save_record(data_for_fill['requirementId'], data_for_fill['username'], hash_id, filename)
+            # 每份写入后即删除，临时目录中最多只有一份
+            save_path.unlink()
+            filenames.append(filename)
+        if bundle:
+            bundle.close()
+            storge.store_object_for_path(data_for_fill['hashId'], tmp_dir / archive_name,
+                                         content_type='application/zip')
+            save_record(data_for_fill['requirementId'], data_for_fill['username'],
+                        data_for_fill['hashId'], archive_name)
+            filenames = [archive_name]
     except Exception as e:
-        log.error(str(e))
+        log.error(e, exc_info=sys.exc_info())
         return False
     finally:
+        if bundle:
+            bundle.close()
         # 清空缓存文件
         tempdir.cleanup()
-    # 文件生成记录
-    save_record(data_for_fill['requirementId'], data_for_fill['username'], data_for_fill['hashId'], filename)
-    del data_for_fill
-    log.info(f'elapsed time {time.perf_counter() - t0}')
-    return filename
+    log.info(f'elapsed time {time.perf_counter() - t0}, {len(filenames)} files')
+    return filenames
 
 
 def add_timestamp_for_filename(filename=None):
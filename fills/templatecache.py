@@ -0,0 +1,137 @@
+"""Celery 进程中的模板文件缓存
+
+模板按 fileId 和对象存储的 ETag 保存在本地目录，文件内容变化后 ETag 不同，旧文件会被淘汰。
+同一台机器的多个 worker 进程共享目录，写入使用临时文件加重命名，读取时以硬链接取出，
+其他进程淘汰文件不影响正在使用的模板
+"""
+import functools
+import os
+import pathlib
+import re
+import shutil
+import threading
+import uuid
+
+from fillexcel.configurator import read_template_cache_config
+from .logger import init_logger
+
+log = init_logger(__name__, 'celery-task.log')
+
+_UNSAFE_PATTERN = re.compile(r'[^0-9A-Za-z_-]')
+
+
+class TemplateCache:
+    __slots__ = ('directory', 'max_bytes', 'hits', 'misses', 'evictions', '_lock')
+
+    def __init__(self, directory, max_bytes):
+        """大小受限的模板缓存，超出时淘汰最久未使用的文件
+
+        :param directory 缓存目录
+        :param max_bytes 缓存的最大字节数
+        """
+        self.directory = pathlib.Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def checkout(self, storage, file_id, target_path, folder='requirement'):
+        """取出模板到指定路径，缓存中没有时从对象存储下载
+
+        :param storage 对象存储
+        :param file_id 文件ID（文件名）
+        :param target_path 模板的保存路径
+        :param folder 对象存储的文件夹
+        :return 是否命中缓存
+        """
+        stat = storage.stat_object(file_id, folder=folder)
+        cached_path = self.directory / f'{_safe_name(file_id)}-{_safe_name(stat.etag)}.xlsx'
+        hit = self._link(cached_path, target_path)
+        if hit:
+            # 更新修改时间作为最近使用时间
+            os.utime(cached_path)
+        else:
+            part_path = self.directory / f'{cached_path.name}.{uuid.uuid4().hex}.part'
+            try:
+                storage.get_object_to_path(file_id, str(part_path), folder)
+                os.replace(part_path, cached_path)
+            finally:
+                part_path.unlink(missing_ok=True)
+            if not self._link(cached_path, target_path):
+                # 刚写入就被其他进程淘汰，再下载一次到目标路径
+                storage.get_object_to_path(file_id, str(target_path), folder)
+            self._evict(keep=cached_path)
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        log.info(f'<TemplateCache> {"hit" if hit else "miss"} {file_id}, '
+                 f'hits {self.hits}, misses {self.misses}, evictions {self.evictions}')
+        return hit
+
+    @staticmethod
+    def _link(cached_path: pathlib.Path, target_path):
+        """硬链接缓存文件到目标路径，不在同一个文件系统时复制"""
+        try:
+            os.link(cached_path, target_path)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError:
+            try:
+                shutil.copyfile(cached_path, target_path)
+                return True
+            except FileNotFoundError:
+                return False
+
+    def _evict(self, keep=None):
+        """缓存超出大小时按最近使用时间淘汰
+
+        :param keep 不淘汰的文件
+        """
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith('.xlsx') or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if keep and path == str(keep):
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            with self._lock:
+                self.evictions += 1
+            log.info(f'<TemplateCache> evict {path}')
+
+    def stats(self):
+        """命中、未命中和淘汰的次数"""
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+def _safe_name(value):
+    return _UNSAFE_PATTERN.sub('_', str(value))
+
+
+@functools.lru_cache(maxsize=None)
+def get_template_cache():
+    """获得当前进程的模板缓存，未启用时返回 None"""
+    config = read_template_cache_config()
+    if not config['enabled']:
+        return None
+    return TemplateCache(config['directory'], config['max_size'] * 1024 * 1024)
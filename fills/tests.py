@@ -1,8 +1,150 @@
+import asyncio
+import io
+import itertools
 import operator
+import os
+import pathlib
+import re
+import tempfile
+import time
+import uuid
+import zipfile
+from unittest import mock
 
-from django.test import TestCase
+import openpyxl
+from celery import states
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
 
-from .models import FillingRequirement, ColumnRule
+from .cache import cache_namespace, get_or_query, get_versions
+from .columnstore import ColumnStore
+from .events import job_events
+from .graph import find_cycle, parse_dependencies, sort_levels
+from .jobs import add_rows, create_jobs, finish_job, job_channel, job_key, read_job, start_job
+from .localcache import LocalCache
+from .models import DataSet, DataSetValue, DataSetBind
+from .models import FillingRequirement, ColumnRule, DataParameter
+from .models import GenerateRule, GenerateRuleParameter
+from .payload import load_payload, remove_payload
+from .plan import get_cached_plan, invalidate_plan, store_plan
+from .ratelimit import RateLimit
+from .serializers import FillingRequirementSerializer
+from .service import build_fill_data, build_fill_stream, compile_plan, defer_fill_excel, defer_fill_excel_batch
+from .service import copy_file_ids, fill_excel, get_batch_status, get_job_status, iter_fill_chunks, load_plan
+from .skeletons import SkeletonCache
+from .templatecache import TemplateCache
+from .tools import RandomNumberGenerator, TimeSerialGenerator, ValueListGenerator
+from .tools import compile_expressions, random_number_iter
+from .upload import XLSX_CONTENT_TYPE, XLSX_MAGIC, complete_upload, create_upload
+from .tasks import write_copies
+from .views import GeneratesBatchView, GeneratesView, parse_byte_range
+from .writers import write_with_openpyxl, write_with_stream
+from .xlsxpatch import write_with_xml_patch
+
+# 测试数据使用自增的ID，避免同一毫秒内生成重复的雪花ID
+_ids = itertools.count(1)
+
+
+def excel_column_name(number):
+    """数字转为 Excel 列名，如 1 -> A, 27 -> AA"""
+    name = ''
+    while number:
+        number, remainder = divmod(number - 1, 26)
+        name = chr(ord('A') + remainder) + name
+    return name
+
+
+class FakeRedis:
+    """测试用的内存 Redis 客户端，只实现用到的命令"""
+
+    def __init__(self):
+        self.values = {}
+        self.published = []
+
+    def get(self, key):
+        return self.values.get(key, None)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+    def hset(self, key, mapping):
+        self.values.setdefault(key, {}).update(((field, str(val)) for field, val in mapping.items()))
+
+    def hincrby(self, key, field, amount):
+        values = self.values.setdefault(key, {})
+        values[field] = str(int(values.get(field, 0)) + amount)
+
+    def hgetall(self, key):
+        return dict(self.values.get(key, {}))
+
+    def expire(self, key, seconds):
+        pass
+
+    def publish(self, channel, message):
+        self.published.append((channel, message))
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    """记录命令，execute 时依次执行"""
+
+    def __init__(self, client: FakeRedis):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+class FakeAsyncRedis:
+    """异步接口的内存 Redis 客户端，订阅时每次收到消息前执行一步状态变化"""
+
+    def __init__(self, client: FakeRedis, steps=()):
+        self.client = client
+        self.steps = list(steps)
+
+    async def hgetall(self, key):
+        return self.client.hgetall(key)
+
+    def pubsub(self):
+        return FakePubSub(self.steps)
+
+
+class FakePubSub:
+
+    def __init__(self, steps: list):
+        self.steps = steps
+        self.channels = []
+
+    async def subscribe(self, channel):
+        self.channels.append(channel)
+
+    async def unsubscribe(self):
+        self.channels.clear()
+
+    async def aclose(self):
+        pass
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        if not self.steps:
+            await asyncio.sleep(timeout)
+            return None
+        self.steps.pop(0)()
+        return dict(type='message', channel=self.channels[0], data='')
 
 
 # Create your tests here.
@@ -16,3 +158,708 @@ class FillingRequirementModelTests(TestCase):
             print(column_rule.rule.fill_order)
 
         self.assertIsNotNone(fr)
+
+
+class CompilePlanQueryTests(TestCase):
+
+    def setUp(self):
+        self.random_rule = self.create_rule('random_number_iter', 1, ('start', 'stop'))
+        self.list_rule = self.create_rule('value_list_iter', 2, ('data_set_id',))
+        self.fill_rule = self.create_rule('associated_fill', 2, ('data_set_id',))
+        self.string_set = DataSet.objects.create(id=next(_ids), username='jack', description='字符串',
+                                                 data_type='string')
+        self.dict_set = DataSet.objects.create(id=next(_ids), username='jack', description='字典', data_type='dict')
+        for item in ('蛇', '蝎', '虎'):
+            DataSetValue.objects.create(id=next(_ids), data_set=self.string_set, item=item, data_type='string')
+        for item in ('{"mass": 158.54}', '{"mass": 851.21}'):
+            DataSetValue.objects.create(id=next(_ids), data_set=self.dict_set, item=item, data_type='dict')
+
+    @staticmethod
+    def create_rule(function_name, fill_order, param_names):
+        rule = GenerateRule.objects.create(id=next(_ids), rule_name=function_name, function_name=function_name,
+                                           fill_order=fill_order, description=function_name)
+        for name in param_names:
+            GenerateRuleParameter.objects.create(id=next(_ids), rule=rule, name=name, data_type='string',
+                                                 description=name, required=False, need_outside_data=False)
+        return rule
+
+    def create_requirement(self, column_number):
+        fr = FillingRequirement.objects.create(id=next(_ids), username='jack', file_id=str(next(_ids)),
+                                               original_filename='abc.xlsx', start_line=2, line_number=10)
+        rules = itertools.cycle((self.random_rule, self.list_rule, self.fill_rule))
+        for number, rule in zip(range(1, column_number + 1), rules):
+            column_rule = ColumnRule.objects.create(id=next(_ids), requirement=fr, rule=rule,
+                                                    column_name=excel_column_name(number), column_type='string',
+                                                    associated_of=rule is not self.random_rule)
+            for param in GenerateRuleParameter.objects.filter(rule_id__exact=rule.id):
+                data_set = self.dict_set if rule is self.fill_rule else self.string_set
+                DataParameter.objects.create(id=next(_ids), column_rule=column_rule, param_rule=param,
+                                             name=param.name, value='10',
+                                             data_set_id=data_set.id if param.name == 'data_set_id' else None)
+            if rule is self.fill_rule:
+                DataSetBind.objects.create(id=next(_ids), data_set=self.dict_set, column_rule=column_rule,
+                                           column_name=column_rule.column_name, data_name='mass')
+        return fr
+
+    def test_query_count_is_independent_of_column_number(self):
+        narrow, wide = self.create_requirement(3), self.create_requirement(50)
+        with self.assertNumQueries(4):
+            narrow_plan = compile_plan(narrow)
+        with self.assertNumQueries(4):
+            wide_plan = compile_plan(wide)
+        self.assertEqual(3, len(narrow_plan.columns))
+        self.assertEqual(50, len(wide_plan.columns))
+        # 按填入顺序排列
+        self.assertEqual(sorted(c.fill_order for c in wide_plan.columns), [c.fill_order for c in wide_plan.columns])
+        fill_column = next(c for c in wide_plan.columns if c.function_name == 'associated_fill')
+        self.assertEqual(({'mass': 158.54}, {'mass': 851.21}), fill_column.values)
+        self.assertEqual(((fill_column.column_name, 'mass'),), fill_column.binds)
+
+    def test_chunks_continue_across_boundaries(self):
+        fr = self.create_requirement(3)
+        DataParameter.objects.filter(column_rule__requirement=fr, name='stop').update(value='1000')
+        plan = compile_plan(fr)
+        whole = next(iter_fill_chunks(plan, plan.line_number))
+        chunks = list(iter_fill_chunks(plan, 3))
+        self.assertEqual([3, 3, 3, 1], [len(chunk['A']) for chunk in chunks])
+        for column in ('B', 'C'):
+            self.assertEqual(whole[column], [val for chunk in chunks for val in chunk[column]])
+
+    def test_plan_compiled_before_change_is_not_served(self):
+        fr = self.create_requirement(3)
+        version, plan = get_cached_plan(fr.id)
+        self.assertIsNone(plan)
+        plan = compile_plan(fr)
+        # 编译期间数据发生变化
+        invalidate_plan(fr.id)
+        store_plan(plan, version)
+        self.assertIsNone(get_cached_plan(fr.id)[1])
+
+    def test_lost_version_does_not_serve_old_plan(self):
+        fr = self.create_requirement(3)
+        load_plan(fr.id)
+        self.assertIsNotNone(get_cached_plan(fr.id)[1])
+        # 版本号被淘汰后以当前时间重新开始，不会回到旧计划的版本
+        time.sleep(0.002)
+        cache.delete(f'CacheVersion:GenerationPlan@{fr.id}')
+        self.assertIsNone(get_cached_plan(fr.id)[1])
+
+    def test_bump_versions_after_commit(self):
+        namespace = cache_namespace('DataSetValue', self.string_set.id)
+        DataSetValue.objects.create(id=next(_ids), data_set=self.string_set, item='x', data_type='string')
+        version = get_versions(namespace)
+        with self.captureOnCommitCallbacks() as callbacks:
+            DataSetValue.objects.filter(data_set=self.string_set).delete()
+        # 提交前其他请求读到的版本号不变，不会把被删除的数据缓存到新版本下
+        self.assertEqual(version, get_versions(namespace))
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(version, get_versions(namespace))
+
+    def test_bulk_delete_resolves_requirements_once(self):
+        fr = self.create_requirement(3)
+        load_plan(fr.id)
+        self.assertIsNotNone(get_cached_plan(fr.id)[1])
+        for item in range(20):
+            DataSetValue.objects.create(id=next(_ids), data_set=self.string_set, item=str(item), data_type='string')
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            DataSetValue.objects.filter(data_set=self.string_set).delete()
+        self.assertEqual(1, sum('"data_parameter"' in query['sql'] for query in queries.captured_queries))
+        self.assertIsNone(get_cached_plan(fr.id)[1])
+
+    @mock.patch('fills.service.create_jobs')
+    @mock.patch('fills.service.generate_excel')
+    def test_defer_checks_requirement_exists(self, generate_excel, create_jobs):
+        with self.assertRaises(ValueError):
+            defer_fill_excel(next(_ids), 'abc')
+        generate_excel.apply_async.assert_not_called()
+        fr = self.create_requirement(3)
+        defer_fill_excel(fr.id, 'abc')
+        generate_excel.apply_async.assert_called_once()
+        create_jobs.assert_called_once()
+
+    @mock.patch('fills.service.group')
+    def test_batch_submission_and_status(self, group):
+        client = FakeRedis()
+        config = dict(location='', ttl=60)
+        with mock.patch('fills.jobs._get_client', return_value=client), \
+                mock.patch('fills.jobs._get_config', return_value=config):
+            fr = self.create_requirement(3)
+            batch = defer_fill_excel_batch([(fr.id, None), (fr.id, 50)])
+            self.assertEqual([10, 50], [job['lineNumber'] for job in batch['items']])
+            group.return_value.apply_async.assert_called_once_with(task_id=batch['batchId'])
+            group.return_value.apply_async.return_value.save.assert_not_called()
+            first, second = (job['fileId'] for job in batch['items'])
+            start_job(first, 10)
+            add_rows(first, 10)
+            finish_job(first, ['abc.xlsx'])
+            start_job(second, 50)
+            add_rows(second, 20)
+            # 状态来自任务进度，不逐个读取 Celery 的结果
+            with mock.patch('fills.service.AsyncResult') as async_result:
+                status = get_batch_status(batch['batchId'])
+            async_result.assert_not_called()
+        self.assertEqual(('running', 1, 1), (status['status'], status['done'], status['running']))
+        self.assertEqual([('done', 10), ('running', 20)], [(item['status'], item['rows']) for item in status['items']])
+        with self.assertRaises(ValueError):
+            get_batch_status('missing')
+
+    def test_batch_size_limit(self):
+        with self.settings(GENERATE_BATCH_MAX_ITEMS=2):
+            items = GeneratesBatchView.resolve_items([1, dict(requirementId=2, lineNumber=100)])
+            self.assertEqual([(1, None), (2, 100)], items)
+            with self.assertRaises(ValueError):
+                GeneratesBatchView.resolve_items([1, 2, 3])
+        with self.assertRaises(ValueError):
+            GeneratesBatchView.resolve_items([dict(requirementId=1, lineNumber=0)])
+
+    @mock.patch('fills.service.create_jobs')
+    @mock.patch('fills.service.write_to_excel')
+    @mock.patch('fills.service.is_by_reference', return_value=True)
+    def test_pass_data_by_reference(self, is_by_reference, write_to_excel, create_jobs):
+        fr = self.create_requirement(3)
+        DataParameter.objects.filter(column_rule__requirement=fr, name='stop').update(value='1000')
+        client = FakeRedis()
+        with mock.patch('fills.payload._get_client', return_value=client):
+            fill_excel(fr.id, 'abc')
+            fill_data = write_to_excel.apply_async.call_args.kwargs['args'][0]
+            # 任务消息中只有数据的 key
+            self.assertNotIn('data', fill_data)
+            excel_data = load_payload(fill_data['dataKey'])
+            self.assertEqual(['A', 'B', 'C'], sorted(excel_data))
+            self.assertEqual([10, 10, 10], [len(data_list) for data_list in excel_data.values()])
+            remove_payload(fill_data['dataKey'])
+            with self.assertRaises(ValueError):
+                load_payload(fill_data['dataKey'])
+
+    def test_copies_use_own_generators(self):
+        fr = self.create_requirement(3)
+        DataParameter.objects.filter(column_rule__requirement=fr, name='stop').update(value='1000')
+        fill_data = build_fill_data(fr.id, 'abc', copies=3)
+        self.assertEqual(['abc', 'abc-2', 'abc-3'], [item['hashId'] for item in fill_data['copies']])
+        first, second = (item['data']['A'] for item in fill_data['copies'][:2])
+        self.assertEqual(10, len(first))
+        self.assertNotEqual(first, second)
+        with self.settings(GENERATE_MAX_COPIES=3):
+            self.assertEqual((3, True), GeneratesView.resolve_copies(dict(copies='3', archive='true')))
+            with self.assertRaises(ValueError):
+                GeneratesView.resolve_copies(dict(copies='4'))
+
+    def test_in_request_generation_keeps_row_limit(self):
+        fr = self.create_requirement(3)
+        FillingRequirement.objects.filter(pk=fr.pk).update(line_number=201)
+        with self.assertRaises(ValueError):
+            build_fill_data(fr.id, 'abc')
+        with self.settings(GENERATE_IN_WORKER=False):
+            self.assertFalse(FillingRequirementSerializer(fr, data=dict(line_number=201), partial=True).is_valid())
+        self.assertTrue(FillingRequirementSerializer(fr, data=dict(line_number=201), partial=True).is_valid())
+
+    @mock.patch('fills.service.create_jobs')
+    @mock.patch('fills.service.group')
+    def test_row_limit_per_write_engine(self, group, create_jobs):
+        fr = self.create_requirement(3)
+        with self.settings(FILL_MAX_LINE_NUMBER=1000, FILL_MAX_LINE_NUMBER_BY_ENGINE={'openpyxl': 100}):
+            # openpyxl 将整个工作簿放在内存中，上限更小
+            self.assertFalse(FillingRequirementSerializer(fr, data=dict(line_number=101), partial=True).is_valid())
+            data = dict(line_number=1000, write_engine='stream')
+            self.assertTrue(FillingRequirementSerializer(fr, data=data, partial=True).is_valid())
+            with self.assertRaises(ValueError):
+                defer_fill_excel_batch([(fr.id, 101)])
+            group.assert_not_called()
+            # 上限变化前保存的填充要求在生成时拒绝
+            FillingRequirement.objects.filter(pk=fr.pk).update(line_number=101)
+            invalidate_plan(fr.id)
+            with self.assertRaises(ValueError):
+                build_fill_stream(fr.id, 'abc')
+            FillingRequirement.objects.filter(pk=fr.pk).update(write_engine='xml')
+            invalidate_plan(fr.id)
+            self.assertEqual(101, build_fill_stream(fr.id, 'abc')[2])
+
+
+class CompileExpressionsTests(SimpleTestCase):
+
+    def test_evaluate_columns(self):
+        compiled = compile_expressions('{A} * {B} + 100')
+        self.assertEqual(('A', 'B'), compiled.variables)
+        column_data = {'A': ('10', '2', '3'), 'B': ('101', '0.5', '1.234'), 'C': ('x', 'y', 'z')}
+        self.assertEqual(['1110', '101.0', '103.7'], compiled.evaluate_columns(column_data, 3))
+
+    def test_reject_invalid_expressions(self):
+        for expressions in ('{A} + B', '{A}{B}', '({A} + 1', 'A.__class__'):
+            with self.assertRaises(ValueError):
+                compile_expressions(expressions)
+
+
+class BatchGeneratorTests(SimpleTestCase):
+
+    def test_random_numbers_in_range(self):
+        values = RandomNumberGenerator(5, 8).generate(1000)
+        self.assertEqual(1000, len(values))
+        self.assertTrue(all(isinstance(val, str) for val in values))
+        # 整数不包含结束值
+        self.assertEqual({'5', '6', '7'}, set(values))
+        decimals = [float(val) for val in RandomNumberGenerator('1.5', '3', 'true', '1').generate(1000)]
+        self.assertTrue(all(1.5 <= val <= 3 and round(val, 1) == val for val in decimals))
+        # 结束值小于起始值时交换
+        self.assertEqual({'3'}, set(RandomNumberGenerator(4, 3).generate(10)))
+
+    def test_values_continue_across_batches(self):
+        # 跨越 batch_iter 的多个批次
+        values = list(itertools.islice(random_number_iter(1, 3), 600))
+        self.assertEqual({'1', '2'}, set(values))
+        generator = ValueListGenerator(('a', 'b', 'c'))
+        self.assertEqual(['a', 'b', 'c', 'a', 'b', 'c', 'a'], generator.generate(4) + generator.generate(3))
+        generator = TimeSerialGenerator(repeat=3)
+        serials = generator.generate(4) + generator.generate(1) + generator.generate(5)
+        # 每个字符串连续重复 3 次，上一批未重复完的字符串在下一批继续
+        self.assertEqual([3, 3, 3, 1], [len(list(group)) for _, group in itertools.groupby(serials)])
+        self.assertEqual(4, len(set(serials)))
+
+
+class ParseByteRangeTests(SimpleTestCase):
+
+    def test_parse(self):
+        self.assertIsNone(parse_byte_range(None, 100))
+        self.assertIsNone(parse_byte_range('bytes=0-1,5-6', 100))
+        self.assertEqual((10, 19), parse_byte_range('bytes=10-19', 100))
+        self.assertEqual((90, 99), parse_byte_range('bytes=90-', 100))
+        self.assertEqual((95, 99), parse_byte_range('bytes=95-200', 100))
+        self.assertEqual((80, 99), parse_byte_range('bytes=-20', 100))
+
+    def test_unsatisfiable(self):
+        for header in ('bytes=100-', 'bytes=20-10', 'bytes=-0'):
+            with self.assertRaises(ValueError):
+                parse_byte_range(header, 100)
+
+
+class WriteWithStreamTests(SimpleTestCase):
+
+    def test_keep_other_sheets(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            template_path, save_path = pathlib.Path(tempdir) / 'template.xlsx', pathlib.Path(tempdir) / 'out.xlsx'
+            book = openpyxl.Workbook()
+            book.active.title = 'Main'
+            book.active['A1'] = 'title'
+            book.create_sheet('Other')['B2'] = 'other'
+            book.save(str(template_path))
+            write_with_stream(template_path, save_path, 2, ({'A': ['1', '2']},), 2)
+            book = openpyxl.load_workbook(str(save_path))
+            self.assertEqual(['Main', 'Other'], book.sheetnames)
+            self.assertEqual('Main', book.active.title)
+            self.assertEqual(['title', '1', '2'], [row[0] for row in book['Main'].iter_rows(values_only=True)])
+            self.assertEqual('other', book['Other']['B2'].value)
+
+
+class WriteWithXmlPatchTests(SimpleTestCase):
+
+    def test_patch_template_rows(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            template_path, save_path = pathlib.Path(tempdir) / 'template.xlsx', pathlib.Path(tempdir) / 'out.xlsx'
+            book = openpyxl.Workbook()
+            sheet = book.active
+            sheet['A1'] = 'name'
+            sheet['B1'] = 'age'
+            sheet['A1'].font = openpyxl.styles.Font(bold=True)
+            sheet['C2'] = 'kept'
+            sheet['A5'] = 'footer'
+            book.create_sheet('Other')['B2'] = 'other'
+            book.save(str(template_path))
+            chunks = ({'A': ['a1', 'a2'], 'B': ['1', '2']}, {'A': ['a3 '], 'B': ['<3>']})
+            # 每次只读取几个字节，标签跨越多次读取
+            with mock.patch('fills.xlsxpatch.SHEET_READ_SIZE', 7):
+                write_with_xml_patch(template_path, save_path, 2, chunks, 3)
+            book = openpyxl.load_workbook(str(save_path))
+            sheet = book.active
+            self.assertEqual([('name', 'age', None), ('a1', '1', 'kept'), ('a2', '2', None), ('a3 ', '<3>', None),
+                              ('footer', None, None)], list(sheet.iter_rows(values_only=True)))
+            self.assertTrue(sheet['A1'].font.bold)
+            self.assertEqual('@', sheet['B2'].number_format)
+            self.assertEqual('other', book['Other']['B2'].value)
+
+
+class TemplateCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.tmp_dir = pathlib.Path(tempdir.name)
+        self.etags = {}
+        self.storage = mock.Mock()
+        self.storage.stat_object.side_effect = lambda file_id, folder: mock.Mock(etag=self.etags[file_id])
+        self.storage.get_object_to_path.side_effect = self.download
+
+    def download(self, file_id, path, folder):
+        pathlib.Path(path).write_bytes(f'{file_id}:{self.etags[file_id]}'.ljust(100).encode())
+
+    def checkout(self, template_cache, file_id):
+        target_path = self.tmp_dir / f'{file_id}-{uuid.uuid4().hex}.xlsx'
+        hit = template_cache.checkout(self.storage, file_id, target_path)
+        return hit, target_path.read_bytes().decode().strip()
+
+    def test_reload_changed_template(self):
+        template_cache = TemplateCache(self.tmp_dir / 'cache', 1024)
+        self.etags['a'] = 'v1'
+        self.assertEqual((False, 'a:v1'), self.checkout(template_cache, 'a'))
+        self.assertEqual((True, 'a:v1'), self.checkout(template_cache, 'a'))
+        # 模板内容变化后 ETag 不同，重新下载
+        self.etags['a'] = 'v2'
+        self.assertEqual((False, 'a:v2'), self.checkout(template_cache, 'a'))
+        self.assertEqual(2, self.storage.get_object_to_path.call_count)
+        self.assertEqual(dict(hits=1, misses=2, evictions=0), template_cache.stats())
+
+    def test_evict_least_recently_used(self):
+        # 只能保存两个模板
+        template_cache = TemplateCache(self.tmp_dir / 'cache', 250)
+        self.etags.update(a='v1', b='v1', c='v1')
+        self.checkout(template_cache, 'a')
+        self.checkout(template_cache, 'b')
+        os.utime(template_cache.directory / 'a-v1.xlsx', (0, 0))
+        self.checkout(template_cache, 'c')
+        self.assertEqual(['b-v1.xlsx', 'c-v1.xlsx'], sorted(path.name for path in template_cache.directory.iterdir()))
+        self.assertEqual(1, template_cache.stats()['evictions'])
+        self.assertFalse(self.checkout(template_cache, 'a')[0])
+
+
+class SkeletonCacheTests(SimpleTestCase):
+
+    def test_evict_least_recently_used(self):
+        skeleton_cache = SkeletonCache(2)
+        loads = []
+        for key in ('a', 'b', 'a', 'c', 'a', 'b'):
+            skeleton_cache.get_or_load(key, lambda: loads.append(key) or key)
+        # 读取 a 后 b 最久未使用，放入 c 时淘汰 b
+        self.assertEqual(['a', 'b', 'c', 'b'], loads)
+        self.assertEqual(dict(hits=2, misses=4, size=2), skeleton_cache.stats())
+
+    def test_reload_changed_template(self):
+        skeleton_cache = SkeletonCache(4)
+        with tempfile.TemporaryDirectory() as tempdir, \
+                mock.patch('fills.writers.get_skeleton_cache', return_value=skeleton_cache):
+            template_path, save_path = pathlib.Path(tempdir) / 'template.xlsx', pathlib.Path(tempdir) / 'out.xlsx'
+            titles = []
+            # 第二次使用同一个模板文件
+            for title in ('v1', None, 'v2'):
+                if title:
+                    book = openpyxl.Workbook()
+                    book.active['A1'] = title
+                    book.save(str(template_path))
+                write_with_openpyxl(template_path, save_path, 2, ({'A': ['1']},), 1)
+                titles.append(openpyxl.load_workbook(str(save_path)).active['A1'].value)
+        # 内容相同的模板摘要不变，内容变化后重新解析
+        self.assertEqual(['v1', 'v1', 'v2'], titles)
+        self.assertEqual((1, 2), (skeleton_cache.hits, skeleton_cache.misses))
+
+
+class WriteCopiesTests(SimpleTestCase):
+
+    def setUp(self):
+        self.stored = {}
+        self.storage = mock.Mock()
+        self.storage.get_object_to_path.side_effect = self.download_template
+        self.storage.store_object_for_path.side_effect = self.store
+        for target, kwargs in (('get_storage', dict(return_value=self.storage)),
+                               ('get_template_cache', dict(return_value=None)), ('save_record', {})):
+            patcher = mock.patch(f'fills.tasks.{target}', **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def download_template(file_id, path, folder):
+        book = openpyxl.Workbook()
+        book.active['A1'] = 'title'
+        book.save(path)
+
+    def store(self, file_id, path, content_type):
+        self.stored[file_id] = (pathlib.Path(path).read_bytes(), content_type)
+
+    def write(self, archive):
+        fill_meta = dict(fileId='tpl', hashId='abc', requirementId=1, username='jack', filename='abc.xlsx',
+                         startLine=2, writeEngine='stream')
+        streams = [(copy_id, iter(({'A': [copy_id] * 3},))) for copy_id in copy_file_ids('abc', 2)]
+        return write_copies(fill_meta, streams, 3, archive)
+
+    def test_upload_each_copy(self):
+        filenames = self.write(False)
+        self.assertEqual(2, len(filenames))
+        self.assertEqual(['abc', 'abc-2'], list(self.stored))
+        self.storage.get_object_to_path.assert_called_once()
+        sheet = openpyxl.load_workbook(io.BytesIO(self.stored['abc-2'][0])).active
+        self.assertEqual(['title', 'abc-2', 'abc-2', 'abc-2'], [row[0] for row in sheet.iter_rows(values_only=True)])
+
+    def test_archive_copies(self):
+        filenames = self.write(True)
+        self.assertEqual(1, len(filenames))
+        self.assertTrue(filenames[0].endswith('.zip'))
+        content, content_type = self.stored['abc']
+        self.assertEqual('application/zip', content_type)
+        with zipfile.ZipFile(io.BytesIO(content)) as bundle:
+            self.assertEqual(['abc-1.xlsx', 'abc-2.xlsx'], bundle.namelist())
+
+
+class JobStatusTests(SimpleTestCase):
+
+    def setUp(self):
+        self.client = FakeRedis()
+        for target, kwargs in (('_get_client', dict(return_value=self.client)),
+                               ('_get_config', dict(return_value=dict(location='', ttl=60)))):
+            patcher = mock.patch(f'fills.jobs.{target}', **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_track_progress(self):
+        create_jobs((('abc', 7, 0),))
+        self.assertEqual(('queued', 7, 0), operator.itemgetter('status', 'requirementId', 'rows')(read_job('abc')))
+        start_job('abc', 20)
+        add_rows('abc', 5)
+        add_rows('abc', 5)
+        job = read_job('abc')
+        self.assertEqual(('running', 10, 20), (job['status'], job['rows'], job['total']))
+        finish_job('abc', ['abc.xlsx'])
+        job = get_job_status('abc')
+        self.assertEqual(('done', ['abc.xlsx']), (job['status'], job['filenames']))
+        self.assertIsNotNone(job['elapsed'])
+        # 每次更新都通知订阅者
+        self.assertEqual([job_channel('abc')] * 4, [channel for channel, _ in self.client.published])
+        self.assertEqual('done', self.client.published[-1][1])
+
+    def test_fall_back_to_task_state(self):
+        with mock.patch('fills.service.AsyncResult', return_value=mock.Mock(state=states.SUCCESS, result=False)):
+            self.assertEqual('failed', get_job_status('expired')['status'])
+        with mock.patch('fills.service.AsyncResult', return_value=mock.Mock(state=states.PENDING)):
+            with self.assertRaises(ValueError):
+                get_job_status('missing')
+
+
+class JobEventsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.client = FakeRedis()
+        self.token = str(AccessToken.for_user(User(id=1, username='jack')))
+
+    def events(self, query_string: bytes, steps=()):
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        async def receive():
+            await asyncio.sleep(60)
+            return dict(type='http.disconnect')
+
+        scope = dict(type='http', path='/fills/events/abc', query_string=query_string)
+        with mock.patch('fills.events._get_client', return_value=FakeAsyncRedis(self.client, steps)):
+            asyncio.run(job_events(scope, receive, send, 'abc'))
+        return sent
+
+    def test_reject_without_token(self):
+        self.assertEqual(401, self.events(b'')[0]['status'])
+        self.assertEqual(401, self.events(b'token=abc')[0]['status'])
+
+    def test_missing_job(self):
+        self.assertEqual(404, self.events(f'token={self.token}'.encode())[0]['status'])
+
+    def test_push_until_done(self):
+        self.client.hset(job_key('abc'), dict(status='running', requirementId=7, rows=0, total=20))
+        sent = self.events(f'token={self.token}'.encode(),
+                           (lambda: self.client.hset(job_key('abc'), dict(status='done', rows=20)),))
+        self.assertEqual(200, sent[0]['status'])
+        self.assertIn((b'content-type', b'text/event-stream; charset=utf-8'), sent[0]['headers'])
+        body = b''.join(message['body'] for message in sent[1:]).decode('utf-8')
+        self.assertEqual(['running', 'done'], re.findall(r'^event: (\w+)$', body, re.M))
+        self.assertIn('"rows": 20', body)
+        self.assertFalse(sent[-1]['more_body'])
+
+
+class PresignedUploadTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.storage = mock.Mock()
+        self.storage.presigned_put_url.return_value = 'http://localhost:9000/requirement/abc'
+        self.storage.stat_object.return_value = mock.Mock(size=1024, content_type=XLSX_CONTENT_TYPE)
+        self.tags = {}
+        self.storage.set_object_tags.side_effect = lambda file_id, tags, folder: self.tags.update({file_id: tags})
+        self.storage.get_object_tags.side_effect = lambda file_id, folder: dict(self.tags.get(file_id, {}))
+        patcher = mock.patch('fills.upload.get_storage', return_value=self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, magic):
+        stream = mock.MagicMock()
+        stream.__iter__.return_value = iter((magic,))
+        self.storage.open_object_stream.return_value = stream
+        return create_upload('jack')['fileId']
+
+    def test_complete_upload(self):
+        file_id = self.upload(XLSX_MAGIC)
+        serializer = FillingRequirementSerializer()
+        # 校验完成前不能被填充要求引用
+        with self.assertRaises(ValidationError):
+            serializer.validate_file_id(file_id)
+        with self.assertRaises(ValueError):
+            complete_upload(file_id, 'rose')
+        self.assertEqual(1024, complete_upload(file_id, 'jack')['size'])
+        self.assertEqual(file_id, serializer.validate_file_id(file_id))
+        self.storage.remove_object.assert_not_called()
+        # 服务端上传的文件不需要校验
+        self.assertEqual('abc', serializer.validate_file_id('abc'))
+
+    def test_reject_after_pending_expired(self):
+        file_id = self.upload(XLSX_MAGIC)
+        # 待校验的标记过期后，未完成校验的文件仍不能被引用，也不能再完成上传
+        cache.clear()
+        with self.assertRaises(ValidationError):
+            FillingRequirementSerializer().validate_file_id(file_id)
+        with self.assertRaises(ValueError):
+            complete_upload(file_id, 'jack')
+        # 客户端写入的标签没有正确的签名
+        self.tags[file_id] = {'validated': 'forged'}
+        with self.assertRaises(ValidationError):
+            FillingRequirementSerializer().validate_file_id(file_id)
+
+    def test_reject_invalid_upload(self):
+        file_id = self.upload(b'%PDF')
+        with self.assertRaises(ValueError):
+            complete_upload(file_id, 'jack')
+        self.storage.remove_object.assert_called_once()
+        self.storage.set_object_tags.assert_not_called()
+        with self.assertRaises(ValidationError):
+            FillingRequirementSerializer().validate_file_id(file_id)
+
+
+class ColumnGraphTests(SimpleTestCase):
+
+    def test_sort_levels(self):
+        edges = {'A': (), 'B': (), 'C': ('A', 'B'), 'D': ('C', 'A'), 'E': ('X',)}
+        levels = sort_levels(tuple(edges), lambda name: (name,), edges.get)
+        self.assertEqual((('A', 'B', 'E'), ('C',), ('D',)), levels)
+
+    def test_reject_cycle(self):
+        self.assertEqual(('C', 'A'), parse_dependencies('join_string', {'columns': 'C,A,C'}))
+        self.assertEqual(('A', 'B'), parse_dependencies('calculate_expressions', {'expressions': '{A} + {B} * {A}'}))
+        edges = {'A': (), 'B': ('D',), 'C': ('B',), 'D': ('C',)}
+        self.assertEqual(['B', 'D', 'C', 'B'], find_cycle(edges))
+        with self.assertRaises(ValueError):
+            sort_levels(tuple(edges), lambda name: (name,), edges.get)
+
+
+class ColumnStoreTests(SimpleTestCase):
+
+    def test_read_referenced_columns(self):
+        store = ColumnStore(('A', 'B', 'C'), 2)
+        store['C'] = ['c1', 'c2']
+        store['A'] = ['a1', 'a2']
+        # 按固定的列位置排列，未生成的列不出现
+        self.assertEqual(['A', 'C'], list(store))
+        self.assertEqual([('c1', 'a1'), ('c2', 'a2')], list(store.iter_rows(('C', 'A'))))
+        with self.assertRaises(KeyError):
+            list(store.iter_rows(('B',)))
+        self.assertEqual({'A': ['a1', 'a2'], 'C': ['c1', 'c2']}, dict(store))
+
+
+class RateLimitTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_limit_per_identity(self):
+        limiter = RateLimit('RateLimitTests', 3, 60)
+        self.assertEqual([True, True, True, False], [limiter.hit('user:1')[0] for _ in range(4)])
+        # 其他用户不受影响
+        self.assertTrue(limiter.hit('user:2')[0])
+
+
+class BulkDetailTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('jack'))
+        rule = GenerateRule.objects.create(id=next(_ids), rule_name='fixed', function_name='fixed_value_iter',
+                                           fill_order=1, description='fixed')
+        fr = FillingRequirement.objects.create(id=next(_ids), username='jack', file_id=str(next(_ids)),
+                                               original_filename='abc.xlsx', start_line=2, line_number=10)
+        self.ids = [ColumnRule.objects.create(id=next(_ids), requirement=fr, rule=rule, column_name=name,
+                                              column_type='string').id for name in ('A', 'B', 'C')]
+
+    def bulk(self, ids):
+        return self.client.get('/fills/columnRule/bulk', dict(ids=','.join(str(pk) for pk in ids)))
+
+    def test_report_missing_ids(self):
+        response = self.bulk(self.ids[:2] + [404])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.ids[:2], [item['id'] for item in response.data['data']])
+        self.assertEqual([404], response.data['missing'])
+
+    def test_reject_too_many_ids(self):
+        with self.settings(BULK_DETAIL_MAX_IDS=2):
+            response = self.bulk(self.ids)
+        self.assertEqual(500, response.status_code)
+        self.assertIn('最多查询 2 条', response.json()['message'])
+
+    def test_share_cache_with_detail(self):
+        with self.assertNumQueries(1):
+            data = self.bulk(self.ids).data['data']
+        with self.assertNumQueries(0):
+            self.assertEqual(data, self.bulk(self.ids).data['data'])
+            self.assertEqual(data[1], self.client.get(f'/fills/columnRule/{self.ids[1]}').data)
+
+
+class GetOrQueryTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_cache_empty_result(self):
+        calls = []
+
+        def query():
+            calls.append(1)
+            return []
+
+        self.assertEqual([], get_or_query('GetOrQueryTests:empty', query))
+        self.assertEqual([], get_or_query('GetOrQueryTests:empty', query))
+        self.assertEqual(1, len(calls))
+
+    def test_keep_lock_acquired_by_other_request(self):
+        def query():
+            # 查询超过锁的时间，锁过期后被其他请求获得
+            cache.set('GetOrQueryTests:slow:lock', 42)
+            return 'slow'
+
+        self.assertEqual('slow', get_or_query('GetOrQueryTests:slow', query))
+        self.assertEqual(42, cache.get('GetOrQueryTests:slow:lock'))
+
+    def test_query_without_lock_after_wait_timeout(self):
+        cache.set('GetOrQueryTests:wait:lock', 42)
+        with mock.patch('fills.cache.LOCK_WAIT_SECONDS', 0.05):
+            self.assertEqual('waited', get_or_query('GetOrQueryTests:wait', lambda: 'waited'))
+        self.assertEqual(42, cache.get('GetOrQueryTests:wait:lock'))
+
+
+class LocalCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_invalidate_other_process(self):
+        loads = []
+        # 模拟两个进程中同一命名空间的缓存
+        first, second = (LocalCache('LocalCacheTests', 8, 60, 0) for _ in range(2))
+        for local_cache in (first, second, first, second):
+            local_cache.get('key', lambda: loads.append(1) or len(loads))
+        self.assertEqual(2, len(loads))
+        self.assertEqual(dict(hits=1, misses=1, size=1), second.stats())
+        first.invalidate()
+        self.assertEqual(3, second.get('key', lambda: 3))
+
+    def test_skip_value_loaded_before_invalidate(self):
+        local_cache = LocalCache('LocalCacheTests', 8, 60, 60)
+
+        def loader():
+            # 读取期间数据发生变化
+            local_cache.invalidate()
+            return 'old'
+
+        self.assertEqual('old', local_cache.get('key', loader))
+        self.assertEqual('new', local_cache.get('key', lambda: 'new'))
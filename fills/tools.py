@@ -1,10 +1,22 @@
+import ast
 import datetime
 import functools
 import itertools
-import random
 import re
 import threading
 
+import numpy as np
+
+# 表达式允许的字符
+_EXPRESSIONS_PATTERN = re.compile('^[0-9A-Z-+*/.{}() ]+$')
+# 表达式中的变量，如 {A}
+_VARIABLE_PATTERN = re.compile(r"\{([A-Z]+)\}")
+# 表达式编译后变量的前缀，避免与未加括号的列名混淆
+_VARIABLE_PREFIX = '_col_'
+# 表达式允许的语法节点
+_ALLOWED_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.Name, ast.Load,
+                  ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Pow, ast.UAdd, ast.USub)
+
 
 def fixed_value_iter(fixed_value):
     """固定值"""
@@ -31,22 +43,7 @@ def random_number_iter(start=1, stop=42, is_decimal=False, ndigits=2):
     :param is_decimal 是否包含小数位
     :param ndigits 小数位数
     """
-    if any((isinstance(is_decimal, str) and is_decimal.lower() == 'true',
-            isinstance(is_decimal, bool) and is_decimal)):
-        start, stop, ndigits = max(1.0, float(start)), max(2.0, float(stop)), max(0, int(ndigits))
-        if stop < start:
-            start, stop = stop, start
-        # 冻结参数
-        func = functools.partial(_random_decimal, start, stop, ndigits)
-    else:
-        start, stop = max(1, int(start)), max(1, int(stop))
-        if stop < start:
-            start, stop = stop, start
-        # 冻结参数
-        func = functools.partial(random.randrange, start, stop)
-    while True:
-        # 数值转为字符串
-        yield str(func())
+    return batch_iter(RandomNumberGenerator(start, stop, is_decimal, ndigits))
 
 
 def time_serial_iter(repeat=1):
@@ -54,14 +51,112 @@ def time_serial_iter(repeat=1):
 
     :param repeat 每个字符串的重复次数
     """
-    repeat = max(1, int(repeat))
-    now = datetime.datetime.now()
-    prefix = now.strftime('%Y%m%d-%H%M%S')
-    c = itertools.count(1)
+    return batch_iter(TimeSerialGenerator(repeat))
+
+
+def batch_iter(generator, batch_size=256):
+    """将批量生成器包装为逐个取值的迭代器
+
+    :param generator 有 generate(n) 方法的批量生成器
+    :param batch_size 每批生成的数量
+    """
     while True:
-        s = f'{prefix}-{next(c)}-{random.randrange(100, 999)}'
-        for _ in range(repeat):
-            yield s
+        yield from generator.generate(batch_size)
+
+
+class FixedValueGenerator:
+    """固定值"""
+    __slots__ = ('fixed_value',)
+
+    def __init__(self, fixed_value):
+        self.fixed_value = fixed_value
+
+    def generate(self, n):
+        return [self.fixed_value] * n
+
+
+class ValueListGenerator:
+    """特定的字符串数组，按顺序循环取值"""
+    __slots__ = ('values', 'position')
+
+    def __init__(self, values, position=0):
+        """
+        :param values 字符串数组
+        :param position 开始取值的位置
+        """
+        self.values = tuple(values)
+        self.position = position
+
+    def generate(self, n):
+        size = len(self.values)
+        if not size:
+            return [None] * n
+        offset = self.position % size
+        self.position += n
+        # 复制足够的整轮数据后截取
+        return list((self.values * ((offset + n) // size + 1))[offset:offset + n])
+
+
+class RandomNumberGenerator:
+    """范围随机整数或小数，一次生成整批数值"""
+    __slots__ = ('start', 'stop', 'is_decimal', 'ndigits', 'rng')
+
+    def __init__(self, start=1, stop=42, is_decimal=False, ndigits=2):
+        """
+        :param start 起始值
+        :param stop 结束值
+        :param is_decimal 是否包含小数位
+        :param ndigits 小数位数
+        """
+        self.is_decimal = any((isinstance(is_decimal, str) and is_decimal.lower() == 'true',
+                               isinstance(is_decimal, bool) and is_decimal))
+        if self.is_decimal:
+            start, stop, ndigits = max(1.0, float(start)), max(2.0, float(stop)), max(0, int(ndigits))
+        else:
+            start, stop = max(1, int(start)), max(1, int(stop))
+        if stop < start:
+            start, stop = stop, start
+        self.start, self.stop, self.ndigits = start, stop, ndigits
+        self.rng = np.random.default_rng()
+
+    def generate(self, n):
+        if self.is_decimal:
+            values = np.round(self.rng.uniform(self.start, self.stop, n), self.ndigits)
+        else:
+            values = self.rng.integers(self.start, self.stop, n)
+        # 数值转为 Python 对象后再转为字符串，比 numpy 直接转为字符串快
+        return list(map(str, values.tolist()))
+
+
+class TimeSerialGenerator:
+    """日期时间组成的字符串，一次生成整批序号"""
+    __slots__ = ('prefix', 'repeat', 'position', 'last_serial', 'rng')
+
+    def __init__(self, repeat=1):
+        """
+        :param repeat 每个字符串的重复次数
+        """
+        self.repeat = max(1, int(repeat))
+        self.prefix = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        self.position = 0
+        # 跨批次时未重复完的字符串
+        self.last_serial = None
+        self.rng = np.random.default_rng()
+
+    def generate(self, n):
+        if n <= 0:
+            return []
+        first, last = self.position // self.repeat + 1, (self.position + n - 1) // self.repeat + 1
+        # 与上一批最后一个序号相同时沿用上一批的字符串
+        start = first + 1 if self.last_serial and first == self.last_serial[0] else first
+        suffixes = self.rng.integers(100, 999, last - start + 1).tolist()
+        serials = dict(((i, f'{self.prefix}-{i}-{r}') for i, r in zip(range(start, last + 1), suffixes)))
+        if start != first:
+            serials[first] = self.last_serial[1]
+        values = [serials[i // self.repeat + 1] for i in range(self.position, self.position + n)]
+        self.position += n
+        self.last_serial = (last, serials[last])
+        return values
 
 
 def join_string(columns, value_dict, delimiter=None):
@@ -82,21 +177,81 @@ def calculate_expressions(expressions, value_dict):
     :param expressions 表达式
     :param value_dict 单元格列对应的值
     """
-    # 先校验正确性
-    if str(expressions) and not validate_expressions(expressions):
-        raise ValueError('expressions is invalid, allow character: 0-9 A-Z +-*/. [space] {} ()')
     # 如果传入的值都是空的直接返回空
     if isinstance(value_dict, dict) and not len(value_dict):
         return None
-    # 填入实际的单元格值
-    compiled_expressions = _replace_expressions_variable(expressions, value_dict)
-    # 利用内置的方法执行计算
-    # 返回的数值转为字符串
-    result = eval(compiled_expressions)
-    if isinstance(result, (int, float)):
-        # 保留 2 位小数
-        result = round(result, 2)
-    return str(result)
+    return compile_expressions(expressions).evaluate(value_dict)
+
+
+class CompiledExpressions:
+    """预编译的表达式
+
+    表达式只解析一次，变量按顺序绑定为函数参数，整列计算时不再逐行替换字符串和调用 eval
+    """
+    __slots__ = ('expressions', 'variables', 'function')
+
+    def __init__(self, expressions, variables, function):
+        self.expressions = expressions
+        # 表达式引用的列名，与函数参数的顺序一致
+        self.variables = variables
+        self.function = function
+
+    def evaluate(self, value_dict):
+        """计算单行的值
+
+        :param value_dict 单元格列对应的值
+        """
+        args = (_to_number(_get_variable(value_dict, v)) for v in self.variables)
+        return _format_result(self.function(*args))
+
+    def evaluate_columns(self, column_data, length):
+        """整列计算
+
+        :param column_data 单元格列对应的整列值
+        :param length 计算的行数
+        """
+        if not self.variables:
+            return [_format_result(self.function())] * length
+        columns = (map(_to_number, _get_variable(column_data, v)[:length]) for v in self.variables)
+        return list(map(_format_result, map(self.function, *columns)))
+
+
+def expression_variables(expressions):
+    """表达式中引用的列名，按首次出现的顺序去重
+
+    :param expressions 表达式，如 {A} * {B} + 100
+    """
+    return tuple(dict.fromkeys(_VARIABLE_PATTERN.findall(expressions)))
+
+
+@functools.lru_cache(maxsize=256)
+def compile_expressions(expressions) -> CompiledExpressions:
+    """编译表达式，如 {A} * {B} + 100
+
+    :param expressions 表达式
+    """
+    if not validate_expressions(expressions):
+        raise ValueError('expressions is invalid, allow character: 0-9 A-Z +-*/. [space] {} ()')
+    variables = expression_variables(expressions)
+    source = _VARIABLE_PATTERN.sub(lambda m: _VARIABLE_PREFIX + m.group(1), expressions)
+    try:
+        tree = ast.parse(source.strip(), mode='eval')
+    except SyntaxError:
+        raise ValueError(f'表达式语法不正确: {expressions}')
+    names = set(_VARIABLE_PREFIX + v for v in variables)
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise ValueError(f'表达式包含不支持的运算: {expressions}')
+        if isinstance(node, ast.Name) and node.id not in names:
+            raise ValueError(f'表达式的变量必须用大括号包裹: {expressions}')
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError(f'表达式只允许数值常量: {expressions}')
+    # 以变量为参数包装为 lambda 编译为字节码
+    args = ast.arguments(posonlyargs=[], args=[ast.arg(arg=_VARIABLE_PREFIX + v) for v in variables],
+                         kwonlyargs=[], kw_defaults=[], defaults=[])
+    lambda_tree = ast.fix_missing_locations(ast.Expression(body=ast.Lambda(args=args, body=tree.body)))
+    function = eval(compile(lambda_tree, '<expressions>', 'eval'), {'__builtins__': {}})
+    return CompiledExpressions(expressions, variables, function)
 
 
 def associated_fill(key_map_list: tuple, value_dict: dict):
@@ -109,47 +264,44 @@ def associated_fill(key_map_list: tuple, value_dict: dict):
         yield column, value_dict.get(name, None)
 
 
-def _random_decimal(start, stop, ndigits):
-    """经过包装的随机范围小数生成"""
-    return round(random.uniform(start, stop), ndigits)
-
-
-def _replace_expressions_variable(expressions, value_dict):
-    """利用正则表达式的方法将变量替换为实际的值
+def _get_variable(value_dict, name):
+    """读取表达式变量对应的值"""
+    try:
+        return value_dict[name]
+    except KeyError:
+        raise ValueError(f'表达式引用的列 "{name}" 没有数据')
 
-    如 A = 10, B = 101
 
-    {A} * {B} + 100  --->  10 * 101 + 100
-    """
-    pattern = re.compile(r"\{([A-Z]+)\}")
+def _to_number(value):
+    """单元格的值转为数值"""
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return float(value)
 
-    def inner_data_get(match):
-        val = value_dict.get(match.group(1), match.group(0))
-        # 正则替换的数据类型必须是字符串
-        return val
 
-    return pattern.sub(inner_data_get, expressions)
+def _format_result(result):
+    """计算结果转为字符串"""
+    if isinstance(result, (int, float)):
+        # 保留 2 位小数
+        result = round(result, 2)
+    return str(result)
 
 
 def try_calculate_expressions(expressions):
     """尝试填入1来计算表达式"""
-    pattern = re.compile(r"\{([A-Z]+)\}")
-
-    def inner_data_get(_):
-        return '1'
-
-    expressions = pattern.sub(inner_data_get, expressions)
-
     try:
-        eval(expressions)
+        compiled = compile_expressions(expressions)
+        compiled.function(*(1 for _ in compiled.variables))
     except Exception:
         raise ValueError('表达式计算验证失败')
 
 
 def validate_expressions(text):
     """校验表达式包含的字符是否符合要求"""
-    valid = re.compile('^[0-9A-Z-+*/.{}() ]+$')
-    if valid.match(text):
+    if _EXPRESSIONS_PATTERN.match(text):
         return True
     else:
         return False
@@ -0,0 +1,108 @@
+import datetime
+import logging
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signing import Signer
+
+from .storage import XLSX_CONTENT_TYPE, get_storage
+from .timeunit import dc
+
+log = logging.getLogger(__name__)
+
+# xlsx 是 zip 文件，以本地文件头开始
+XLSX_MAGIC = b'PK\x03\x04'
+# 模板文件存放的文件夹
+UPLOAD_FOLDER = 'requirement'
+# 直接上传的文件ID前缀，用于区分服务端上传的文件
+PRESIGNED_PREFIX = 'p'
+# 校验通过后写入文件的标签，值为文件ID的签名，客户端无法伪造
+VALIDATED_TAG = 'validated'
+
+_signer = Signer(salt='fills.upload')
+
+
+def _pending_key(file_id):
+    return f'PresignedUpload:{file_id}'
+
+
+def create_upload(username):
+    """创建直接上传到对象存储的临时地址
+
+    上传完成前文件标记为待校验，只有校验通过、带有签名标签的文件才能被填充要求引用
+
+    :param username 上传的用户
+    :return 文件ID、上传地址和过期时间
+    """
+    expires = datetime.timedelta(seconds=settings.PRESIGNED_URL_EXPIRES)
+    file_id = PRESIGNED_PREFIX + uuid.uuid1().hex
+    url = get_storage(retry=0).presigned_put_url(file_id, expires, folder=UPLOAD_FOLDER)
+    # 标记保留 1 天，超过后未完成的上传视为放弃
+    cache.set(_pending_key(file_id), username, dc.days.to_seconds(1))
+    log.info(f'<PresignedUpload> create upload: {file_id}')
+    return dict(fileId=file_id, url=url, contentType=XLSX_CONTENT_TYPE,
+                expiresAt=datetime.datetime.now() + expires)
+
+
+def is_presigned_upload(file_id):
+    """文件是否通过上传地址直接上传
+
+    :param file_id 文件ID
+    """
+    return len(file_id) == len(PRESIGNED_PREFIX) + 32 and file_id.startswith(PRESIGNED_PREFIX)
+
+
+def is_upload_validated(file_id):
+    """直接上传的文件是否已通过校验
+
+    以文件的签名标签为准，不依赖会过期或被淘汰的缓存；读取标签失败时视为未校验
+
+    :param file_id 文件ID
+    """
+    try:
+        tags = get_storage(retry=0).get_object_tags(file_id, folder=UPLOAD_FOLDER)
+    except Exception as e:
+        log.error('读取上传文件标签异常' + str(e))
+        return False
+    return tags.get(VALIDATED_TAG, None) == _signer.signature(file_id)
+
+
+def complete_upload(file_id, username):
+    """校验直接上传的文件，校验不通过时删除文件
+
+    :param file_id 文件ID
+    :param username 上传的用户
+    """
+    key = _pending_key(file_id)
+    if cache.get(key, None) != username:
+        raise ValueError('上传记录不存在或已过期')
+    storage = get_storage(retry=0)
+    try:
+        stat = storage.stat_object(file_id, folder=UPLOAD_FOLDER)
+    except Exception as e:
+        log.error('读取上传文件异常' + str(e))
+        raise ValueError('未找到上传的文件，请上传后再试')
+    error = None
+    if stat.size <= len(XLSX_MAGIC) or stat.size > settings.PRESIGNED_UPLOAD_MAX_SIZE:
+        error = '上传文件的大小不符合要求'
+    elif stat.content_type != XLSX_CONTENT_TYPE:
+        error = '上传文件的内容类型必须是 xlsx'
+    else:
+        # 只读取文件开头的几个字节
+        stream = storage.open_object_stream(file_id, folder=UPLOAD_FOLDER, length=len(XLSX_MAGIC))
+        try:
+            magic = b''.join(stream)
+        finally:
+            stream.close()
+        if magic != XLSX_MAGIC:
+            error = '上传文件不是有效的 xlsx 文件'
+    if error:
+        storage.remove_object(file_id, folder=UPLOAD_FOLDER)
+        cache.delete(key)
+        log.info(f'<PresignedUpload> reject upload: {file_id}, {error}')
+        raise ValueError(error)
+    storage.set_object_tags(file_id, {VALIDATED_TAG: _signer.signature(file_id)}, folder=UPLOAD_FOLDER)
+    cache.delete(key)
+    log.info(f'<PresignedUpload> complete upload: {file_id}')
+    return dict(fileId=file_id, size=stat.size, createdAt=datetime.datetime.now())
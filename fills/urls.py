@@ -8,16 +8,24 @@ urlpatterns = (
     path("", views.IndexView.as_view(), name="index"),
     # 填充表格
     path("<int:requirement_id>", views.GeneratesView.as_view(), name="generates"),
+    path("job/<str:file_id>", views.GeneratesJobView.as_view(), name="generates_job"),
+    path("batch", views.GeneratesBatchView.as_view(), name="generates_batch"),
+    path("batch/<str:batch_id>", views.GeneratesBatchDetail.as_view(), name="generates_batch_detail"),
     path("upload", views.FileUploadView.as_view(), name="upload"),
+    path("upload/presigned", views.PresignedUploadView.as_view(), name="presigned_upload"),
+    path("upload/presigned/<str:file_id>", views.PresignedUploadCompleteView.as_view(),
+         name="presigned_upload_complete"),
     # 填充要求
     path("requirement", views.FillingRequirementList.as_view(), {'format': 'json'}, name="requirement"),
     path("requirement/<int:pk>", views.FillingRequirementDetail.as_view(), name="requirement_detail"),
     # 列规则
     path("columnRule", views.ColumnRuleList.as_view(), {'format': 'json'}, name="column_rule"),
     path("columnRule/<int:pk>", views.ColumnRuleDetail.as_view(), name="column_rule_detail"),
+    path("columnRule/bulk", views.ColumnRuleBulkDetail.as_view(), name="column_rule_bulk_detail"),
     # 列规则参数
     path("dataParameter", views.DataParameterList.as_view(), {'format': 'json'}, name="data_parameter"),
     path("dataParameter/<int:pk>", views.DataParameterDetail.as_view(), name="data_parameter_detail"),
+    path("dataParameter/bulk", views.DataParameterBulkDetail.as_view(), name="data_parameter_bulk_detail"),
     # 数据集
     path("dataSet", views.DataSetList.as_view(), {'format': 'json'}, name="data_set"),
     path("dataSet/<int:pk>", views.DataSetDetail.as_view(), name="data_set_detail"),
@@ -30,9 +38,11 @@ urlpatterns = (
     # 数据集绑定
     path("dataSetBind", views.DataSetBindList.as_view(), {'format': 'json'}, name="data_set_bind"),
     path("dataSetBind/<int:pk>", views.DataSetBindDetail.as_view(), name="data_set_bind_detail"),
+    path("dataSetBind/bulk", views.DataSetBindBulkDetail.as_view(), name="data_set_bind_bulk_detail"),
     # 文件生成记录
     path("fileRecord", views.FileRecordList.as_view(), {'format': 'json'}, name="file_record"),
     path("fileRecord/<int:pk>", views.FileRecordDetail.as_view(), name="file_record_detail"),
+    path("fileRecord/<int:pk>/url", views.FileRecordUrlView.as_view(), name="file_record_url"),
     # 生成规则
     path("generateRule", views.GenerateRuleList.as_view(), {'format': 'json'}, name="generate_rule"),
     path("generateRule/<int:pk>", views.GenerateRuleDetail.as_view(), name="generate_rule_detail"),
@@ -1,15 +1,16 @@
 import datetime
-import io
 import logging
 import re
 import time
 import typing
 import uuid
+from urllib.parse import quote
 
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.cache import cache
 from django.core.paginator import Paginator
-from django.http import FileResponse, QueryDict
+from django.db import models
+from django.http import HttpResponse, QueryDict, StreamingHttpResponse
 from django.views import generic
 from rest_framework import permissions, status
 from rest_framework.parsers import MultiPartParser, FormParser
@@ -18,7 +19,7 @@ from rest_framework.response import Response
 from rest_framework.serializers import Serializer
 from rest_framework.views import APIView
 
-from .cache import cache_evict, cacheable, CacheManager
+from .cache import cache_evict, cache_namespace, cacheable, get_many_or_query, CacheManager
 from .models import DataSet, DataSetDefine, DataSetValue, DataSetBind
 from .models import FillingRequirement, GenerateRule, GenerateRuleParameter, ColumnRule, DataParameter, FileRecord
 from .serializers import DataSetSerializer, DataSetDefineSerializer, DataSetValueSerializer, DataSetBindSerializer
@@ -26,9 +27,12 @@ from .serializers import FileUploadSerializer, FileRecordSerializer
 from .serializers import FillingRequirementSerializer, ColumnRuleSerializer, DataParameterSerializer
 from .serializers import GenerateRuleSerializer, GenerateRuleParameterSerializer
 from .serializers import UserSerializer
-from .service import fill_excel
-from .storage import Storage
+from .service import defer_fill_excel_batch, get_batch_status, get_job_status
+from .service import copy_file_ids, fill_excel, defer_fill_excel, validate_column_dependencies
+from .ratelimit import rate_limit
+from .storage import XLSX_CONTENT_TYPE, get_storage
 from .timeunit import dc
+from .upload import complete_upload, create_upload
 from .tools import is_basic_ascii_visible
 from .tools import run_in_thread
 from .tools import try_calculate_expressions
@@ -36,6 +40,8 @@ from .tools import validate_expressions
 
 log = logging.getLogger(__name__)
 
+_BYTE_RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
 
 # Create your views here.
 class UserView(APIView):
@@ -75,15 +81,9 @@ class UserCreateView(APIView):
         else:
             return Response(headers={'USER-EXISTS': 'FALSE'})
 
+    # 每个地址 10 分钟内 30 次操作
+    @rate_limit('UserCreateView:UserCreateLimit', 30, dc.minutes.to_seconds(10))
     def post(self, request):
-        limit_cache_key = 'UserCreateView:UserCreateLimit'
-        request_count = cache.get(limit_cache_key, 0)
-
-        if request_count >= 30:
-            raise ValueError('您的操作频率太快，请稍后再试！')
-        # 10 分钟内 30 次操作
-        cache.set(limit_cache_key, request_count + 1, dc.minutes.to_seconds(10))
-
         name: str = request.data['username']
         passwd: str = request.data['password']
         if not name or not len(name.strip()):
@@ -145,7 +145,42 @@ class PagingViewMixin:
         return response_data
 
 
-class FillingRequirementList(APIView, PagingViewMixin):
+class BulkDetailView(APIView):
+    """
+    按多个ID查询，如 ?ids=1,2,3，每条数据与单个查询的响应相同并共用缓存
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    model: typing.Type[models.Model] = None
+    serializer_class: typing.Type[Serializer] = None
+    # 单个查询的视图类名和命名空间
+    detail_view_name: str = None
+    namespace: str = None
+
+    def get(self, request: Request, format=None):
+        ids = self.resolve_ids(request.query_params.get('ids', None))
+
+        def query(pks):
+            return dict(((obj.pk, self.serializer_class(obj).data) for obj in self.model.objects.filter(pk__in=pks)))
+
+        found = get_many_or_query(self.detail_view_name, ids, query, self.namespace)
+        return Response(dict(data=[found[pk] for pk in ids if pk in found],
+                             missing=[pk for pk in ids if pk not in found]))
+
+    @staticmethod
+    def resolve_ids(ids):
+        """解析以英文逗号拼接的ID，去掉重复的ID"""
+        if not ids:
+            raise ValueError('必须传ID参数')
+        try:
+            ids = list(dict.fromkeys(int(pk) for pk in ids.split(',') if pk.strip()))
+        except ValueError:
+            raise ValueError('ID必须是以英文逗号拼接的数字')
+        if len(ids) > settings.BULK_DETAIL_MAX_IDS:
+            raise ValueError(f'每次最多查询 {settings.BULK_DETAIL_MAX_IDS} 条数据')
+        return ids
+
+
+class FillingRequirementList(APIView, PagingViewMixin, CacheManager):
     """
     生成要求: 查询所有/新增
     """
@@ -158,8 +193,15 @@ class FillingRequirementList(APIView, PagingViewMixin):
             ('remark__contains', 'remark'),
             ('original_filename__contains', 'original_filename')
         ))
-        requirement = FillingRequirement.objects.filter(**query).order_by('-id').values()
-        data = self.paging(requirement, query_params, FillingRequirementSerializer)
+
+        def query_page():
+            requirement = FillingRequirement.objects.filter(**query).order_by('-id').values()
+            return self.paging(requirement, query_params, FillingRequirementSerializer)
+
+        # 按用户查询时只在该用户的数据变化后失效
+        namespace = cache_namespace('FillingRequirement', query.get('username__exact', None))
+        key = self.params_key(query_params, ('username', 'remark', 'original_filename', 'page', 'size'))
+        data = self.get_cache(key, query_page, (namespace,))
         return Response(data)
 
     def post(self, request: Request, format=None):
@@ -183,7 +225,7 @@ class FillingRequirementDetail(APIView):
         except FillingRequirement.DoesNotExist:
             raise ValueError('未查询到对应数据')
 
-    @cacheable('pk')
+    @cacheable('pk', namespace='FillingRequirement')
     def get(self, request, pk):
 
         requirement = self.get_object(pk)
@@ -191,7 +233,7 @@ class FillingRequirementDetail(APIView):
 
         return Response(serializer.data)
 
-    @cache_evict('pk')
+    @cache_evict('pk', namespace='FillingRequirement')
     def put(self, request, pk):
         requirement = self.get_object(pk)
         serializer = FillingRequirementSerializer(requirement, data=request.data)
@@ -200,7 +242,7 @@ class FillingRequirementDetail(APIView):
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    @cache_evict('pk')
+    @cache_evict('pk', namespace='FillingRequirement')
     def delete(self, request, pk):
         requirement = self.get_object(pk)
         requirement.delete()
@@ -211,14 +253,14 @@ class FillingRequirementDetail(APIView):
     @staticmethod
     def delete_requirement_file(file_id):
         try:
-            storage = Storage(retry=0)
+            storage = get_storage(retry=0)
             storage.remove_object(file_id, 'requirement')
             log.info(f'填充要求的关联文件已删除: {file_id}')
         except Exception as e:
             log.error("填充要求的关联文件删除异常:" + str(e))
 
 
-class ColumnRuleList(APIView, PagingViewMixin):
+class ColumnRuleList(APIView, PagingViewMixin, CacheManager):
     """
     列规则: 查询所有/新增
     """
@@ -233,8 +275,13 @@ class ColumnRuleList(APIView, PagingViewMixin):
         column_name = query_params.get('column_name', None)
         if column_name:
             query['column_name__iexact'] = column_name
-        column_rule = ColumnRule.objects.filter(**query).order_by('-id').values()
-        data = self.paging(column_rule, query_params, ColumnRuleSerializer)
+
+        def query_page():
+            column_rule = ColumnRule.objects.filter(**query).order_by('-id').values()
+            return self.paging(column_rule, query_params, ColumnRuleSerializer)
+
+        key = self.params_key(query_params, ('requirement_id', 'column_name', 'page', 'size'))
+        data = self.get_cache(key, query_page, (cache_namespace('ColumnRule', int(requirement_id)),))
         return Response(data)
 
     def post(self, request: Request, format=None):
@@ -263,7 +310,7 @@ class ColumnRuleDetail(APIView):
         except ColumnRule.DoesNotExist:
             raise ValueError('未查询到对应数据')
 
-    @cacheable('pk')
+    @cacheable('pk', namespace='ColumnRule')
     def get(self, request, pk):
 
         column_rule = self.get_object(pk)
@@ -271,7 +318,7 @@ class ColumnRuleDetail(APIView):
 
         return Response(serializer.data)
 
-    @cache_evict('pk')
+    @cache_evict('pk', namespace='ColumnRule')
     def put(self, request, pk):
         # 同一个填充要求中存在列名重复判断
         column_name = request.data['column_name']
@@ -285,13 +332,23 @@ class ColumnRuleDetail(APIView):
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    @cache_evict('pk')
+    @cache_evict('pk', namespace='ColumnRule')
     def delete(self, request, pk):
         column_rule = self.get_object(pk)
         column_rule.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class ColumnRuleBulkDetail(BulkDetailView):
+    """
+    列规则: 按多个ID查询
+    """
+    model = ColumnRule
+    serializer_class = ColumnRuleSerializer
+    detail_view_name = 'ColumnRuleDetail'
+    namespace = 'ColumnRule'
+
+
 class DataParameterList(APIView, PagingViewMixin):
     """
     填充函数参数: 查询所有/新增
@@ -311,6 +368,7 @@ class DataParameterList(APIView, PagingViewMixin):
         # 部分规则参数必要校验
         for data_param in request.data:
             self.validate_parameter_related_columns(data_param)
+        self.validate_dependencies(request.data)
         serializer = DataParameterSerializer(data=request.data, many=True)
         if serializer.is_valid():
             # 删除旧的数据
@@ -364,11 +422,15 @@ class DataParameterList(APIView, PagingViewMixin):
                                                     column_name__iexact=column_name)
         if not expected_column.exists():
             raise ValueError(f'传入的关联列 "{column_name}" 未在此填充规则中定义')
-        # 查询对应列的绑定规则数据
-        column_rule = expected_column[0]
-        generate_rule = GenerateRule.get_with_cache(column_rule.rule.id)
-        if generate_rule.function_name in {'join_string', 'calculate_expressions'}:
-            raise ValueError(f'传入的关联列 "{column_name}" 的生成规则不能为列值拼接、表达式计算')
+
+    @staticmethod
+    def validate_dependencies(data_params):
+        """关联的列可以是其它计算列，但不能循环引用"""
+        if not data_params:
+            return
+        column_rule = ColumnRule.objects.select_related('rule').get(pk=data_params[0]['column_rule_id'])
+        params = dict(((p['name'], p.get('value', '')) for p in data_params))
+        validate_column_dependencies(column_rule, params)
 
 
 class DataParameterDetail(APIView):
@@ -384,7 +446,7 @@ class DataParameterDetail(APIView):
         except DataParameter.DoesNotExist:
             raise ValueError('未查询到对应数据')
 
-    @cacheable('pk')
+    @cacheable('pk', namespace='DataParameter')
     def get(self, request, pk):
 
         data_parameter = self.get_object(pk)
@@ -392,7 +454,7 @@ class DataParameterDetail(APIView):
 
         return Response(serializer.data)
 
-    @cache_evict('pk')
+    @cache_evict('pk', namespace='DataParameter')
     def put(self, request, pk):
         data_parameter = self.get_object(pk)
         serializer = DataParameterSerializer(data_parameter, data=request.data)
@@ -401,13 +463,23 @@ class DataParameterDetail(APIView):
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    @cache_evict('pk')
+    @cache_evict('pk', namespace='DataParameter')
     def delete(self, request, pk):
         data_parameter = self.get_object(pk)
         data_parameter.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class DataParameterBulkDetail(BulkDetailView):
+    """
+    填充函数参数: 按多个ID查询
+    """
+    model = DataParameter
+    serializer_class = DataParameterSerializer
+    detail_view_name = 'DataParameterDetail'
+    namespace = 'DataParameter'
+
+
 class DataSetList(APIView, PagingViewMixin):
     """
     数据集: 查询所有/新增
@@ -446,7 +518,7 @@ class DataSetDetail(APIView):
         except DataSet.DoesNotExist:
             raise ValueError('未查询到对应数据')
 
-    @cacheable('pk')
+    @cacheable('pk', namespace='DataSet')
     def get(self, request, pk):
 
         data_set = self.get_object(pk)
@@ -454,7 +526,7 @@ class DataSetDetail(APIView):
 
         return Response(serializer.data)
 
-    @cache_evict('pk')
+    @cache_evict('pk', namespace='DataSet')
     def put(self, request, pk):
         data_set = self.get_object(pk)
         serializer = DataSetSerializer(data_set, data=request.data)
@@ -463,7 +535,7 @@ class DataSetDetail(APIView):
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    @cache_evict('pk')
+    @cache_evict('pk', namespace='DataSet')
     def delete(self, request, pk):
         # 列绑定和规则绑定的数据集都不能删除
         if DataSetBind.objects.filter(data_set_id__exact=pk).exists() or DataParameter.objects.filter(
@@ -492,7 +564,8 @@ class DataSetDefineList(APIView, PagingViewMixin, CacheManager):
             data_set_define = DataSetDefine.objects.filter(**params).order_by('id').values()
             return self.paging(data_set_define, query_params, DataSetDefineSerializer)
 
-        data = self.get_cache(str(data_set_id), query)
+        key = self.params_key(query_params, ('data_set_id', 'page', 'size'))
+        data = self.get_cache(key, query, (cache_namespace('DataSetDefine', int(data_set_id)),))
         return Response(data)
 
     def post(self, request: Request, format=None):
@@ -507,9 +580,9 @@ class DataSetDefineList(APIView, PagingViewMixin, CacheManager):
                 raise ValueError('不能定义重复的字段属性')
         if serializer.is_valid():
             data_set_id = define_list[0]['data_set_id']
+            # 删除和新增时都会增加数据集的版本号，缓存的所有页同时失效
             DataSetDefine.objects.filter(data_set_id__exact=data_set_id).delete()
             serializer.save()
-            self.invalid_cache(str(data_set_id))
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -527,7 +600,7 @@ class DataSetDefineDetail(APIView):
         except DataSetDefine.DoesNotExist:
             raise ValueError('未查询到对应数据')
 
-    @cacheable('pk')
+    @cacheable('pk', namespace='DataSetDefine')
     def get(self, request, pk):
 
         data_set_define = self.get_object(pk)
@@ -535,14 +608,14 @@ class DataSetDefineDetail(APIView):
 
         return Response(serializer.data)
 
-    @cache_evict('pk')
+    @cache_evict('pk', namespace='DataSetDefine')
     def delete(self, request, pk):
         data_set_define = self.get_object(pk)
         data_set_define.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class DataSetValueList(APIView, PagingViewMixin):
+class DataSetValueList(APIView, PagingViewMixin, CacheManager):
     """
     数据集数据: 查询所有/新增
     """
@@ -553,9 +626,14 @@ class DataSetValueList(APIView, PagingViewMixin):
         data_set_id = query_params.get('data_set_id', None)
         if not data_set_id:
             raise ValueError('必须传数据集ID参数')
-        query = {'data_set_id__exact': data_set_id}
-        data_set_value = DataSetValue.objects.filter(**query).order_by('-id').values()
-        data = self.paging(data_set_value, query_params, DataSetValueSerializer)
+
+        def query_page():
+            query = {'data_set_id__exact': data_set_id}
+            data_set_value = DataSetValue.objects.filter(**query).order_by('-id').values()
+            return self.paging(data_set_value, query_params, DataSetValueSerializer)
+
+        key = self.params_key(query_params, ('data_set_id', 'page', 'size'))
+        data = self.get_cache(key, query_page, (cache_namespace('DataSetValue', int(data_set_id)),))
         return Response(data)
 
     def post(self, request: Request, format=None):
@@ -579,7 +657,7 @@ class DataSetValueDetail(APIView):
         except DataSetValue.DoesNotExist:
             raise ValueError('未查询到对应数据')
 
-    @cacheable('pk')
+    @cacheable('pk', namespace='DataSetValue')
     def get(self, request, pk):
 
         data_set_value = self.get_object(pk)
@@ -587,7 +665,7 @@ class DataSetValueDetail(APIView):
 
         return Response(serializer.data)
 
-    @cache_evict('pk')
+    @cache_evict('pk', namespace='DataSetValue')
     def put(self, request, pk):
         data_set_value = self.get_object(pk)
         serializer = DataSetValueSerializer(data_set_value, data=request.data)
@@ -596,7 +674,7 @@ class DataSetValueDetail(APIView):
             return Response(serializer.data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    @cache_evict('pk')
+    @cache_evict('pk', namespace='DataSetValue')
     def delete(self, request, pk):
         data_set_value = self.get_object(pk)
         data_set_value.delete()
@@ -653,7 +731,7 @@ class DataSetBindDetail(APIView):
         except DataSetBind.DoesNotExist:
             raise ValueError('未查询到对应数据')
 
-    @cacheable('pk')
+    @cacheable('pk', namespace='DataSetBind')
     def get(self, request, pk):
 
         data_set_bind = self.get_object(pk)
@@ -661,13 +739,23 @@ class DataSetBindDetail(APIView):
 
         return Response(serializer.data)
 
-    @cache_evict('pk')
+    @cache_evict('pk', namespace='DataSetBind')
     def delete(self, request, pk):
         data_set_bind = self.get_object(pk)
         data_set_bind.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class DataSetBindBulkDetail(BulkDetailView):
+    """
+    数据集绑定: 按多个ID查询
+    """
+    model = DataSetBind
+    serializer_class = DataSetBindSerializer
+    detail_view_name = 'DataSetBindDetail'
+    namespace = 'DataSetBind'
+
+
 class GenerateRuleList(APIView, PagingViewMixin, CacheManager):
     """
     生成规则: 查询所有
@@ -684,7 +772,7 @@ class GenerateRuleList(APIView, PagingViewMixin, CacheManager):
 
         page = query_params.get('page', default=1)
         size = query_params.get('size', default=8)
-        data = self.get_cache(f'{page}of{size}', query)
+        data = self.get_cache(f'{page}of{size}', query, (cache_namespace('GenerateRule'),))
         return Response(data)
 
 
@@ -701,7 +789,7 @@ class GenerateRuleDetail(APIView):
         except GenerateRule.DoesNotExist:
             raise ValueError('未查询到对应数据')
 
-    @cacheable('pk')
+    @cacheable('pk', namespace='GenerateRule')
     def get(self, request, pk):
 
         generate_rule = self.get_object(pk)
@@ -732,7 +820,8 @@ class GenerateRuleParameterList(APIView, PagingViewMixin, CacheManager):
 
         page = query_params.get('page', default=1)
         size = query_params.get('size', default=8)
-        data = self.get_cache(f'{rule_id}@{page}of{size}', query)
+        data = self.get_cache(f'{rule_id}@{page}of{size}', query,
+                              (cache_namespace('GenerateRuleParameter', int(rule_id)),))
         return Response(data)
 
 
@@ -749,7 +838,7 @@ class GenerateRuleParameterDetail(APIView):
         except GenerateRuleParameter.DoesNotExist:
             raise ValueError('未查询到对应数据')
 
-    @cacheable('pk')
+    @cacheable('pk', namespace='GenerateRuleParameter')
     def get(self, request, pk):
 
         generate_rule_parameter = self.get_object(pk)
@@ -765,27 +854,95 @@ class GeneratesView(APIView):
     permission_classes = (permissions.IsAuthenticated,)
 
     @staticmethod
-    def generates(req_id: int):
-        limit_cache_key = 'GeneratesView:GenerateLimit'
-        request_count = cache.get(limit_cache_key, 0)
-
-        if request_count >= 42:
-            raise ValueError('您的操作频率太快，请稍后再试！')
-        # 1 分钟内 42 次操作
-        cache.set(limit_cache_key, request_count + 1, dc.minutes.to_seconds(1))
-
+    def generates(req_id: int, copies=1, archive=False):
         t0 = time.perf_counter()
-        fr = FillingRequirement.objects.get(pk=req_id)
         hash_id = uuid.uuid1().hex
-        fill_excel(fr, hash_id)
+        if settings.GENERATE_IN_WORKER:
+            # 只提交任务，不占用 Web 进程
+            defer_fill_excel(req_id, hash_id, copies, archive)
+        else:
+            fill_excel(req_id, hash_id, copies, archive)
         took = time.perf_counter() - t0
-        return Response(dict(requirement=req_id, fileId=hash_id, took=took))
+        if copies == 1 and not archive:
+            return Response(dict(requirement=req_id, fileId=hash_id, took=took))
+        file_ids = [hash_id] if archive else copy_file_ids(hash_id, copies)
+        return Response(dict(requirement=req_id, fileId=hash_id, fileIds=file_ids, copies=copies,
+                             archive=archive, took=took))
 
+    @staticmethod
+    def resolve_copies(params):
+        """解析生成的份数和是否打包，如 ?copies=5&archive=true"""
+        copies = params.get('copies', None) or 1
+        try:
+            copies = int(copies)
+        except (TypeError, ValueError):
+            raise ValueError('生成的份数必须是数字')
+        if copies < 1 or copies > settings.GENERATE_MAX_COPIES:
+            raise ValueError(f'支持生成的份数在1到{settings.GENERATE_MAX_COPIES}之间')
+        archive = str(params.get('archive', '')).lower() in ('1', 'true', 'yes')
+        return copies, archive
+
+    # 每个用户 1 分钟内 42 次操作，GET 和 POST 共用
+    @rate_limit('GeneratesView:GenerateLimit', 42, dc.minutes.to_seconds(1))
     def get(self, request: Request, requirement_id: int):
-        return self.generates(requirement_id)
+        return self.generates(requirement_id, *self.resolve_copies(request.query_params))
 
+    @rate_limit('GeneratesView:GenerateLimit', 42, dc.minutes.to_seconds(1))
     def post(self, request: Request, requirement_id: int):
-        return self.generates(requirement_id)
+        return self.generates(requirement_id, *self.resolve_copies(request.data or request.query_params))
+
+
+class GeneratesJobView(APIView):
+    """
+    生成任务: 查询状态、已写入行数和耗时
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request: Request, file_id: str):
+        return Response(get_job_status(file_id))
+
+
+class GeneratesBatchView(APIView):
+    """
+    批量填入并生成excel文件
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    # 每个用户 1 分钟内 10 次操作
+    @rate_limit('GeneratesBatchView:GenerateLimit', 10, dc.minutes.to_seconds(1))
+    def post(self, request: Request):
+        items = self.resolve_items(request.data.get('items', None))
+        batch = defer_fill_excel_batch(items)
+        return Response(dict(batch, total=len(items)), status=status.HTTP_202_ACCEPTED)
+
+    @staticmethod
+    def resolve_items(items):
+        """解析填充要求ID和可选的行数，如 [1, {"requirementId": 2, "lineNumber": 1000}]"""
+        if not isinstance(items, list) or not len(items):
+            raise ValueError('请传入需要生成的填充要求')
+        if len(items) > settings.GENERATE_BATCH_MAX_ITEMS:
+            raise ValueError(f'每批最多生成 {settings.GENERATE_BATCH_MAX_ITEMS} 个文件')
+        resolved = []
+        for item in items:
+            requirement_id, line_number = (item.get('requirementId', None), item.get('lineNumber', None)) \
+                if isinstance(item, dict) else (item, None)
+            if not isinstance(requirement_id, int) or isinstance(requirement_id, bool):
+                raise ValueError(f'填充要求ID不正确: {requirement_id}')
+            if line_number is not None and (not isinstance(line_number, int)
+                                            or not 1 <= line_number <= settings.FILL_MAX_LINE_NUMBER):
+                raise ValueError(f'支持填充行数在1到{settings.FILL_MAX_LINE_NUMBER}之间')
+            resolved.append((requirement_id, line_number))
+        return resolved
+
+
+class GeneratesBatchDetail(APIView):
+    """
+    批量生成: 查询整体状态和每个文件的状态
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request: Request, batch_id: str):
+        return Response(get_batch_status(batch_id))
 
 
 class FileUploadView(APIView):
@@ -799,10 +956,10 @@ class FileUploadView(APIView):
         if serializer.is_valid():
             file = serializer.validated_data['file']
             try:
-                storage = Storage(retry=0)
+                storage = get_storage(retry=0)
                 hash_id = uuid.uuid1().hex
                 storage.store_object(hash_id, file.file, file.size, folder='requirement',
-                                     content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+                                     content_type=XLSX_CONTENT_TYPE)
                 return Response(dict(fileId=hash_id, createdAt=datetime.datetime.now()), status=status.HTTP_201_CREATED)
             except Exception as e:
                 log.error('上传文件异常' + str(e))
@@ -811,6 +968,28 @@ class FileUploadView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class PresignedUploadView(APIView):
+    """直接上传文件到对象存储"""
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request):
+        try:
+            data = create_upload(request.user.username)
+        except Exception as e:
+            log.error('创建上传地址异常' + str(e))
+            raise ValueError('创建上传地址失败，请稍后再试')
+        return Response(data, status=status.HTTP_201_CREATED)
+
+
+class PresignedUploadCompleteView(APIView):
+    """直接上传完成后校验文件"""
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def post(self, request, file_id):
+        data = complete_upload(file_id, request.user.username)
+        return Response(data)
+
+
 class FileRecordList(APIView, PagingViewMixin):
     """
     生成文件记录: 查询所有
@@ -829,6 +1008,34 @@ class FileRecordList(APIView, PagingViewMixin):
         return Response(data)
 
 
+def parse_byte_range(header, size):
+    """解析 Range 请求头，只支持单个范围
+
+    :param header Range 请求头
+    :param size 文件大小
+    :return 起始和结束的字节位置（包含结束位置）；没有或不支持的请求头返回 None
+    :raise ValueError 范围无法满足
+    """
+    if not header:
+        return None
+    match = _BYTE_RANGE_PATTERN.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # bytes=-500 表示最后 500 个字节
+        if int(last) == 0 or size == 0:
+            raise ValueError('请求的范围无法满足')
+        return max(size - int(last), 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError('请求的范围无法满足')
+    return start, end
+
+
 class FileRecordDetail(APIView):
     """
     生成文件记录: 单个查询/删除
@@ -842,27 +1049,66 @@ class FileRecordDetail(APIView):
         except FileRecord.DoesNotExist:
             raise ValueError('未查询到对应数据')
 
+    # 每个用户 1 分钟内 30 次操作
+    @rate_limit('FileRecordDetail:DownloadLimit', 30, dc.minutes.to_seconds(1))
     def get(self, request, pk):
-
-        limit_cache_key = 'FileRecordDetail:DownloadLimit'
-        request_count = cache.get(limit_cache_key, 0)
-
-        if request_count >= 30:
-            raise ValueError('您的操作频率太快，请稍后再试！')
-        # 1 分钟内 30 次操作
-        cache.set(limit_cache_key, request_count + 1, dc.minutes.to_seconds(1))
-
         file_record = self.get_object(pk)
         try:
-            storage = Storage(retry=0)
-            data = io.BytesIO(storage.get_object(file_record.file_id))
-            data.seek(0)
-            # 返回文件下载
-            return FileResponse(data, as_attachment=True, filename=file_record.filename,
-                                content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+            storage = get_storage(retry=0)
+            stat = storage.stat_object(file_record.file_id)
+        except Exception as e:
+            log.error('处理下载文件异常' + str(e))
+            raise ValueError('处理下载文件异常，请稍后再试')
+        etag = f'"{stat.etag}"'
+        headers = {'ETag': etag, 'Accept-Ranges': 'bytes'}
+        # 客户端已有相同的文件
+        if_none_match = self.split_etags(request.headers.get('If-None-Match'))
+        if etag in if_none_match or '*' in if_none_match:
+            return HttpResponse(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        byte_range = None
+        if_range = request.headers.get('If-Range')
+        # If-Range 与当前文件不一致时返回整个文件
+        if not if_range or if_range == etag:
+            try:
+                byte_range = parse_byte_range(request.headers.get('Range'), stat.size)
+            except ValueError:
+                headers['Content-Range'] = f'bytes */{stat.size}'
+                return HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, headers=headers)
+        if byte_range:
+            start, end = byte_range
+            headers['Content-Range'] = f'bytes {start}-{end}/{stat.size}'
+            status_code = status.HTTP_206_PARTIAL_CONTENT
+        else:
+            start, end = 0, stat.size - 1
+            status_code = status.HTTP_200_OK
+        try:
+            # 长度为 0 时读取整个文件
+            stream = storage.open_object_stream(file_record.file_id, offset=start, length=end - start + 1) \
+                if stat.size else iter(())
         except Exception as e:
             log.error('处理下载文件异常' + str(e))
             raise ValueError('处理下载文件异常，请稍后再试')
+        headers['Content-Length'] = str(end - start + 1)
+        headers['Content-Disposition'] = self.attachment_header(file_record.filename)
+        # 分块从对象存储转发给客户端，不在内存中保留整个文件，多份打包的文件为 zip
+        return StreamingHttpResponse(stream, status=status_code, headers=headers,
+                                     content_type=stat.content_type or XLSX_CONTENT_TYPE)
+
+    @staticmethod
+    def split_etags(header):
+        """解析 If-None-Match 请求头中的 ETag"""
+        if not header:
+            return ()
+        return tuple(tag.strip().removeprefix('W/') for tag in header.split(','))
+
+    @staticmethod
+    def attachment_header(filename):
+        """下载文件的 Content-Disposition，非 ASCII 文件名按 RFC 5987 编码"""
+        try:
+            filename.encode('ascii')
+            return 'attachment; filename="{}"'.format(filename.replace('\\', '\\\\').replace('"', r'\"'))
+        except UnicodeEncodeError:
+            return "attachment; filename*=utf-8''{}".format(quote(filename))
 
     def delete(self, request, pk):
         file_record = self.get_object(pk)
@@ -874,8 +1120,25 @@ class FileRecordDetail(APIView):
     @staticmethod
     def delete_record_file(file_id):
         try:
-            storage = Storage(retry=0)
+            storage = get_storage(retry=0)
             storage.remove_object(file_id)
             log.info(f'生成记录的文件已删除: {file_id}')
         except Exception as e:
             log.error('生成记录的文件删除异常:' + str(e))
+
+
+class FileRecordUrlView(APIView):
+    """生成文件记录: 获得直接下载的临时地址"""
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, pk):
+        file_record = FileRecordDetail.get_object(pk)
+        expires = datetime.timedelta(seconds=settings.PRESIGNED_URL_EXPIRES)
+        try:
+            url = get_storage(retry=0).presigned_get_url(
+                file_record.file_id, expires,
+                content_disposition=FileRecordDetail.attachment_header(file_record.filename))
+        except Exception as e:
+            log.error('创建下载地址异常' + str(e))
+            raise ValueError('创建下载地址失败，请稍后再试')
+        return Response(dict(url=url, expiresAt=datetime.datetime.now() + expires))
@@ -0,0 +1,281 @@
+import copy
+import itertools
+import pathlib
+import pickle
+import sys
+import tempfile
+import time
+import typing
+
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import column_index_from_string
+
+from .logger import init_logger
+from .skeletons import file_digest, get_skeleton_cache
+from .xlsxpatch import write_with_xml_patch
+
+log = init_logger(__name__, 'celery-task.log')
+
+# 写入模式下每次转换为行的数量
+STREAM_CHUNK_SIZE = 1000
+
+
+def foreach_rows(worksheet, start_line, excel_data: dict):
+    for column, data_list in excel_data.items():
+        for num, val in zip(range(start_line, start_line + len(data_list)), data_list):
+            worksheet[f'{column}{num}'] = str(val)
+            worksheet[f'{column}{num}'].number_format = '@'
+
+
+def write_with_openpyxl(template_path, save_path, start_line, chunks: typing.Iterable[dict], line_number):
+    """读取整个模板后逐个单元格写入
+
+    整个工作簿都在内存中，适合行数较少的填充
+
+    :param template_path 模板文件路径
+    :param save_path 保存的文件路径
+    :param start_line 起始行
+    :param chunks 按块生成的列名对应的数据
+    :param line_number 总行数
+    """
+    book = _clone_workbook(template_path)
+    sheet = book.active
+    for offset, excel_data in _iter_chunk_offsets(chunks):
+        foreach_rows(sheet, start_line + offset, excel_data)
+    book.save(str(save_path))
+    book.close()
+
+
+def chunk_length(excel_data: dict):
+    """数据块的行数"""
+    return max((len(data_list) for data_list in excel_data.values()), default=0)
+
+
+def _iter_chunk_offsets(chunks: typing.Iterable[dict]):
+    """数据块和块的第一行相对于起始行的位置"""
+    offset = 0
+    for excel_data in chunks:
+        yield offset, excel_data
+        offset += chunk_length(excel_data)
+
+
+def _clone_workbook(template_path):
+    """从缓存的模板复制出新的工作簿
+
+    解析后的工作簿序列化后缓存，反序列化比重新解析 XML 快；无法序列化的模板每次重新解析
+    """
+    key = ('openpyxl', file_digest(template_path))
+    skeleton = get_skeleton_cache().get_or_load(key, lambda: _dump_workbook(template_path))
+    if skeleton is None:
+        return openpyxl.load_workbook(str(template_path))
+    return pickle.loads(skeleton)
+
+
+def _dump_workbook(template_path):
+    book = openpyxl.load_workbook(str(template_path))
+    try:
+        return pickle.dumps(book, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        log.warning(f'template can not be cached: {e}')
+        return None
+    finally:
+        book.close()
+
+
+class SheetSkeleton(typing.NamedTuple):
+    """只写模式需要的工作表结构"""
+    title: str
+    column_widths: tuple
+    row_heights: tuple
+    freeze_panes: typing.Optional[str]
+    merged_cells: tuple
+    # 复制的行，单元格为值和样式
+    rows: tuple
+
+
+class StreamSkeleton(typing.NamedTuple):
+    """只写模式需要的模板结构"""
+    # 按模板中的顺序排列的工作表
+    sheets: tuple[SheetSkeleton, ...]
+    # 写入数据的工作表的位置
+    active: int
+
+
+def write_with_stream(template_path, save_path, start_line, chunks: typing.Iterable[dict], line_number):
+    """以只写模式流式写入
+
+    写入数据的工作表只复制起始行之前的行（包括样式）、列宽和合并单元格，起始行及之后的模板内容不会保留，
+    适用于数据区域为空白的模板；其他工作表复制所有单元格的值和样式。图片、图表、数据验证和条件格式等不会保留，
+    需要保留时使用 openpyxl 或 xml 写入方式；数据块写入后即可释放
+
+    :param template_path 模板文件路径
+    :param save_path 保存的文件路径
+    :param start_line 起始行
+    :param chunks 按块生成的列名对应的数据
+    :param line_number 总行数
+    """
+    key = ('stream', file_digest(template_path), start_line)
+    skeleton = get_skeleton_cache().get_or_load(key, lambda: _read_stream_skeleton(template_path, start_line))
+    book = openpyxl.Workbook(write_only=True)
+    for idx, sheet_skeleton in enumerate(skeleton.sheets):
+        sheet = _create_sheet(book, sheet_skeleton)
+        if idx != skeleton.active:
+            continue
+        # 补齐模板中不存在的空行
+        for _ in range(len(sheet_skeleton.rows), start_line - 1):
+            sheet.append([])
+        # 文本格式的样式只计算一次，所有单元格共用
+        text_cell = WriteOnlyCell(sheet)
+        text_cell.number_format = '@'
+        text_style = text_cell._style
+        for excel_data in chunks:
+            for rows in _iter_row_chunks(excel_data, STREAM_CHUNK_SIZE):
+                for row in rows:
+                    sheet.append([_text_cell(sheet, text_style, val) for val in row])
+    book.active = skeleton.active
+    book.save(str(save_path))
+    book.close()
+
+
+def _create_sheet(book, skeleton: SheetSkeleton):
+    """按工作表结构创建只写的工作表并写入复制的行"""
+    sheet = book.create_sheet(skeleton.title)
+    # 行列样式需要在写入单元格之前设置
+    for column_key, width in skeleton.column_widths:
+        sheet.column_dimensions[column_key].width = width
+    for row_idx, height in skeleton.row_heights:
+        sheet.row_dimensions[row_idx].height = height
+    sheet.freeze_panes = skeleton.freeze_panes
+    for coord in skeleton.merged_cells:
+        sheet.merged_cells.add(coord)
+    for row in skeleton.rows:
+        sheet.append([_new_cell(sheet, cell) for cell in row])
+    return sheet
+
+
+def _read_stream_skeleton(template_path, start_line):
+    """读取所有工作表的结构，写入数据的工作表只读取起始行之前的行"""
+    template = openpyxl.load_workbook(str(template_path))
+    active = template.worksheets.index(template.active)
+    sheets = tuple(_read_sheet_skeleton(source, start_line if idx == active else None)
+                   for idx, source in enumerate(template.worksheets))
+    template.close()
+    return StreamSkeleton(sheets, active)
+
+
+def _read_sheet_skeleton(source, start_line=None):
+    """读取工作表的行、列宽、行高和合并单元格
+
+    :param source 模板中的工作表
+    :param start_line 起始行，只读取之前的行；为空时读取所有行
+    """
+    max_row = source.max_row if start_line is None else start_line - 1
+    column_widths = tuple((key, dimension.width) for key, dimension in source.column_dimensions.items()
+                          if dimension.width)
+    row_heights = tuple((row_idx, source.row_dimensions[row_idx].height) for row_idx in range(1, max_row + 1)
+                        if row_idx in source.row_dimensions and source.row_dimensions[row_idx].height)
+    merged_cells = tuple(merged.coord for merged in source.merged_cells.ranges if merged.max_row <= max_row)
+    rows = ()
+    if max_row > 0:
+        rows = tuple(tuple(_read_cell(cell) for cell in row) for row in source.iter_rows(min_row=1, max_row=max_row))
+    return SheetSkeleton(source.title, column_widths, row_heights, source.freeze_panes, merged_cells, rows)
+
+
+def _read_cell(cell):
+    """读取模板单元格的值和样式"""
+    if cell.value is None and not cell.has_style:
+        return None
+    if not cell.has_style:
+        return cell.value, None
+    return cell.value, (copy.copy(cell.font), copy.copy(cell.fill), copy.copy(cell.border),
+                        copy.copy(cell.alignment), copy.copy(cell.protection), cell.number_format)
+
+
+def _new_cell(sheet, cell):
+    """按模板单元格的值和样式创建单元格"""
+    if cell is None:
+        return None
+    value, style = cell
+    new_cell = WriteOnlyCell(sheet, value=value)
+    if style:
+        new_cell.font, new_cell.fill, new_cell.border, new_cell.alignment, new_cell.protection, \
+            new_cell.number_format = style
+    return new_cell
+
+
+def _text_cell(sheet, text_style, val):
+    """创建文本格式的单元格"""
+    if val is None:
+        return None
+    cell = WriteOnlyCell(sheet, value=str(val))
+    # 写入后样式不会再修改，共用同一个样式
+    cell._style = text_style
+    return cell
+
+
+def _iter_row_chunks(excel_data: dict, chunk_size):
+    """将按列存储的数据分批转为按行的数据
+
+    :param excel_data 列名对应的数据
+    :param chunk_size 每批的行数
+    """
+    if not excel_data:
+        return
+    # 列名转为列的位置，缺少的列补空
+    indexes = dict(((column_index_from_string(column), column) for column in excel_data))
+    width = max(indexes)
+    length = max(len(data_list) for data_list in excel_data.values())
+    for start in range(0, length, chunk_size):
+        stop = min(start + chunk_size, length)
+        columns = []
+        for idx in range(1, width + 1):
+            column = indexes.get(idx, None)
+            data_list = excel_data[column][start:stop] if column else ()
+            columns.append(data_list)
+        yield itertools.zip_longest(*columns, fillvalue=None)
+
+
+__WRITERS__ = {
+    'openpyxl': write_with_openpyxl,
+    'stream': write_with_stream,
+    'xml': write_with_xml_patch
+}
+
+
+def get_writer(engine):
+    """按写入方式获得写入函数，默认读取整个模板写入"""
+    return __WRITERS__.get(engine, write_with_openpyxl)
+
+
+def benchmark(line_number=10000, column_number=8, start_line=2):
+    """比较各写入方式的耗时
+
+    python -m fills.writers 10000
+
+    :param line_number 写入行数
+    :param column_number 写入列数
+    :param start_line 起始行
+    """
+    with tempfile.TemporaryDirectory() as tempdir:
+        tmp_dir = pathlib.Path(tempdir)
+        template_path = tmp_dir / 'template.xlsx'
+        # 带有表头样式的模板
+        book = openpyxl.Workbook()
+        sheet = book.active
+        for idx in range(1, column_number + 1):
+            cell = sheet.cell(1, idx, f'title-{idx}')
+            cell.font = openpyxl.styles.Font(bold=True)
+        book.save(str(template_path))
+        excel_data = dict(((openpyxl.utils.get_column_letter(idx), [f'{idx}-{n}' for n in range(line_number)])
+                           for idx in range(1, column_number + 1)))
+        for engine, writer in __WRITERS__.items():
+            t0 = time.perf_counter()
+            writer(template_path, tmp_dir / f'{engine}.xlsx', start_line, (excel_data,), line_number)
+            took = time.perf_counter() - t0
+            size = (tmp_dir / f'{engine}.xlsx').stat().st_size
+            print(f'{engine:>10}: {took:.3f}s, {size} bytes')
+
+
+if __name__ == '__main__':
+    benchmark(*(int(arg) for arg in sys.argv[1:]))
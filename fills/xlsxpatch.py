@@ -0,0 +1,315 @@
+"""直接修改 .xlsx 中工作表 XML 的写入方式
+
+只重新生成活动工作表和样式表，其余 zip 成员按原来的压缩方式流式复制；
+活动工作表也是流式读取，只有 sheetData 之前的部分和一块数据会同时放在内存中
+"""
+import itertools
+import posixpath
+import re
+import shutil
+import typing
+import zipfile
+from xml.sax.saxutils import escape
+
+from lxml import etree
+from openpyxl.utils import column_index_from_string, get_column_letter
+
+SHEET_MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+RELATIONSHIP_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PACKAGE_RELATIONSHIP_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+# 内置的文本格式 "@"
+TEXT_NUMBER_FORMAT_ID = '49'
+# 每次写入 zip 的行数
+PATCH_CHUNK_SIZE = 1000
+# 每次读取模板工作表的字节数
+SHEET_READ_SIZE = 64 * 1024
+
+_SHEET_DATA_PATTERN = re.compile(rb'<(?:(\w+):)?sheetData(?:\s[^>]*)?(/?)>')
+_ROOT_TAG_PATTERN = re.compile(rb'<[^?!][^>]*>')
+_NAMESPACE_PATTERN = re.compile(rb'\sxmlns(?::\w+)?="[^"]*"')
+_CELL_REF_PATTERN = re.compile(r'^([A-Z]+)(\d+)$')
+
+
+def write_with_xml_patch(template_path, save_path, start_line, chunks: typing.Iterable[dict], line_number):
+    """直接修改工作表 XML 写入数据
+
+    模板的所有内容都会保留，数据以行内字符串写入，数据区域已有的模板单元格会被替换；
+    数据块写入后即可释放
+
+    :param template_path 模板文件路径
+    :param save_path 保存的文件路径
+    :param start_line 起始行
+    :param chunks 按块生成的列名对应的数据
+    :param line_number 总行数
+    """
+    with zipfile.ZipFile(str(template_path)) as source:
+        styles_path = 'xl/styles.xml'
+        styles = _add_text_style(source.read(styles_path)) if styles_path in source.NameToInfo else None
+        if styles is not None:
+            _patch_workbook(source, save_path, start_line, chunks, line_number, styles_path, styles)
+            return
+    # 没有可追加文本样式的样式表，改为读取整个模板写入
+    from .writers import write_with_openpyxl
+    write_with_openpyxl(template_path, save_path, start_line, chunks, line_number)
+
+
+def _patch_workbook(source: zipfile.ZipFile, save_path, start_line, chunks, line_number, styles_path, styles):
+    """替换活动工作表和样式表，其余成员原样复制"""
+    sheet_path = _active_sheet_path(source)
+    styles_xml, text_style = styles
+    with zipfile.ZipFile(str(save_path), 'w', compression=zipfile.ZIP_DEFLATED) as target:
+        for info in source.infolist():
+            if info.filename == sheet_path:
+                with source.open(info) as sheet, target.open(_new_info(info), 'w', force_zip64=True) as out:
+                    _patch_sheet(sheet, out, start_line, chunks, line_number, text_style)
+            elif info.filename == styles_path:
+                target.writestr(_new_info(info), styles_xml)
+            else:
+                _copy_member(source, target, info)
+
+
+def _new_info(info: zipfile.ZipInfo, compress_type=zipfile.ZIP_DEFLATED):
+    """重新压缩的成员沿用原来的文件名和时间"""
+    new_info = zipfile.ZipInfo(info.filename, info.date_time)
+    new_info.compress_type = compress_type
+    new_info.external_attr = info.external_attr
+    return new_info
+
+
+def _copy_member(source: zipfile.ZipFile, target: zipfile.ZipFile, info: zipfile.ZipInfo):
+    """按原来的压缩方式流式复制 zip 成员，不把整个成员读入内存
+
+    :param source 模板文件
+    :param target 写入的 zip 文件
+    :param info 源文件的成员信息
+    """
+    with source.open(info) as src, target.open(_new_info(info, info.compress_type), 'w', force_zip64=True) as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def _active_sheet_path(source: zipfile.ZipFile):
+    """获得活动工作表在 zip 中的路径"""
+    workbook = etree.fromstring(source.read('xl/workbook.xml'))
+    view = workbook.find(f'{{{SHEET_MAIN_NS}}}bookViews/{{{SHEET_MAIN_NS}}}workbookView')
+    active = int(view.get('activeTab', 0)) if view is not None else 0
+    sheets = workbook.findall(f'{{{SHEET_MAIN_NS}}}sheets/{{{SHEET_MAIN_NS}}}sheet')
+    rel_id = sheets[active].get(f'{{{RELATIONSHIP_NS}}}id')
+    rels = etree.fromstring(source.read('xl/_rels/workbook.xml.rels'))
+    for rel in rels.iterfind(f'{{{PACKAGE_RELATIONSHIP_NS}}}Relationship'):
+        if rel.get('Id') == rel_id:
+            target = rel.get('Target')
+            if target.startswith('/'):
+                return target.lstrip('/')
+            return posixpath.normpath(posixpath.join('xl', target))
+    raise ValueError('模板中未找到活动的工作表')
+
+
+def _add_text_style(styles_xml: bytes):
+    """在样式表中追加文本格式的单元格样式
+
+    :return 新的样式表和文本样式的序号，样式表中没有 cellXfs 时返回 None
+    """
+    styles = etree.fromstring(styles_xml)
+    cell_xfs = styles.find(f'{{{SHEET_MAIN_NS}}}cellXfs')
+    if cell_xfs is None:
+        return None
+    index = len(cell_xfs)
+    etree.SubElement(cell_xfs, f'{{{SHEET_MAIN_NS}}}xf', numFmtId=TEXT_NUMBER_FORMAT_ID, fontId='0', fillId='0',
+                     borderId='0', xfId='0', applyNumberFormat='1')
+    cell_xfs.set('count', str(index + 1))
+    return etree.tostring(styles, xml_declaration=True, encoding='UTF-8', standalone=True), index
+
+
+def _patch_sheet(sheet, out, start_line, chunks: typing.Iterable[dict], line_number, text_style):
+    """将数据行合并到工作表的 sheetData 中
+
+    :param sheet 模板工作表的文件流
+    :param out 写入的文件
+    :param start_line 起始行
+    :param chunks 按块生成的列名对应的数据
+    :param line_number 总行数
+    :param text_style 文本样式的序号
+    """
+    buffer, match = _read_head(sheet)
+    prefix = match.group(1) + b':' if match.group(1) else b''
+    end_tag = b'</' + prefix + b'sheetData>'
+    if match.group(2):
+        # <sheetData/> 没有任何行
+        head = buffer[:match.start()] + b'<' + prefix + b'sheetData>'
+        reader = None
+        template_rows = iter(())
+    else:
+        head = buffer[:match.end()]
+        # 使用工作表根元素声明的命名空间包装为完整的 XML
+        root_tag = _ROOT_TAG_PATTERN.search(head).group(0)
+        opening = b'<' + prefix + b'sheetData' + b''.join(_NAMESPACE_PATTERN.findall(root_tag)) + b'>'
+        reader = _SheetDataReader(sheet, opening + buffer[match.end():], end_tag)
+        template_rows = _iter_template_rows(reader)
+    # 使用范围在写入行之前，从第一块数据得到最大的列
+    chunks = iter(chunks)
+    first = next(chunks, None)
+    chunks = itertools.chain((first,), chunks) if first is not None else ()
+    max_column = max((column_index_from_string(column) for column in first), default=0) if first else 0
+    out.write(_update_dimension(head, prefix, start_line + line_number - 1, max_column))
+    tag = prefix.decode()
+    generated_rows = _iter_generated_rows(chunks, start_line, tag, text_style)
+    rows = []
+    for row in _merge_rows(template_rows, generated_rows, tag):
+        rows.append(row)
+        if len(rows) >= PATCH_CHUNK_SIZE:
+            out.write(b''.join(rows))
+            rows.clear()
+    out.write(b''.join(rows))
+    # sheetData 之后的部分原样复制
+    out.write(end_tag)
+    out.write(buffer[match.end():] if reader is None else reader.tail)
+    shutil.copyfileobj(sheet, out, SHEET_READ_SIZE)
+
+
+def _read_head(sheet):
+    """读取工作表到 sheetData 开始标签为止
+
+    :return 已读取的内容和 sheetData 开始标签的匹配
+    """
+    buffer = b''
+    while True:
+        data = sheet.read(SHEET_READ_SIZE)
+        if not data:
+            raise ValueError('模板工作表缺少 sheetData')
+        # 标签可能跨越两次读取，从上次末尾之前开始查找
+        offset = max(len(buffer) - 256, 0)
+        buffer += data
+        match = _SHEET_DATA_PATTERN.search(buffer, offset)
+        if match:
+            return buffer, match
+
+
+class _SheetDataReader:
+    """按需读取 sheetData 中的行，读到结束标签为止，结束标签之后的内容保存在 tail 中"""
+
+    def __init__(self, sheet, buffer: bytes, end_tag: bytes):
+        self.sheet = sheet
+        self.buffer = buffer
+        self.end_tag = end_tag
+        self.tail = b''
+        self.done = False
+        self._find_end()
+
+    def _find_end(self):
+        index = self.buffer.find(self.end_tag)
+        if index >= 0:
+            # 结束标签作为包装元素的结束
+            end = index + len(self.end_tag)
+            self.buffer, self.tail = self.buffer[:end], self.buffer[end:]
+            self.done = True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = SHEET_READ_SIZE
+        # 保留可能是结束标签开头的字节
+        while not self.done and len(self.buffer) < size + len(self.end_tag):
+            data = self.sheet.read(SHEET_READ_SIZE)
+            if not data:
+                raise ValueError('模板工作表的 sheetData 没有结束')
+            self.buffer += data
+            self._find_end()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def _update_dimension(head: bytes, prefix: bytes, max_row, max_column):
+    """扩大工作表的使用范围"""
+    pattern = re.compile(b'(<' + prefix + rb'dimension\s+ref=")([^"]*)(")')
+    match = pattern.search(head)
+    if not match or max_column <= 0:
+        return head
+    refs = match.group(2).decode().split(':')
+    first = _CELL_REF_PATTERN.match(refs[0])
+    last = _CELL_REF_PATTERN.match(refs[-1])
+    if not first or not last:
+        return head
+    column = get_column_letter(max(column_index_from_string(last.group(1)), max_column))
+    row = max(int(last.group(2)), max_row)
+    ref = f'{first.group(0)}:{column}{row}'.encode()
+    return head[:match.start(2)] + ref + head[match.end(2):]
+
+
+def _iter_template_rows(reader: _SheetDataReader):
+    """流式读取模板中已有的行
+
+    :return 行号和行元素
+    """
+    row_number = 0
+    for _, elem in etree.iterparse(reader, events=('end',), tag=f'{{{SHEET_MAIN_NS}}}row'):
+        row_number = int(elem.get('r', row_number + 1))
+        yield row_number, elem
+        # 释放已处理的行
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def _iter_generated_rows(chunks: typing.Iterable[dict], start_line, tag: str, text_style):
+    """生成数据行
+
+    :return 行号和列序号对应的单元格
+    """
+    first_row = start_line
+    for excel_data in chunks:
+        columns = sorted(((column_index_from_string(column), column) for column in excel_data))
+        length = max((len(data_list) for data_list in excel_data.values()), default=0)
+        for offset in range(length):
+            row_number = first_row + offset
+            cells = {}
+            for idx, column in columns:
+                data_list = excel_data[column]
+                if offset >= len(data_list) or data_list[offset] is None:
+                    continue
+                val = str(data_list[offset])
+                space = ' xml:space="preserve"' if val != val.strip() else ''
+                cells[idx] = (f'<{tag}c r="{column}{row_number}" s="{text_style}" t="inlineStr">'
+                              f'<{tag}is><{tag}t{space}>{escape(val)}</{tag}t></{tag}is></{tag}c>')
+            yield row_number, cells
+        first_row += length
+
+
+def _merge_rows(template_rows, generated_rows, tag: str):
+    """按行号合并模板行和数据行"""
+    template_row = next(template_rows, None)
+    for row_number, cells in generated_rows:
+        # 数据行之前的模板行
+        while template_row and template_row[0] < row_number:
+            yield etree.tostring(template_row[1])
+            template_row = next(template_rows, None)
+        if template_row and template_row[0] == row_number:
+            yield _merge_row(template_row[1], cells)
+            template_row = next(template_rows, None)
+        else:
+            body = ''.join(cells[idx] for idx in sorted(cells))
+            yield f'<{tag}row r="{row_number}">{body}</{tag}row>'.encode()
+    # 数据行之后的模板行
+    while template_row:
+        yield etree.tostring(template_row[1])
+        template_row = next(template_rows, None)
+
+
+def _merge_row(row, cells: dict):
+    """将数据单元格合并到模板已有的行中，替换相同列的单元格"""
+    merged = dict(cells)
+    for c in row.findall(f'{{{SHEET_MAIN_NS}}}c'):
+        match = _CELL_REF_PATTERN.match(c.get('r', ''))
+        idx = column_index_from_string(match.group(1)) if match else None
+        if idx is not None and idx not in merged:
+            merged[idx] = etree.tostring(c).decode()
+        row.remove(c)
+    # 列范围已变化，删除可选的 spans
+    if 'spans' in row.attrib:
+        del row.attrib['spans']
+    row_xml = etree.tostring(row).decode()
+    body = ''.join(merged[idx] for idx in sorted(merged))
+    if row_xml.endswith('/>'):
+        start_tag = row_xml[:-2]
+        end_tag = '</' + start_tag[1:].split(None, 1)[0] + '>'
+        return (start_tag + '>' + body + end_tag).encode()
+    close = row_xml.rindex('</')
+    return (row_xml[:close] + body + row_xml[close:]).encode()